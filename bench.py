@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки обработки видео.
+
+Сравнение обычного и параллельного кодирования для Telegram:
+    python bench.py transcode /path/to/video.mp4 --runs 3
+
+Набор бенчмарков этапов на синтетических видео (ffmpeg lavfi) с заглушками
+вместо платформы (локальный файловый сервер для yt-dlp) и Bot API (локальный HTTP-сервер):
+    python bench.py suite --profiles short-720p long-1080p --output results.json
+
+Сравнение двух сохраненных прогонов (например, до и после коммита):
+    python bench.py compare before.json after.json --threshold 10
+
+Проверка отправки через свой сервер Bot API (BOT_API_URL) на заглушке: лимит 1950 MB,
+файл больше облачного лимита уходит целиком, в BOT_API_LOCAL_MODE - путем file://, иначе в теле запроса:
+    python bench.py botapi --profile high-bitrate-720p
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import pathlib
+import platform
+import threading
+import subprocess
+import multiprocessing
+import urllib.parse
+from types import SimpleNamespace
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+
+try:
+    import resource
+except ImportError:
+    # Не Unix: процессорное время и память процессов не измеряются
+    resource = None
+
+import main
+
+
+async def probe_source(path: str) -> dict:
+    """Длительность, высота и наличие аудио у исходного файла"""
+    media = await main.probe_media(path)
+    return {
+        'duration': media.duration,
+        'height': media.height or 720,
+        'has_audio': media.has_audio
+    }
+
+
+async def bench_transcode(path: str, runs: int):
+    source = await probe_source(path)
+    video_args = main.telegram_video_args(min(720, source['height']))
+    print(f"📹 {os.path.basename(path)}: {source['duration']:.1f}s, {source['height']}p, "
+          f"{os.path.getsize(path) / (1024 * 1024):.1f} MB")
+    print(f"⚙️ Параллельных процессов: {main.PARALLEL_TRANSCODE_JOBS} × {main.PARALLEL_THREADS_PER_JOB} потока\n")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for mode in ('single', 'parallel'):
+            timings = []
+            output_size = 0
+            for run in range(runs):
+                output_path = os.path.join(work_dir, f"{mode}_{run}.mp4")
+                started = time.perf_counter()
+                if mode == 'single':
+                    ok = await main.encode_single(path, output_path, video_args, source['duration'])
+                else:
+                    ok = await main.encode_parallel(path, output_path, video_args, source['duration'],
+                                                    source['has_audio'])
+                elapsed = time.perf_counter() - started
+                if not ok:
+                    raise SystemExit(f"❌ Кодирование в режиме {mode} завершилось ошибкой")
+
+                timings.append(elapsed)
+                output_size = os.path.getsize(output_path)
+                os.remove(output_path)
+                print(f"  {mode:<8} прогон {run + 1}: {elapsed:.1f}s")
+
+            results[mode] = {'best': min(timings), 'mean': sum(timings) / len(timings), 'size': output_size}
+
+    print()
+    for mode, stats in results.items():
+        print(f"{mode:<8} лучшее {stats['best']:.1f}s, среднее {stats['mean']:.1f}s, "
+              f"размер {stats['size'] / (1024 * 1024):.1f} MB")
+    print(f"🚀 Ускорение: ×{results['single']['best'] / results['parallel']['best']:.2f}")
+
+
+# Синтетические видео: testsrc2 + синус детерминированы, поэтому файлы воспроизводимы
+# для одной версии ffmpeg/x264
+PROFILES = {
+    'short-720p': {'duration': 20, 'width': 1280, 'height': 720, 'fps': 30, 'bitrate': '3M'},
+    'low-360p': {'duration': 60, 'width': 640, 'height': 360, 'fps': 25, 'bitrate': '800k'},
+    'long-1080p': {'duration': 120, 'width': 1920, 'height': 1080, 'fps': 30, 'bitrate': '8M'},
+    'high-bitrate-720p': {'duration': 60, 'width': 1280, 'height': 720, 'fps': 60, 'bitrate': '12M'},
+}
+
+STAGES = ('download', 'probe', 'thumbnail', 'optimize', 'split', 'upload')
+
+
+def generate_media(profile: str, params: dict, media_dir: str) -> str:
+    """Создает (или берет готовое) синтетическое видео профиля через ffmpeg lavfi"""
+    path = os.path.join(
+        media_dir,
+        f"{profile}_{params['width']}x{params['height']}_{params['fps']}fps_{params['bitrate']}_{params['duration']}s.mp4"
+    )
+    if os.path.exists(path):
+        return path
+
+    duration = params['duration']
+    cmd = [
+        "ffmpeg", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={params['width']}x{params['height']}:rate={params['fps']}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+        "-b:v", params['bitrate'], "-maxrate", params['bitrate'], "-bufsize", params['bitrate'],
+        "-g", str(params['fps'] * 2),
+        "-c:a", "aac", "-b:a", "128k",
+        "-movflags", "+faststart",
+        "-y", f"{path}.tmp.mp4"
+    ]
+    print(f"🎨 Генерирую {profile}...")
+    subprocess.run(cmd, check=True)
+    os.replace(f"{path}.tmp.mp4", path)
+    return path
+
+
+def _serve_files(directory: str, port_queue):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(_QuietFileHandler, directory=directory))
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+class _QuietFileHandler(SimpleHTTPRequestHandler):
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            pass  # yt-dlp закрывает соединение после чтения заголовков
+
+    def log_message(self, *args):
+        pass
+
+
+class _BotApiStub(BaseHTTPRequestHandler):
+    """Заглушка Bot API: читает тело запроса целиком и отвечает правдоподобным сообщением"""
+    protocol_version = 'HTTP/1.1'
+    message_ids = iter(range(1, 10 ** 9))
+
+    def read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def send_result(self, result):
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.read_body()
+        method = self.path.rsplit('/', 1)[-1]
+        message_id = next(self.message_ids)
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif method in ('deleteMessage', 'answerCallbackQuery'):
+            result = True
+        else:
+            result = {
+                'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': 1, 'type': 'private'},
+                'video': {'file_id': f"video{message_id}", 'file_unique_id': f"u{message_id}",
+                          'width': 1280, 'height': 720, 'duration': 1},
+                'document': {'file_id': f"doc{message_id}", 'file_unique_id': f"d{message_id}"}
+            }
+        self.send_result(result)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve_bot_api(port_queue):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _BotApiStub)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+class _UploadRecorder(_BotApiStub):
+    """Заглушка Bot API, которая сообщает в очередь, в каком виде пришел файл в sendVideo"""
+    uploads = None
+
+    def read_body(self) -> bytes:
+        body = super().read_body()
+        if self.path.endswith('/sendVideo'):
+            # Путь в local_mode приходит полем video: в форме или, если файлов нет, urlencoded
+            if self.headers.get('Content-Type', '').startswith('multipart/'):
+                video = re.search(rb'name="video"\r\n\r\n([^\r]*)', body)
+                video = video.group(1).decode(errors='replace') if video else None
+            else:
+                video = (urllib.parse.parse_qs(body.decode()).get('video') or [None])[0]
+            self.uploads.put({'bytes': len(body), 'video': video})
+        return body
+
+
+def _serve_upload_recorder(uploads, port_queue):
+    _UploadRecorder.uploads = uploads
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _UploadRecorder)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def start_stub(target, *args) -> tuple:
+    """Запускает заглушку в отдельном процессе, чтобы ее CPU не смешивался с измерениями этапов"""
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=(*args, port_queue), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=10)
+
+
+def _child_pids(parent: int, exclude: set) -> list:
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit() or int(entry) in exclude:
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        if int(stat.rsplit(')', 1)[1].split()[1]) == parent:
+            children.append(int(entry))
+    return children
+
+
+def _rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+
+class RssSampler:
+    """Пиковая память бота вместе с дочерними процессами (ffmpeg, yt-dlp) - опрос /proc"""
+
+    def __init__(self, exclude: set, interval: float = 0.05):
+        self.exclude = exclude
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = 0
+        self._stop.clear()
+        if os.path.isdir('/proc'):
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        pid = os.getpid()
+        while not self._stop.is_set():
+            total = _rss_bytes(pid) + sum(_rss_bytes(child) for child in _child_pids(pid, self.exclude))
+            self.peak = max(self.peak, total)
+            self._stop.wait(self.interval)
+
+
+def _cpu_seconds() -> float:
+    if resource is None:
+        return 0.0
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _bytes_written() -> int:
+    """Записанные на диск байты процессом и завершенными дочерними процессами (Linux)"""
+    try:
+        with open('/proc/self/io') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('write_bytes'))
+    except (OSError, StopIteration):
+        return 0
+
+
+async def measure(stage: str, profile: str, exclude: set, action) -> dict:
+    """Выполняет этап и снимает стеновое и процессорное время, пик памяти и записанные байты"""
+    cpu_before = _cpu_seconds()
+    written_before = _bytes_written()
+    error = None
+    output_bytes = None
+    with RssSampler(exclude) as sampler:
+        started = time.perf_counter()
+        try:
+            output_bytes = await action()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        wall = time.perf_counter() - started
+
+    result = {
+        'profile': profile,
+        'stage': stage,
+        'wall_s': round(wall, 3),
+        'cpu_s': round(_cpu_seconds() - cpu_before, 3),
+        'peak_rss_mb': round(sampler.peak / (1024 * 1024), 1),
+        'disk_written_mb': round((_bytes_written() - written_before) / (1024 * 1024), 1),
+        'output_mb': round(output_bytes / (1024 * 1024), 2) if output_bytes is not None else None,
+        'error': error
+    }
+    status = f"❌ {error}" if error else f"{result['output_mb']} MB" if output_bytes is not None else ""
+    print(f"  {stage:<10} {wall:7.2f}s  cpu {result['cpu_s']:7.2f}s  rss {result['peak_rss_mb']:7.1f} MB  "
+          f"диск {result['disk_written_mb']:7.1f} MB  {status}")
+    return result
+
+
+async def bench_profile(profile: str, source: str, work_dir: str, file_url: str, bot, split_mb: float,
+                        exclude: set) -> list:
+    results = []
+    profile_dir = os.path.join(work_dir, profile)
+    os.makedirs(profile_dir, exist_ok=True)
+    files = {}
+
+    async def download():
+        # yt-dlp качает файл с локального сервера как обычную прямую ссылку
+        files['path'] = await main.download_backend.download(
+            f"{file_url}/{os.path.basename(source)}", 'best', profile_dir
+        )
+        return os.path.getsize(files['path'])
+
+    async def probe():
+        main._media_info_cache.clear()
+        await main.probe_media(files['path'])
+        return None
+
+    async def thumbnail():
+        thumbnail_path = await main.create_thumbnail(files['path'])
+        return os.path.getsize(thumbnail_path) if thumbnail_path else None
+
+    async def optimize():
+        paths_before = dict(main.optimization_paths)
+        output = await main.optimize_video_for_telegram(files['path'], os.path.join(profile_dir, "optimized.mp4"))
+        files['optimize_path'] = ",".join(
+            path for path, count in main.optimization_paths.items() if count > paths_before.get(path, 0)
+        )
+        return os.path.getsize(output)
+
+    async def split():
+        files['parts'] = await main.split_large_file(files['path'], max_size_mb=split_mb)
+        return sum(os.path.getsize(part) for part in files['parts'])
+
+    details = {
+        'optimize': lambda: {'path': files.get('optimize_path')},
+        'split': lambda: {'parts': len(files.get('parts') or [])},
+    }
+
+    async def upload():
+        context = SimpleNamespace(bot=bot)
+        parts = files['parts']
+        if parts == [files['path']]:
+            # Файл не делился - отправляем копию, send_video_parts удаляет отправленное
+            copy = os.path.join(profile_dir, "upload.mp4")
+            os.link(files['path'], copy)
+            parts = [copy]
+        size = sum(os.path.getsize(part) for part in parts)
+        if not await main.send_video_parts(1, parts, context, os.path.basename(files['path'])):
+            raise RuntimeError("send_video_parts вернул ошибку")
+        return size
+
+    actions = {'download': download, 'probe': probe, 'thumbnail': thumbnail, 'optimize': optimize,
+               'split': split, 'upload': upload}
+    for stage in STAGES:
+        if stage != 'download' and 'path' not in files:
+            # Без yt-dlp этапы идут по исходному файлу
+            files['path'] = os.path.join(profile_dir, os.path.basename(source))
+            os.link(source, files['path'])
+        if stage == 'upload' and 'parts' not in files:
+            break
+        result = await measure(stage, profile, exclude, actions[stage])
+        if stage in details:
+            result.update(details[stage]())
+        results.append(result)
+    return results
+
+
+def _send_through_bot_api(path: str, result_queue):
+    """
+    Процесс с настройками своего сервера Bot API: main импортируется заново и читает
+    BOT_API_URL/BOT_API_LOCAL_MODE из окружения, как при запуске бота
+    """
+    async def send():
+        parts = await main.split_large_file(path)
+        application = main.build_application()
+        async with application.bot:
+            sent = await main.send_video_parts(1, parts, SimpleNamespace(bot=application.bot),
+                                               os.path.basename(path))
+        return {'limit_mb': main.TELEGRAM_UPLOAD_LIMIT_MB, 'parts': len(parts), 'sent': bool(sent)}
+
+    result_queue.put(asyncio.run(send()))
+
+
+def check_bot_api(profile: str, media_dir: str) -> int:
+    """Отправка через заглушку своего сервера Bot API с local_mode и без; код возврата 1 при расхождении"""
+    os.makedirs(media_dir, exist_ok=True)
+    source = generate_media(profile, PROFILES[profile], media_dir)
+    size = os.path.getsize(source)
+    # spawn: процесс отправки импортирует main с нуля, с переменными окружения своего сервера
+    context = multiprocessing.get_context('spawn')
+    failures = 0
+
+    for local_mode in (False, True):
+        uploads = multiprocessing.Queue()
+        api_server, api_port = start_stub(_serve_upload_recorder, uploads)
+        api_url = f"http://127.0.0.1:{api_port}/bot"
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            # send_video_parts удаляет отправленное - отправляем ссылку на исходник
+            path = os.path.join(work_dir, os.path.basename(source))
+            os.link(source, path)
+            environ = dict(os.environ)
+            os.environ.update({'BOT_API_URL': api_url, 'BOT_API_LOCAL_MODE': '1' if local_mode else '0'})
+            os.environ.setdefault('TOKEN', '0:bench')
+            os.environ.setdefault('METRICS_PORT', '0')
+            try:
+                result_queue = context.Queue()
+                sender = context.Process(target=_send_through_bot_api, args=(path, result_queue))
+                sender.start()
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+            result = result_queue.get(timeout=600)
+            sender.join()
+
+        api_server.terminate()
+        api_server.join()
+        recorded = []
+        while not uploads.empty():
+            recorded.append(uploads.get())
+
+        checks = {
+            f"лимит {result['limit_mb']} MB": result['limit_mb'] == 1950,
+            f"{size / (1024 * 1024):.1f} MB без разделения": result['parts'] == 1 and result['sent'],
+            "один sendVideo": len(recorded) == 1,
+        }
+        if recorded:
+            if local_mode:
+                checks[f"путь {recorded[0]['video']}"] = recorded[0]['video'] == pathlib.Path(path).as_uri()
+                checks[f"тело {recorded[0]['bytes']} байт без файла"] = recorded[0]['bytes'] < size
+            else:
+                checks[f"файл в теле ({recorded[0]['bytes']} байт)"] = recorded[0]['bytes'] >= size
+
+        print(f"\n{'local_mode' if local_mode else 'загрузка файла'}:")
+        for name, ok in checks.items():
+            print(f"  {'✅' if ok else '❌'} {name}")
+            failures += not ok
+    return 1 if failures else 0
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def ffmpeg_version() -> str:
+    try:
+        return subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.split('\n')[0]
+    except OSError:
+        return "unknown"
+
+
+async def bench_suite(profiles: list, media_dir: str, output: str, split_mb: float):
+    from telegram import Bot
+
+    os.makedirs(media_dir, exist_ok=True)
+    sources = {profile: generate_media(profile, PROFILES[profile], media_dir) for profile in profiles}
+
+    file_server, file_port = start_stub(_serve_files, media_dir)
+    api_server, api_port = start_stub(_serve_bot_api)
+    exclude = {file_server.pid, api_server.pid}
+    bot = Bot("0:bench", base_url=f"http://127.0.0.1:{api_port}/bot")
+
+    report = {
+        'revision': git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'platform': platform.platform(), 'cpus': os.cpu_count(), 'python': platform.python_version(),
+                 'ffmpeg': ffmpeg_version()},
+        'settings': {'split_mb': split_mb, 'transcode_mode': main.TRANSCODE_MODE,
+                     'parallel_jobs': main.PARALLEL_TRANSCODE_JOBS},
+        'profiles': {profile: PROFILES[profile] for profile in profiles},
+        'results': []
+    }
+    try:
+        async with bot:
+            with tempfile.TemporaryDirectory() as work_dir:
+                for profile in profiles:
+                    print(f"\n📹 {profile}: {os.path.getsize(sources[profile]) / (1024 * 1024):.1f} MB")
+                    report['results'].extend(await bench_profile(
+                        profile, sources[profile], work_dir, f"http://127.0.0.1:{file_port}", bot, split_mb, exclude
+                    ))
+    finally:
+        for process in (file_server, api_server):
+            process.terminate()
+            process.join()
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Результаты сохранены: {output} (ревизия {report['revision']})")
+
+
+def compare_results(before_path: str, after_path: str, threshold: float) -> int:
+    """Сравнивает время этапов двух прогонов; код возврата 1, если есть замедление больше порога"""
+    with open(before_path, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(after_path, encoding='utf-8') as f:
+        after = json.load(f)
+
+    baseline = {(r['profile'], r['stage']): r for r in before['results'] if not r['error']}
+    print(f"{before['revision']} → {after['revision']}\n")
+    regressions = 0
+    for result in after['results']:
+        old = baseline.get((result['profile'], result['stage']))
+        if old is None or result['error'] or not old['wall_s']:
+            continue
+        change = (result['wall_s'] / old['wall_s'] - 1) * 100
+        mark = ""
+        if change > threshold:
+            mark = " ⚠️ медленнее"
+            regressions += 1
+        elif change < -threshold:
+            mark = " 🚀 быстрее"
+        print(f"{result['profile']:<18} {result['stage']:<10} {old['wall_s']:7.2f}s → {result['wall_s']:7.2f}s "
+              f"({change:+.1f}%)  rss {old['peak_rss_mb']} → {result['peak_rss_mb']} MB{mark}")
+    return 1 if regressions else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарки обработки видео")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    transcode = commands.add_parser('transcode', help="обычное vs параллельное кодирование")
+    transcode.add_argument('path', help="исходное видео")
+    transcode.add_argument('--runs', type=int, default=3, help="число прогонов каждого режима")
+
+    suite = commands.add_parser('suite', help="этапы обработки на синтетических видео с заглушками")
+    suite.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=list(PROFILES),
+                       help="профили синтетических видео")
+    suite.add_argument('--media-dir', default=os.path.join(tempfile.gettempdir(), "bench_media"),
+                       help="папка для сгенерированных видео (переиспользуются между прогонами)")
+    suite.add_argument('--split-mb', type=float, default=20, help="размер части при разделении")
+    suite.add_argument('--output', default=None, help="JSON с результатами (по умолчанию bench-<ревизия>.json)")
+
+    compare = commands.add_parser('compare', help="сравнение двух JSON с результатами")
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.add_argument('--threshold', type=float, default=10, help="порог изменения времени, %%")
+
+    botapi = commands.add_parser('botapi', help="отправка через заглушку своего сервера Bot API")
+    botapi.add_argument('--profile', choices=sorted(PROFILES), default='high-bitrate-720p',
+                        help="синтетическое видео больше облачного лимита")
+    botapi.add_argument('--media-dir', default=os.path.join(tempfile.gettempdir(), "bench_media"),
+                        help="папка для сгенерированных видео")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == 'transcode':
+        asyncio.run(bench_transcode(args.path, args.runs))
+    elif args.command == 'suite':
+        asyncio.run(bench_suite(args.profiles, args.media_dir, args.output or f"bench-{git_revision()}.json",
+                                args.split_mb))
+    elif args.command == 'compare':
+        sys.exit(compare_results(args.before, args.after, args.threshold))
+    elif args.command == 'botapi':
+        sys.exit(check_bot_api(args.profile, args.media_dir))
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест бота: сотни одновременных пользователей на одной машине.
+
+Настоящее приложение (build_application, те же обработчики и планировщик) получает синтетические
+Update через update_queue - так же, как при опросе Telegram. Исходящие запросы уходят в заглушку
+Bot API, которая записывает, когда и что пользователь увидел; видео бот скачивает с локального
+файлового сервера (синтетические ролики из bench.py).
+
+Каждый пользователь проходит сценарий: ссылка -> кнопка качества -> «Отправить» (для больших
+файлов - разделение или оптимизация) -> видео. Пользователи приходят пуассоновским потоком,
+интенсивность растет ступенями:
+    python loadtest.py --rates 0.5 1 2 4 --step 60 --mix short-720p:best=3 low-360p:fit=1 broken=0.2
+
+С --webhook обновления приходят POST-запросами на HTTP-сервер вебхука с секретным токеном,
+как от Telegram в режиме BOT_MODE=webhook.
+
+Для каждой ступени выводятся p50/p95/p99 времени до первого ответа и до видео и доля ошибок.
+"""
+import os
+import math
+import re
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import platform
+import threading
+import multiprocessing
+from collections import Counter
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer
+
+# Бот под нагрузкой работает в своей папке и не трогает рабочие данные и порты.
+# Папку создает только запущенный скрипт: процессы пула yt-dlp (spawn) заново импортируют
+# этот модуль как __mp_main__ и получают ее через унаследованное окружение
+OWNS_WORK_DIR = 'LOADTEST_DIR' not in os.environ
+if OWNS_WORK_DIR:
+    os.environ['LOADTEST_DIR'] = tempfile.mkdtemp(prefix="loadtest_")
+WORK_DIR = os.environ['LOADTEST_DIR']
+os.environ.setdefault('DOWNLOADS_DIR', os.path.join(WORK_DIR, "downloads"))
+os.environ.setdefault('SAVED_DIR', os.path.join(WORK_DIR, "saved"))
+os.environ.setdefault('DOWNLOAD_CACHE_DIR', os.path.join(WORK_DIR, "cache"))
+os.environ.setdefault('METRICS_PORT', '0')
+
+import httpx
+
+import main
+import bench
+
+# Домен, который проходит проверку поддерживаемых платформ (ссылка все равно ведет на локальный сервер)
+PLATFORM_DOMAIN = 'vk.com'
+# Профиль ссылки на несуществующее видео: проверяет путь ошибки скачивания
+BROKEN_PROFILE = 'broken'
+
+MESSAGE_METHODS = ('sendMessage', 'editMessageText', 'sendVideo', 'sendDocument', 'sendAudio')
+VIDEO_METHODS = ('sendVideo', 'sendDocument', 'sendAudio')
+# Ответы бота, после которых сценарий пользователя не может продолжиться
+ERROR_PREFIXES = ("❌", "💽")
+
+_MULTIPART_FIELD = re.compile(rb'Content-Disposition: form-data; name="([^"]+)"\r\n\r\n(.*?)\r\n--', re.S)
+
+
+def parse_fields(content_type: str, body: bytes) -> dict:
+    """Поля запроса к Bot API (без содержимого файлов)"""
+    if content_type.startswith('multipart/form-data'):
+        return {name.decode(): value.decode('utf-8', 'replace') for name, value in _MULTIPART_FIELD.findall(body)}
+    if content_type.startswith('application/json'):
+        return {key: value if isinstance(value, str) else json.dumps(value)
+                for key, value in json.loads(body or b'{}').items()}
+    return {key: values[0] for key, values in parse_qs(body.decode('utf-8', 'replace')).items()}
+
+
+class _RecordingBotApi(bench._BotApiStub):
+    """Заглушка Bot API, которая сообщает тесту о каждом сообщении пользователю"""
+    events = None
+
+    def do_POST(self):
+        fields = parse_fields(self.headers.get('Content-Type', ''), self.read_body())
+        received = time.time()
+        method = self.path.rsplit('/', 1)[-1]
+        chat_id = int(fields['chat_id']) if fields.get('chat_id', '').lstrip('-').isdigit() else 0
+
+        if method == 'getMe':
+            self.send_result({'id': 1, 'is_bot': True, 'first_name': 'load', 'username': 'load_bot'})
+            return
+        if method not in MESSAGE_METHODS:
+            self.send_result(True)
+            return
+
+        if method == 'editMessageText':
+            message_id = int(fields.get('message_id') or 0)
+        else:
+            message_id = next(self.message_ids)
+        text = fields.get('text') or fields.get('caption') or ""
+        markup = json.loads(fields['reply_markup']) if fields.get('reply_markup') else {}
+        buttons = [button['callback_data'] for row in markup.get('inline_keyboard', [])
+                   for button in row if 'callback_data' in button]
+
+        result = {
+            'message_id': message_id, 'date': int(received),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'load'},
+            'text': text
+        }
+        if method in VIDEO_METHODS:
+            result['video'] = {'file_id': f"video{message_id}", 'file_unique_id': f"u{message_id}",
+                               'width': 1280, 'height': 720, 'duration': 1}
+            result['document'] = {'file_id': f"doc{message_id}", 'file_unique_id': f"d{message_id}"}
+        self.send_result(result)
+        self.events.put({'time': received, 'method': method, 'chat_id': chat_id, 'message_id': message_id,
+                         'text': text, 'buttons': buttons})
+
+
+def _serve_recording_bot_api(events, port_queue):
+    _RecordingBotApi.events = events
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _RecordingBotApi)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+class Inbox:
+    """Раскладывает события заглушки по пользователям (очередь на каждый чат)"""
+
+    def __init__(self, events, loop):
+        self.events = events
+        self.loop = loop
+        self.chats = {}
+        self.thread = threading.Thread(target=self._pump, daemon=True)
+        self.thread.start()
+
+    def _pump(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            self.loop.call_soon_threadsafe(self._deliver, event)
+
+    def _deliver(self, event):
+        queue = self.chats.get(event['chat_id'])
+        if queue is not None:
+            queue.put_nowait(event)
+
+    def open(self, chat_id: int) -> asyncio.Queue:
+        self.chats[chat_id] = asyncio.Queue()
+        return self.chats[chat_id]
+
+    def close(self, chat_id: int):
+        self.chats.pop(chat_id, None)
+
+    def stop(self):
+        self.events.put(None)
+        self.thread.join()
+
+
+class LinkMix:
+    """
+    Смесь ссылок 'профиль[:качество][=вес]': профиль - синтетическое видео из bench.PROFILES
+    или 'broken' (ссылка на несуществующий файл), качество - кнопка, которую нажимает пользователь.
+    """
+
+    def __init__(self, specs: list):
+        self.entries = []
+        for spec in specs:
+            spec, _, weight = spec.partition('=')
+            profile, _, quality = spec.partition(':')
+            if profile != BROKEN_PROFILE and profile not in bench.PROFILES:
+                raise SystemExit(f"❌ Неизвестный профиль: {profile}")
+            self.entries.append((profile, quality or 'best', float(weight or 1)))
+
+    @property
+    def profiles(self) -> set:
+        return {profile for profile, _, _ in self.entries if profile != BROKEN_PROFILE}
+
+    def pick(self, rng: random.Random) -> tuple:
+        profile, quality, _ = rng.choices(self.entries, weights=[entry[2] for entry in self.entries])[0]
+        return profile, quality
+
+
+def percentile(values: list, q: float):
+    """Перцентиль по ближайшему рангу; None для пустой выборки"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * q / 100) - 1)]
+
+
+class LoadRunner:
+    def __init__(self, application, inbox: Inbox, links: dict, timeout: float, large_action: str,
+                 unique_links: bool, webhook: main.WebhookServer = None):
+        self.application = application
+        self.webhook = webhook
+        self.http = httpx.AsyncClient(timeout=30) if webhook else None
+        self.inbox = inbox
+        self.links = links
+        self.timeout = timeout
+        self.large_action = large_action
+        self.unique_links = unique_links
+        self.update_ids = iter(range(1, 10 ** 9))
+        self.user_ids = iter(range(100000, 10 ** 9))
+        self.bot_user = {'id': 1, 'is_bot': True, 'first_name': 'load'}
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': 'load', 'username': f"load{user_id}"}
+
+    async def _submit(self, update: dict):
+        """Доставляет обновление боту: POST на вебхук или сразу в очередь приложения (как опрос)"""
+        if self.webhook is None:
+            await self.application.update_queue.put(main.Update.de_json(update, self.application.bot))
+            return
+        response = await self.http.post(
+            f"http://127.0.0.1:{self.webhook.port}{self.webhook.path}", json=update,
+            headers={'X-Telegram-Bot-Api-Secret-Token': self.webhook.secret_token.decode()}
+        )
+        response.raise_for_status()
+
+    async def _send_text(self, user_id: int, text: str):
+        await self._submit({
+            'update_id': next(self.update_ids),
+            'message': {
+                'message_id': next(self.update_ids), 'date': int(time.time()), 'text': text,
+                'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id)
+            }
+        })
+
+    async def _press(self, user_id: int, event: dict, data: str):
+        await self._submit({
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)), 'chat_instance': str(user_id), 'data': data,
+                'from': self._user(user_id),
+                'message': {
+                    'message_id': event['message_id'], 'date': int(event['time']), 'text': event['text'],
+                    'chat': {'id': user_id, 'type': 'private'}, 'from': self.bot_user
+                }
+            }
+        })
+
+    def _choose(self, buttons: list, quality: str, pressed: set):
+        """Кнопка, которую нажмет пользователь: выбранное качество (или лучшее), затем отправка файла"""
+        actions = {data.partition(':')[0]: data for data in buttons}
+        choices = ("action_send", self.large_action)
+        if not any(data.startswith("quality_") for data in pressed):
+            choices = (f"quality_{quality}", "quality_best") + choices
+        for action in choices:
+            if actions.get(action) and actions[action] not in pressed:
+                return actions[action]
+        return None
+
+    async def simulate_user(self, profile: str, quality: str) -> dict:
+        user_id = next(self.user_ids)
+        url = self.links[profile]
+        if self.unique_links:
+            url += f"?u={user_id}"
+        result = {'profile': profile, 'quality': quality, 'ttfr': None, 'ttv': None, 'error': None}
+        inbox = self.inbox.open(user_id)
+        pressed = set()
+        started = time.time()
+        try:
+            await self._send_text(user_id, url)
+            while True:
+                remaining = started + self.timeout - time.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                event = await asyncio.wait_for(inbox.get(), remaining)
+                if result['ttfr'] is None:
+                    result['ttfr'] = event['time'] - started
+                if event['method'] in VIDEO_METHODS:
+                    result['ttv'] = event['time'] - started
+                    return result
+                if event['text'].startswith(ERROR_PREFIXES):
+                    result['error'] = event['text'].splitlines()[0]
+                    return result
+                data = self._choose(event['buttons'], quality, pressed)
+                if data:
+                    pressed.add(data)
+                    await self._press(user_id, event, data)
+        except asyncio.TimeoutError:
+            result['error'] = "таймаут"
+            return result
+        except httpx.HTTPError as e:
+            result['error'] = f"вебхук: {e}"
+            return result
+        finally:
+            self.inbox.close(user_id)
+
+    async def run_step(self, rate: float, duration: float, mix: LinkMix, rng: random.Random) -> dict:
+        """Пуассоновский поток пользователей с интенсивностью rate в течение duration секунд"""
+        users = []
+        started = time.time()
+        while True:
+            await asyncio.sleep(rng.expovariate(rate))
+            if time.time() - started >= duration:
+                break
+            users.append(asyncio.create_task(self.simulate_user(*mix.pick(rng))))
+        arrived = time.time() - started
+        results = await asyncio.gather(*users)
+        return summarize(rate, arrived, time.time() - started, results)
+
+
+def summarize(rate: float, arrived: float, elapsed: float, results: list) -> dict:
+    ttfr = [r['ttfr'] for r in results if r['ttfr'] is not None]
+    ttv = [r['ttv'] for r in results if r['ttv'] is not None]
+    errors = Counter(r['error'] for r in results if r['error'])
+    return {
+        'rate': rate,
+        'users': len(results),
+        'achieved_rate': round(len(results) / arrived, 3) if arrived else 0,
+        'elapsed_s': round(elapsed, 1),
+        'videos': len(ttv),
+        'error_rate': round(sum(errors.values()) / len(results), 4) if results else 0,
+        'errors': dict(errors),
+        'ttfr_s': {f"p{q}": percentile(ttfr, q) for q in (50, 95, 99)},
+        'ttv_s': {f"p{q}": percentile(ttv, q) for q in (50, 95, 99)},
+        'by_profile': {
+            profile: {
+                'users': sum(1 for r in results if r['profile'] == profile),
+                'ttv_p95_s': percentile([r['ttv'] for r in results if r['profile'] == profile and r['ttv']], 95)
+            } for profile in sorted({r['profile'] for r in results})
+        }
+    }
+
+
+def _fmt(value) -> str:
+    return f"{value:7.2f}" if value is not None else "      -"
+
+
+def print_step(step: dict):
+    print(f"{step['rate']:>6.2f}/s {step['users']:>5} "
+          f"{_fmt(step['ttfr_s']['p50'])} {_fmt(step['ttfr_s']['p95'])} {_fmt(step['ttfr_s']['p99'])}  "
+          f"{_fmt(step['ttv_s']['p50'])} {_fmt(step['ttv_s']['p95'])} {_fmt(step['ttv_s']['p99'])}  "
+          f"{step['error_rate'] * 100:6.1f}%")
+    for error, count in step['errors'].items():
+        print(f"{'':>15}{count:>5} × {error}")
+
+
+async def run_load(rates: list, step: float, mix: LinkMix, media_dir: str, timeout: float, large_action: str,
+                   unique_links: bool, stop_error_rate: float, seed: int, webhook: bool, output: str):
+    os.makedirs(media_dir, exist_ok=True)
+    # Ссылки должны проходить проверку платформы: раздаем видео из подпапки с именем домена
+    links_dir = os.path.join(WORK_DIR, "links")
+    os.makedirs(os.path.join(links_dir, PLATFORM_DOMAIN))
+    for profile in mix.profiles:
+        os.symlink(bench.generate_media(profile, bench.PROFILES[profile], media_dir),
+                   os.path.join(links_dir, PLATFORM_DOMAIN, f"{profile}.mp4"))
+
+    events = multiprocessing.Queue()
+    file_server, file_port = bench.start_stub(bench._serve_files, links_dir)
+    api_server, api_port = bench.start_stub(_serve_recording_bot_api, events)
+    links = {profile: f"http://127.0.0.1:{file_port}/{PLATFORM_DOMAIN}/{profile}.mp4"
+             for profile in mix.profiles | {BROKEN_PROFILE}}
+
+    application = main.build_application(
+        main.Application.builder().token("0:load").base_url(f"http://127.0.0.1:{api_port}/bot")
+    )
+    inbox = Inbox(events, asyncio.get_running_loop())
+    server = main.WebhookServer(application, main.WEBHOOK_PATH, main.WEBHOOK_SECRET) if webhook else None
+    runner = LoadRunner(application, inbox, links, timeout, large_action, unique_links, server)
+
+    report = {
+        'revision': bench.git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'platform': platform.platform(), 'cpus': os.cpu_count(), 'python': platform.python_version()},
+        'settings': {'step_s': step, 'mix': [list(entry) for entry in mix.entries], 'timeout_s': timeout,
+                     'unique_links': unique_links, 'seed': seed, 'updates': 'webhook' if webhook else 'queue',
+                     'pools': {name: [pool.workers, pool.max_queue] for name, pool in main.scheduler.pools.items()}},
+        'steps': []
+    }
+    rng = random.Random(seed)
+    try:
+        await application.initialize()
+        await application.post_init(application)
+        if server is not None:
+            await server.start('127.0.0.1', 0)
+        await application.start()
+        print(f"\n{'нагрузка':>8} {'польз':>5} {'TTFR p50':>7} {'p95':>7} {'p99':>7}  "
+              f"{'видео p50':>7} {'p95':>7} {'p99':>7}  {'ошибки':>7}")
+        for rate in rates:
+            result = await runner.run_step(rate, step, mix, rng)
+            report['steps'].append(result)
+            print_step(result)
+            if result['error_rate'] > stop_error_rate:
+                print(f"🛑 Доля ошибок больше {stop_error_rate * 100:.0f}%, дальше нагрузку не увеличиваем")
+                break
+    finally:
+        if server is not None:
+            await server.stop()
+            await runner.http.aclose()
+        if application.running:
+            await application.stop()
+            await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+        main.download_backend.close()
+        inbox.stop()
+        for process in (file_server, api_server):
+            process.terminate()
+            process.join()
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Результаты сохранены: {output} (ревизия {report['revision']})")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушками Telegram и платформы")
+    parser.add_argument('--rates', nargs='+', type=float, default=[0.5, 1, 2, 4],
+                        help="ступени интенсивности, новых пользователей в секунду")
+    parser.add_argument('--step', type=float, default=60, help="длительность каждой ступени, секунд")
+    parser.add_argument('--mix', nargs='+', default=['short-720p:best=3', 'low-360p:fit=1'],
+                        help="смесь ссылок 'профиль[:качество][=вес]'; профиль 'broken' - битая ссылка")
+    parser.add_argument('--timeout', type=float, default=600, help="сколько пользователь ждет видео, секунд")
+    parser.add_argument('--large-action', choices=('split', 'optimize'), default='split',
+                        help="что выбирает пользователь, если файл больше лимита отправки")
+    parser.add_argument('--shared-links', action='store_true',
+                        help="одинаковые ссылки у всех пользователей (работает кэш скачиваний)")
+    parser.add_argument('--stop-error-rate', type=float, default=0.5,
+                        help="остановиться, если доля ошибок на ступени больше этой")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--webhook', action='store_true',
+                        help="доставлять обновления через HTTP-сервер вебхука, а не прямо в очередь приложения")
+    parser.add_argument('--media-dir', default=os.path.join(tempfile.gettempdir(), "bench_media"),
+                        help="папка для сгенерированных видео (общая с bench.py)")
+    parser.add_argument('--output', default=None, help="JSON с результатами (по умолчанию load-<ревизия>.json)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        asyncio.run(run_load(
+            args.rates, args.step, LinkMix(args.mix), args.media_dir, args.timeout, args.large_action,
+            not args.shared_links, args.stop_error_rate, args.seed, args.webhook,
+            args.output or f"load-{bench.git_revision()}.json"
+        ))
+    finally:
+        if OWNS_WORK_DIR:
+            shutil.rmtree(WORK_DIR, ignore_errors=True)
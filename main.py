@@ -5,10 +5,36 @@ import subprocess
 import shutil
 import asyncio
 import time
-import math
 import json
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+import collections
+import hashlib
+import math
+import hmac
+import signal
+import urllib.parse
+import bisect
+import heapq
+import struct
+import itertools
+import functools
+import threading
+import multiprocessing
+import concurrent.futures
+import tempfile
+import contextlib
+import contextvars
+import sqlite3
+import httpx
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, InputFile
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import (Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler,
+                          CallbackContext, BaseRateLimiter)
+
+try:
+    import yt_dlp
+except ImportError:
+    # Необязательная зависимость: нужна только для DOWNLOAD_BACKEND=api
+    yt_dlp = None
 
 #хранение токенов
 from dotenv import load_dotenv
@@ -19,6 +45,13 @@ admin_id = os.getenv('ADMIN_ID')
 #Настройки
 BOT_TOKEN = token
 
+# Свой сервер Bot API (telegram-bot-api), например http://localhost:8081/bot; пусто - облачный API.
+# Через него бот отправляет файлы до 2000 MB целиком, без разделения и пережатия
+BOT_API_URL = os.getenv('BOT_API_URL', '')
+BOT_API_FILE_URL = os.getenv('BOT_API_FILE_URL', BOT_API_URL.removesuffix('/bot') + '/file/bot')
+# Сервер запущен с --local и видит ту же файловую систему: файлы передаются путем, без загрузки
+BOT_API_LOCAL_MODE = os.getenv('BOT_API_LOCAL_MODE', '0') == '1'
+
 # Настройка логирования
 # logging.basicConfig(
 #     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -26,8 +59,524 @@ BOT_TOKEN = token
 # )
 logger = logging.getLogger(__name__)
 
-# Временное хранилище для данных пользователей
-user_data = {}
+# Папка для скачанных файлов пользователей
+DOWNLOADS_DIR = os.getenv('DOWNLOADS_DIR', "/home/taras/video_downloads")
+# Папка, куда пользователи сохраняют видео на сервере
+SAVED_DIR = os.getenv('SAVED_DIR', "/home/torrent/download/youtube")
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def _format_labels(key: tuple, **extra) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """
+    Метрика в формате Prometheus: значения по наборам меток.
+    collect - функция, которая при каждом чтении возвращает {кортеж меток: значение}
+    для величин, которые уже считаются в других объектах
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, collect=None):
+        self.name = name
+        self.help = help_text
+        self.collect = collect
+        self.values = {}
+
+    def samples(self) -> list:
+        values = dict(self.values)
+        if self.collect is not None:
+            values.update(self.collect())
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in values.items()]
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+
+class CounterMetric(Metric):
+    kind = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class GaugeMetric(CounterMetric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.values[_label_key(labels)] = value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+
+class HistogramMetric(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: tuple):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        state = self.values.setdefault(key, {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0})
+        state['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+        state['sum'] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Измеряет длительность блока (в том числе с await внутри)"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self) -> list:
+        lines = []
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), state['buckets']):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {state['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Встроенный реестр метрик и HTTP-сервер с /metrics для Prometheus"""
+
+    def __init__(self):
+        self.metrics = []
+        self._server = None
+
+    def _register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, collect=None) -> CounterMetric:
+        return self._register(CounterMetric(name, help_text, collect))
+
+    def gauge(self, name: str, help_text: str, collect=None) -> GaugeMetric:
+        return self._register(GaugeMetric(name, help_text, collect))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple) -> HistogramMetric:
+        return self._register(HistogramMetric(name, help_text, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Ошибка чтения метрики {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass  # Заголовки запроса не нужны
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+metrics = MetricsRegistry()
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Порт HTTP-сервера метрик; 0 - не запускать
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+stage_seconds = metrics.histogram(
+    'bot_stage_duration_seconds',
+    "Длительность этапов обработки (download, stream, probe, optimize, split, thumbnail, upload)",
+    DURATION_BUCKETS
+)
+bytes_total = metrics.counter('bot_bytes_total', "Байты, скачанные с платформ (in) и отправленные в Telegram (out)")
+compression_ratios = metrics.histogram(
+    'bot_compression_ratio', "Отношение размера после оптимизации к исходному",
+    (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+)
+downloads_total = metrics.counter('bot_downloads_total', "Скачивания по платформам и результату (ok/error)")
+subprocesses_active = metrics.gauge('bot_subprocesses_active', "Запущенные внешние процессы (ffmpeg, ffprobe, yt-dlp)")
+cache_lookups_total = metrics.counter('bot_cache_lookups_total', "Обращения к кэшам по результату (hit/miss)")
+
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """Отрезок трассы: этап, внешний процесс или запрос к Bot API"""
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'start', 'duration', 'status', 'attrs')
+
+    def __init__(self, trace, span_id: int, parent_id, name: str, attrs: dict):
+        self.trace = trace
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.monotonic()
+        self.duration = None
+        self.status = 'ok'
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'start': round(self.start - self.trace.start, 4),
+            'duration': round(self.duration, 4) if self.duration is not None else None,
+            'status': self.status,
+            'attrs': self.attrs
+        }
+
+
+class _NoSpan:
+    """Заглушка вне трассы: атрибуты никуда не пишутся"""
+
+    def set(self, **attrs):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """Трасса одного прохода задачи (скачивание или действие с файлом) - дерево отрезков"""
+
+    def __init__(self, job_id, user_id, name: str):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.monotonic()
+        self.spans = []
+        self.dropped = 0
+        self._ids = itertools.count(1)
+
+    def summary(self) -> dict:
+        root = self.spans[0]
+        return {
+            'job_id': self.job_id,
+            'user_id': self.user_id,
+            'name': self.name,
+            'started_at': round(self.started_at, 3),
+            'duration': round(root.duration, 4),
+            'status': root.status,
+            'dropped_spans': self.dropped,
+            'spans': [span.to_dict() for span in self.spans]
+        }
+
+
+class Tracer:
+    """
+    Трассировка задач: вложенные отрезки для этапов, внешних процессов и запросов к Bot API.
+    Текущий отрезок передается через contextvars, поэтому дочерние задачи asyncio и
+    asyncio.to_thread наследуют трассу. Завершенная трасса дописывается в файл:
+    JSON Lines (одна трасса на строку) или события Chrome trace (chrome://tracing, Perfetto).
+    Последние трассы хранятся в памяти для команды /slow.
+    """
+
+    def __init__(self, path: str, fmt: str = 'jsonl', keep: int = 200, max_spans: int = 2000,
+                 max_bytes: int = 50 * 1024 * 1024):
+        self.path = path
+        self.format = fmt
+        self.max_spans = max_spans
+        self.max_bytes = max_bytes
+        self.recent = collections.deque(maxlen=keep)
+
+    @contextlib.contextmanager
+    def job(self, job_id, user_id, name: str, **attrs):
+        """Корневой отрезок задачи; внутри уже открытой трассы - обычный вложенный отрезок"""
+        if _current_span.get() is not None:
+            with self.span(name, job_id=job_id, **attrs) as span:
+                yield span
+            return
+
+        trace = Trace(job_id, user_id, name)
+        try:
+            with self._open(trace, None, name, attrs) as span:
+                yield span
+        finally:
+            self._finish(trace)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs):
+        """Вложенный отрезок текущей трассы; вне трассы ничего не записывает"""
+        parent = _current_span.get()
+        if parent is None:
+            yield NO_SPAN
+            return
+        with self._open(parent.trace, parent.span_id, name, attrs) as span:
+            yield span
+
+    @staticmethod
+    def current():
+        return _current_span.get() or NO_SPAN
+
+    @contextlib.contextmanager
+    def _open(self, trace: Trace, parent_id, name: str, attrs: dict):
+        if len(trace.spans) >= self.max_spans:
+            trace.dropped += 1
+            yield NO_SPAN
+            return
+
+        span = Span(trace, next(trace._ids), parent_id, name, attrs)
+        trace.spans.append(span)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            span.status = 'cancelled'
+            raise
+        except BaseException as e:
+            span.status = 'error'
+            span.attrs['error'] = f"{type(e).__name__}: {e}"[:300]
+            raise
+        finally:
+            span.duration = time.monotonic() - span.start
+            _current_span.reset(token)
+
+    def _finish(self, trace: Trace):
+        summary = trace.summary()
+        self.recent.append(summary)
+        if not self.path:
+            return
+        try:
+            self._write(summary)
+        except OSError as e:
+            logger.error(f"Не удалось записать трассу: {e}")
+
+    def _write(self, summary: dict):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, f"{self.path}.1")
+
+        if self.format != 'chrome':
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+            return
+
+        # Формат Chrome trace допускает незакрытый массив событий, поэтому файл только дописывается
+        new_file = not os.path.exists(self.path)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            if new_file:
+                f.write("[\n")
+            for span in summary['spans']:
+                event = {
+                    'name': span['name'],
+                    'ph': 'X',
+                    'ts': int((summary['started_at'] + span['start']) * 1_000_000),
+                    'dur': int((span['duration'] or 0) * 1_000_000),
+                    'pid': summary['job_id'],
+                    'tid': summary['name'],
+                    'args': dict(span['attrs'], status=span['status'])
+                }
+                f.write(json.dumps(event, ensure_ascii=False) + ",\n")
+
+    def slowest(self, limit: int = 10) -> list:
+        return sorted(self.recent, key=lambda trace: trace['duration'], reverse=True)[:limit]
+
+
+tracer = Tracer(
+    os.getenv('TRACE_FILE', os.path.join(DOWNLOADS_DIR, 'traces.jsonl')),
+    fmt=os.getenv('TRACE_FORMAT', 'jsonl')
+)
+
+
+async def traced(job_id, user_id, name: str, coro, **attrs):
+    """Выполняет корутину задачи внутри ее трассы"""
+    with tracer.job(job_id, user_id, name, **attrs):
+        return await coro
+
+
+def timed(stage: str):
+    """Декоратор: длительность асинхронной функции попадает в гистограмму этапа и в трассу задачи"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with stage_seconds.time(stage=stage), tracer.span(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def platform_label(url: str) -> str:
+    """Домен платформы для меток метрик"""
+    return next((domain for domain in SUPPORTED_PLATFORMS if domain in url), 'other')
+
+
+class JobStore:
+    """
+    Сессии и задачи пользователей в SQLite (режим WAL), переживают перезапуск бота.
+    Задача - одна ссылка: состояние, данные в JSON и срок жизни, который
+    продлевается при каждом обновлении.
+    Состояния: quality_selection -> queued -> downloading -> downloaded -> sending
+    """
+
+    # Задачи в этих состояниях прерываются остановкой бота
+    INTERRUPTIBLE_STATES = ('queued', 'downloading', 'sending')
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._db = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, isolation_level=None)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "user_id INTEGER NOT NULL, "
+                "state TEXT NOT NULL, "
+                "data TEXT NOT NULL, "
+                "created REAL NOT NULL, "
+                "expires REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, job_id)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_expires ON jobs (expires)")
+        return self._db
+
+    @staticmethod
+    def _to_job(row) -> dict:
+        job = json.loads(row['data'])
+        job.update(job_id=row['job_id'], user_id=row['user_id'], state=row['state'], expires=row['expires'])
+        return job
+
+    def create(self, user_id: int, state: str, **data) -> int:
+        """Создает задачу и возвращает ее job_id; заодно удаляет просроченные"""
+        self.remove_expired()
+        now = time.time()
+        cursor = self.db.execute(
+            "INSERT INTO jobs (user_id, state, data, created, expires) VALUES (?, ?, ?, ?, ?)",
+            (user_id, state, json.dumps(data), now, now + self.ttl)
+        )
+        return cursor.lastrowid
+
+    def get(self, job_id: int):
+        row = self.db.execute(
+            "SELECT * FROM jobs WHERE job_id = ? AND expires > ?", (job_id, time.time())
+        ).fetchone()
+        return self._to_job(row) if row else None
+
+    def update(self, job_id: int, state: str = None, **data) -> bool:
+        """Обновляет состояние и поля задачи и продлевает срок жизни. False - задачи уже нет"""
+        row = self.db.execute("SELECT state, data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return False
+        merged = json.loads(row['data'])
+        merged.update(data)
+        self.db.execute(
+            "UPDATE jobs SET state = ?, data = ?, expires = ? WHERE job_id = ?",
+            (state or row['state'], json.dumps(merged), time.time() + self.ttl, job_id)
+        )
+        return True
+
+    def claim(self, job_id: int, expected: str, state: str) -> bool:
+        """
+        Переводит задачу из состояния expected в state одним запросом, без await между проверкой
+        и записью. False - задача уже в другом состоянии (повторное нажатие) или ее нет
+        """
+        cursor = self.db.execute(
+            "UPDATE jobs SET state = ?, expires = ? WHERE job_id = ? AND state = ?",
+            (state, time.time() + self.ttl, job_id, expected)
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, job_id: int):
+        self.db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def all(self) -> list:
+        return [self._to_job(row) for row in self.db.execute("SELECT * FROM jobs ORDER BY job_id")]
+
+    def remove_expired(self) -> list:
+        """Удаляет просроченные задачи вместе с их файлами в папке скачиваний"""
+        rows = self.db.execute("SELECT * FROM jobs WHERE expires <= ?", (time.time(),)).fetchall()
+        expired = [self._to_job(row) for row in rows]
+        self.db.executemany("DELETE FROM jobs WHERE job_id = ?", [(job['job_id'],) for job in expired])
+        for job in expired:
+            remove_job_file(job)
+        return expired
+
+
+def remove_job_file(job: dict):
+    """Удаляет файл задачи, если он еще лежит во временной папке (сохраненные пользователем не трогаем)"""
+    file_path = job.get('file_path')
+    if not file_path or not os.path.abspath(file_path).startswith(DOWNLOADS_DIR + os.sep):
+        return
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            logger.info(f"Удален файл задачи {job['job_id']}: {file_path}")
+    except OSError as e:
+        logger.error(f"Не удалось удалить файл задачи {job['job_id']}: {e}")
+
+
+# Задачи пользователей: SQLite рядом со скачанными файлами, срок жизни - час без активности
+job_store = JobStore(
+    os.getenv('JOB_DB_PATH', os.path.join(DOWNLOADS_DIR, "jobs.db")),
+    float(os.getenv('JOB_TTL', '3600'))
+)
+
+
+def job_callback(action: str, job_id: int) -> str:
+    """callback_data кнопки, относящейся к задаче: 'действие:job_id'"""
+    return f"{action}:{job_id}"
+
+
+def get_callback_job(query):
+    """Разбирает callback_data 'действие:job_id' -> (действие, задача); задача None, если устарела или чужая"""
+    action, _, job_id = query.data.partition(':')
+    job = job_store.get(int(job_id)) if job_id.isdigit() else None
+    if job is not None and job['user_id'] != query.from_user.id:
+        job = None
+    return action, job
 
 # Поддерживаемые платформы
 SUPPORTED_PLATFORMS = {
@@ -37,6 +586,753 @@ SUPPORTED_PLATFORMS = {
 }
 
 
+class ProcessResult:
+    """Результат выполнения внешней команды"""
+
+    def __init__(self, args, returncode: int, stdout: str, stderr: str):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+async def _pump_stream(stream, chunks: list, on_line=None):
+    """Читает поток процесса по кускам и отдает строки в обработчик"""
+    pending = b""
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if on_line is None:
+            continue
+
+        # ffmpeg и yt-dlp обновляют прогресс через \r, поэтому режем по обоим разделителям
+        pending += chunk.replace(b"\r", b"\n")
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line:
+                on_line(line.decode("utf-8", errors="replace"))
+
+    if on_line is not None and pending:
+        on_line(pending.decode("utf-8", errors="replace"))
+
+
+async def _kill_process(process):
+    """Принудительно завершает процесс и дожидается его"""
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+    await process.wait()
+
+
+async def run_process(cmd: list, timeout: float = None, on_stdout=None, on_stderr=None) -> ProcessResult:
+    """
+    Асинхронно выполняет внешнюю команду, не блокируя цикл событий:
+    - stdout/stderr читаются потоково и могут построчно передаваться в обработчики
+    - по таймауту процесс убивается и выбрасывается subprocess.TimeoutExpired
+    - при отмене задачи процесс тоже убивается
+    """
+    with tracer.span(f"process.{os.path.basename(cmd[0])}", args=" ".join(map(str, cmd[1:]))[:300]) as span:
+        result = await _run_process(cmd, timeout, on_stdout, on_stderr)
+        span.set(exit=result.returncode)
+        return result
+
+
+async def _run_process(cmd: list, timeout: float, on_stdout, on_stderr) -> ProcessResult:
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    subprocesses_active.inc()
+
+    stdout_chunks = []
+    stderr_chunks = []
+
+    async def communicate():
+        await asyncio.gather(
+            _pump_stream(process.stdout, stdout_chunks, on_stdout),
+            _pump_stream(process.stderr, stderr_chunks, on_stderr)
+        )
+        return await process.wait()
+
+    try:
+        returncode = await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        await _kill_process(process)
+        raise subprocess.TimeoutExpired(
+            cmd, timeout,
+            output=b"".join(stdout_chunks),
+            stderr=b"".join(stderr_chunks)
+        )
+    except asyncio.CancelledError:
+        await _kill_process(process)
+        raise
+    finally:
+        subprocesses_active.dec()
+
+    return ProcessResult(
+        cmd,
+        returncode,
+        b"".join(stdout_chunks).decode("utf-8", errors="replace"),
+        b"".join(stderr_chunks).decode("utf-8", errors="replace")
+    )
+
+
+class QueueFullError(Exception):
+    """Очередь этапа переполнена, задача отклонена"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Очередь этапа '{stage}' переполнена")
+        self.stage = stage
+
+
+class StagePool:
+    """
+    Пул исполнителей одного этапа: ограничение параллельности, очередь и счетчики задержек.
+    Очередь справедлива между владельцами (пользователями): освободившиеся слоты раздаются
+    по кругу, у одного владельца не больше owner_workers выполняемых и owner_queue ожидающих задач.
+    Задачи без владельца (owner=None) ограничены только общими лимитами.
+    """
+
+    def __init__(self, name: str, workers: int, max_queue: int, owner_workers: int = None,
+                 owner_queue: int = None):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.owner_workers = owner_workers or (self.workers + 1) // 2
+        self.owner_queue = owner_queue or max_queue
+        self.active = 0
+        self.queued = 0
+        self._active_by_owner = collections.Counter()
+        # Владелец -> очередь его ожидающих; порядок ключей задает очередность обхода по кругу
+        self._waiters = collections.OrderedDict()
+        self.stats = {
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+            'run_total': 0.0,
+            'run_max': 0.0
+        }
+
+    @property
+    def waiting_owners(self) -> int:
+        return len(self._waiters)
+
+    def _under_owner_limit(self, owner) -> bool:
+        return owner is None or self._active_by_owner[owner] < self.owner_workers
+
+    def _can_start(self, owner) -> bool:
+        # Свои ожидающие задачи владелец не обгоняет
+        return self.active < self.workers and self._under_owner_limit(owner) and not self._waiters.get(owner)
+
+    def is_full(self, owner=None) -> bool:
+        """Новая задача владельца будет отклонена"""
+        if self._can_start(owner):
+            return False
+        return self.queued >= self.max_queue or \
+            (owner is not None and len(self._waiters.get(owner, ())) >= self.owner_queue)
+
+    def next_position(self, owner=None) -> int:
+        """Позиция, которую займет новая задача (0 - начнет выполняться сразу)"""
+        if self._can_start(owner):
+            return 0
+        return self._position(owner, len(self._waiters.get(owner, ())))
+
+    def _position(self, owner, index: int) -> int:
+        # При обходе по кругу до index-й задачи владельца успеет не больше index + 1 задачи каждого другого
+        others = sum(min(len(waiters), index + 1) for key, waiters in self._waiters.items() if key != owner)
+        return others + index + 1
+
+    def _start(self, owner):
+        self.active += 1
+        if owner is not None:
+            self._active_by_owner[owner] += 1
+
+    def _release(self, owner):
+        self.active -= 1
+        if owner is not None:
+            self._active_by_owner[owner] -= 1
+            if self._active_by_owner[owner] <= 0:
+                del self._active_by_owner[owner]
+        self._dispatch()
+
+    def _dispatch(self):
+        """Отдает свободные слоты ожидающим по кругу, пропуская владельцев, упершихся в свой лимит"""
+        while self.active < self.workers:
+            for owner, waiters in self._waiters.items():
+                if self._under_owner_limit(owner):
+                    break
+            else:
+                return
+
+            waiter = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self._waiters.move_to_end(owner)
+            else:
+                del self._waiters[owner]
+
+            if not waiter.done():
+                self._start(owner)
+                waiter.set_result(True)
+
+    def _remove_waiter(self, owner, waiter) -> bool:
+        waiters = self._waiters.get(owner)
+        if not waiters or waiter not in waiters:
+            return False
+        waiters.remove(waiter)
+        self.queued -= 1
+        if not waiters:
+            del self._waiters[owner]
+        return True
+
+    async def run(self, job_factory, on_queued=None, owner=None):
+        """Выполняет задачу в пуле, при необходимости ожидая свободного слота"""
+        queued_at = time.monotonic()
+
+        if self._can_start(owner):
+            self._start(owner)
+        else:
+            if self.is_full(owner):
+                self.stats['rejected'] += 1
+                raise QueueFullError(self.name)
+
+            waiter = asyncio.get_running_loop().create_future()
+            waiters = self._waiters.setdefault(owner, collections.deque())
+            waiters.append(waiter)
+            self.queued += 1
+            try:
+                if on_queued is not None:
+                    try:
+                        await on_queued(self._position(owner, len(waiters) - 1))
+                    except Exception as e:
+                        logger.warning(f"Не удалось сообщить позицию в очереди: {e}")
+                await waiter
+            except asyncio.CancelledError:
+                if not self._remove_waiter(owner, waiter) and waiter.done() and not waiter.cancelled():
+                    self._release(owner)
+                raise
+
+        started_at = time.monotonic()
+        wait_time = started_at - queued_at
+        self.stats['wait_total'] += wait_time
+        self.stats['wait_max'] = max(self.stats['wait_max'], wait_time)
+
+        try:
+            with tracer.span(f"stage.{self.name}", wait=round(wait_time, 3)):
+                result = await job_factory()
+            self.stats['completed'] += 1
+            return result
+        except BaseException:
+            self.stats['failed'] += 1
+            raise
+        finally:
+            run_time = time.monotonic() - started_at
+            self.stats['run_total'] += run_time
+            self.stats['run_max'] = max(self.stats['run_max'], run_time)
+            self._release(owner)
+
+
+class JobScheduler:
+    """Планировщик задач с отдельными пулами для скачивания, перекодирования и отправки"""
+
+    def __init__(self, limits: dict, owner_workers: int = None, owner_queue: int = None):
+        self.pools = {
+            stage: StagePool(stage, workers, max_queue, owner_workers, owner_queue)
+            for stage, (workers, max_queue) in limits.items()
+        }
+        self._tasks = set()
+
+    async def run(self, stage: str, job_factory, on_queued=None, owner=None):
+        return await self.pools[stage].run(job_factory, on_queued, owner)
+
+    @property
+    def active_tasks(self) -> int:
+        return len(self._tasks)
+
+    def spawn(self, coro) -> asyncio.Task:
+        """Запускает фоновую задачу и хранит ссылку на нее до завершения"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Ждет завершения фоновых задач не дольше timeout секунд, оставшиеся отменяет.
+        Отмененные задачи остаются в хранилище и продолжаются после перезапуска (resume_jobs).
+        Возвращает число отмененных задач.
+        """
+        deadline = time.monotonic() + timeout
+        while self._tasks and time.monotonic() < deadline:
+            # Пока ждем, задачи могут запускать новые - проверяем множество заново
+            await asyncio.wait(set(self._tasks), timeout=deadline - time.monotonic())
+        pending = list(self._tasks)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        return len(pending)
+
+    def _on_task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка фоновой задачи: {task.exception()}")
+
+    def format_stats(self) -> str:
+        lines = []
+        for stage, pool in self.pools.items():
+            stats = pool.stats
+            finished = stats['completed'] + stats['failed']
+            avg_wait = stats['wait_total'] / finished if finished else 0.0
+            avg_run = stats['run_total'] / finished if finished else 0.0
+            lines.append(
+                f"• {stage}: активно {pool.active}/{pool.workers}, в очереди {pool.queued}/{pool.max_queue} "
+                f"(пользователей: {pool.waiting_owners})\n"
+                f"  готово {stats['completed']}, ошибок {stats['failed']}, отклонено {stats['rejected']}\n"
+                f"  ожидание ср. {avg_wait:.1f}с (макс. {stats['wait_max']:.1f}с), "
+                f"выполнение ср. {avg_run:.1f}с (макс. {stats['run_max']:.1f}с)"
+            )
+        return "\n".join(lines)
+
+
+# Лимиты пулов: (число исполнителей, максимальная длина очереди)
+SCHEDULER_LIMITS = {
+    'download': (int(os.getenv('DOWNLOAD_WORKERS', '3')), int(os.getenv('DOWNLOAD_QUEUE_SIZE', '20'))),
+    'transcode': (int(os.getenv('TRANSCODE_WORKERS', str(max(1, (os.cpu_count() or 2) // 4)))),
+                  int(os.getenv('TRANSCODE_QUEUE_SIZE', '10'))),
+    'upload': (int(os.getenv('UPLOAD_WORKERS', '4')), int(os.getenv('UPLOAD_QUEUE_SIZE', '30'))),
+    'probe': (int(os.getenv('PROBE_WORKERS', '4')), int(os.getenv('PROBE_QUEUE_SIZE', '50')))
+}
+
+# Лимиты одного пользователя на каждом этапе: выполняемые задачи (0 - половина исполнителей пула)
+# и ожидающие в очереди, чтобы десятки ссылок от одного человека не задерживали остальных
+scheduler = JobScheduler(
+    SCHEDULER_LIMITS,
+    owner_workers=int(os.getenv('USER_MAX_ACTIVE', '0')) or None,
+    owner_queue=int(os.getenv('USER_MAX_QUEUED', '5'))
+)
+metrics.gauge('bot_stage_queue_depth', "Задачи в очереди этапа",
+              collect=lambda: {(('stage', stage),): pool.queued for stage, pool in scheduler.pools.items()})
+metrics.gauge('bot_stage_active', "Выполняемые задачи этапа",
+              collect=lambda: {(('stage', stage),): pool.active for stage, pool in scheduler.pools.items()})
+metrics.counter('bot_stage_jobs_total', "Задачи этапа по результату (completed/failed/rejected)", collect=lambda: {
+    (('result', result), ('stage', stage)): pool.stats[result]
+    for stage, pool in scheduler.pools.items() for result in ('completed', 'failed', 'rejected')
+})
+
+
+# Приоритеты исходящих запросов к Bot API: меньше - раньше
+PRIORITY_MEDIA = 0  # Загрузка файлов и ответы на нажатия кнопок
+PRIORITY_NORMAL = 1  # Сообщения и итоговые правки
+PRIORITY_STATUS = 2  # Косметические правки статуса: прогресс, позиция в очереди
+
+MEDIA_ENDPOINTS = {'sendVideo', 'sendDocument', 'sendAudio', 'sendPhoto', 'sendMediaGroup', 'answerCallbackQuery'}
+
+_request_priority = contextvars.ContextVar('request_priority', default=PRIORITY_NORMAL)
+
+
+@contextlib.contextmanager
+def request_priority(priority: int):
+    """Задает приоритет запросов к Bot API, сделанных внутри блока"""
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def _upload_size(value) -> int:
+    """Размер файла в параметре запроса: загружаемый InputFile или путь file:// своего сервера Bot API"""
+    if isinstance(value, InputFile):
+        content = value.input_file_content
+        return len(content) if isinstance(content, bytes) else os.fstat(content.fileno()).st_size
+    if isinstance(value, str) and value.startswith('file://'):
+        try:
+            return os.path.getsize(value[len('file://'):])
+        except OSError:
+            return 0
+    return 0
+
+
+class _PendingRequest:
+    __slots__ = ('priority', 'seq', 'chat_id', 'edit_key', 'future')
+
+    def __init__(self, priority, seq, chat_id, edit_key):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.edit_key = edit_key
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """
+    Единый планировщик исходящих запросов к Bot API:
+    - общая корзина токенов на бота и своя на каждый чат (в группах лимит ниже)
+    - из ожидающих первым уходит запрос с наивысшим приоритетом, у которого есть токены
+    - ожидающая правка сообщения отбрасывается, если пришла более новая правка того же сообщения
+    - ответ 429 ставит на паузу чат (или всего бота) на retry_after; запрос без загрузки
+      файла повторяется, загрузку повторяет вызывающий (upload_with_retry), потому что
+      файл уже прочитан и его нужно открыть заново
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float, max_retries: int = 3):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.stats = collections.Counter()
+        self._waiting = []
+        self._edits = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def initialize(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for request in self._waiting:
+            request.future.cancel()
+        self._waiting.clear()
+        self._edits.clear()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # Забываем чаты с полной корзиной - для них ничего не изменится
+                now = time.monotonic()
+                self.chat_buckets = {key: b for key, b in self.chat_buckets.items() if b.delay(now) > 0}
+            rate = self.group_rate if chat_id.startswith('-') else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, max(1.0, rate * 3))
+        return bucket
+
+    def _delay(self, request: _PendingRequest, now: float) -> float:
+        delay = self.global_bucket.delay(now)
+        if request.chat_id is not None:
+            delay = max(delay, self._chat_bucket(request.chat_id).delay(now))
+        return delay
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            wait = None
+            for request in sorted(self._waiting, key=lambda r: (r.priority, r.seq)):
+                delay = self._delay(request, now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                self.global_bucket.take()
+                if request.chat_id is not None:
+                    self._chat_bucket(request.chat_id).take()
+                self._forget(request)
+                request.future.set_result(True)
+                break
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _forget(self, request: _PendingRequest):
+        self._waiting.remove(request)
+        if request.edit_key is not None and self._edits.get(request.edit_key) is request:
+            del self._edits[request.edit_key]
+
+    async def _acquire(self, priority: int, chat_id, edit_key) -> bool:
+        """Ждет своей очереди; False - запрос отброшен более новой правкой"""
+        request = _PendingRequest(priority, next(self._seq), chat_id, edit_key)
+        if self._delay(request, time.monotonic()) > 0 or self._waiting:
+            self.stats['delayed'] += 1
+        if edit_key is not None:
+            superseded = self._edits.get(edit_key)
+            if superseded is not None:
+                self._forget(superseded)
+                superseded.future.set_result(False)
+            self._edits[edit_key] = request
+        self._waiting.append(request)
+        self.stats['queued'] += 1
+        self._wakeup.set()
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            if request in self._waiting:
+                self._forget(request)
+            raise
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = str(data['chat_id']) if data.get('chat_id') is not None else None
+        priority = PRIORITY_MEDIA if endpoint in MEDIA_ENDPOINTS else _request_priority.get()
+        edit_key = None
+        if endpoint.startswith('editMessage'):
+            edit_key = (endpoint, chat_id, data.get('message_id'), data.get('inline_message_id'))
+        has_upload = any(isinstance(value, InputFile) for value in data.values())
+        upload_bytes = sum(_upload_size(value) for value in data.values()) if endpoint in MEDIA_ENDPOINTS else 0
+
+        for attempt in itertools.count():
+            if not await self._acquire(priority, chat_id, edit_key):
+                self.stats['dropped'] += 1
+                return True  # Сообщение все равно покажет более новую правку
+            try:
+                with tracer.span(f"telegram.{endpoint}", attempt=attempt, bytes=upload_bytes):
+                    if not upload_bytes:
+                        return await callback(*args, **kwargs)
+                    with stage_seconds.time(stage='upload'):
+                        result = await callback(*args, **kwargs)
+                bytes_total.inc(upload_bytes, direction='out')
+                return result
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self.pause(chat_id, delay)
+                logger.warning(f"Bot API: 429 на {endpoint}, пауза {delay:.0f}s")
+                if has_upload or attempt >= self.max_retries:
+                    raise
+
+    async def acquire_upload(self, chat_id):
+        """
+        Очередь для загрузки мимо бота (потоковая отправка собирает запрос sendVideo сама через httpx):
+        токены общей корзины и корзины чата расходуются так же, как у send_video
+        """
+        if self._task is None:
+            return  # Лимитер не запущен: бот работает без приложения (бенчмарки)
+        await self._acquire(PRIORITY_MEDIA, str(chat_id), None)
+
+    def pause(self, chat_id, delay: float):
+        """Учитывает ответ 429: запросы в чат (без чата - все запросы бота) ждут delay секунд"""
+        self.stats['retry_after'] += 1
+        (self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket).pause(delay)
+
+    def format_stats(self) -> str:
+        return (f"в очереди {self.queued}, всего {self.stats['queued']}, задержано {self.stats['delayed']}, "
+                f"отброшено правок {self.stats['dropped']}, 429: {self.stats['retry_after']}")
+
+
+rate_limiter = TelegramRateLimiter(
+    global_rate=float(os.getenv('TG_GLOBAL_RATE', '30')),
+    chat_rate=float(os.getenv('TG_CHAT_RATE', '1')),
+    group_rate=float(os.getenv('TG_GROUP_RATE', '0.33'))
+)
+metrics.gauge('bot_telegram_queue_depth', "Запросы к Bot API, ожидающие токенов",
+              collect=lambda: {(): rate_limiter.queued})
+metrics.counter('bot_telegram_requests_total', "События планировщика Bot API (queued/delayed/dropped/retry_after)",
+                collect=lambda: {(('event', event),): rate_limiter.stats[event]
+                                 for event in ('queued', 'delayed', 'dropped', 'retry_after')})
+
+
+def queue_notifier(query, stage_title: str):
+    """Возвращает обработчик, который показывает пользователю позицию в очереди"""
+    async def on_queued(position: int):
+        with request_priority(PRIORITY_STATUS):
+            await query.edit_message_text(
+                f"🕐 Ожидание очереди на {stage_title}\n"
+                f"📍 Позиция в очереди: {position}"
+            )
+    return on_queued
+
+
+OVERLOAD_MESSAGE = "❌ Сервер сейчас перегружен\n\n💡 Попробуйте повторить через несколько минут."
+
+
+# Минимальный интервал между правками статусного сообщения в одном чате (секунды)
+STATUS_UPDATE_INTERVAL = float(os.getenv('STATUS_UPDATE_INTERVAL', '3'))
+# Последнее занятое окно правки по чатам в порядке занятия; окна, которые уже прошли, ни на что
+# не влияют и удаляются с начала словаря, так что в нем остаются только чаты с недавними правками
+_chat_last_status_edit = collections.OrderedDict()
+
+
+class StatusUpdater:
+    """
+    Статусное сообщение с прогрессом: частые обновления склеиваются,
+    в Telegram уходит не больше одной правки за STATUS_UPDATE_INTERVAL на чат
+    """
+
+    def __init__(self, edit, chat_id: int, interval: float = None):
+        self._edit = edit
+        self.chat_id = chat_id
+        self.interval = STATUS_UPDATE_INTERVAL if interval is None else interval
+        self._pending = None
+        self._last_text = None
+        self._task = None
+        self._closed = False
+
+    def _reserve_slot(self) -> float:
+        """Занимает ближайшее свободное окно правки в чате, возвращает задержку до него"""
+        now = time.monotonic()
+        while _chat_last_status_edit:
+            chat_id, last_slot = next(iter(_chat_last_status_edit.items()))
+            if last_slot + STATUS_UPDATE_INTERVAL > now:
+                break
+            del _chat_last_status_edit[chat_id]
+        slot = max(now, _chat_last_status_edit.get(self.chat_id, 0.0) + self.interval)
+        _chat_last_status_edit[self.chat_id] = slot
+        _chat_last_status_edit.move_to_end(self.chat_id)
+        return slot - now
+
+    def update(self, text: str):
+        """Запоминает новый текст; отправлен будет только последний к моменту правки"""
+        if self._closed or text == self._last_text:
+            return
+        self._pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self._pending is not None and not self._closed:
+            delay = self._reserve_slot()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self._pending is None or self._closed:
+                break
+            text, self._pending = self._pending, None
+            with request_priority(PRIORITY_STATUS):
+                await self._send(text)
+
+    async def _send(self, text: str):
+        try:
+            await self._edit(text)
+            self._last_text = text
+        except Exception as e:
+            logger.debug(f"Не удалось обновить статус: {e}")
+
+    async def close(self, final_text: str = None):
+        """Отменяет отложенные правки; final_text отправляется сразу, без ожидания"""
+        self._closed = True
+        self._pending = None
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        if final_text is not None and final_text != self._last_text:
+            self._reserve_slot()
+            await self._send(final_text)
+
+
+def progress_reporter(status: StatusUpdater, title: str):
+    """Обработчик доли выполнения, который обновляет статус с полосой прогресса"""
+    return lambda fraction: status.update(f"{title}\n{render_progress_bar(fraction)}")
+
+
+def render_progress_bar(fraction: float, width: int = 10) -> str:
+    fraction = min(max(fraction or 0.0, 0.0), 1.0)
+    filled = int(round(fraction * width))
+    return f"[{'▓' * filled}{'░' * (width - filled)}] {fraction * 100:.0f}%"
+
+
+def format_download_progress(progress: dict) -> str:
+    """Текст статуса скачивания по событию прогресса yt-dlp"""
+    downloaded = progress.get('downloaded_bytes') or 0
+    total = progress.get('total_bytes')
+    lines = ["⏬ Скачиваю видео..."]
+    if total:
+        lines.append(render_progress_bar(downloaded / total))
+        lines.append(f"📊 {downloaded / (1024 * 1024):.1f} / {total / (1024 * 1024):.1f} MB")
+    else:
+        lines.append(f"📊 {downloaded / (1024 * 1024):.1f} MB")
+    if progress.get('speed'):
+        lines.append(f"🚀 {progress['speed'] / (1024 * 1024):.1f} MB/s")
+    if progress.get('eta') is not None:
+        minutes, seconds = divmod(int(progress['eta']), 60)
+        lines.append(f"⏳ Осталось ~{minutes}:{seconds:02d}")
+    return "\n".join(lines)
+
+
+# Шаблон прогресса yt-dlp (--newline --progress-template), разбирается parse_ytdlp_progress
+YTDLP_PROGRESS_TEMPLATE = (
+    "download:PROGRESS %(progress.downloaded_bytes)s %(progress.total_bytes)s "
+    "%(progress.total_bytes_estimate)s %(progress.speed)s %(progress.eta)s"
+)
+
+
+def parse_ytdlp_progress(line: str):
+    """Разбирает строку прогресса yt-dlp, возвращает dict или None"""
+    if not line.startswith("PROGRESS "):
+        return None
+
+    def number(value):
+        try:
+            return float(value)
+        except ValueError:
+            return None  # yt-dlp пишет NA для неизвестных значений
+
+    values = [number(v) for v in line.split()[1:6]]
+    if len(values) < 5:
+        return None
+    downloaded, total, estimate, speed, eta = values
+    return {
+        'status': 'downloading',
+        'downloaded_bytes': downloaded,
+        'total_bytes': total or estimate,
+        'speed': speed,
+        'eta': eta
+    }
+
+
+class FfmpegProgress:
+    """Разбор вывода ffmpeg -progress pipe:1: доля выполненной работы по out_time"""
+
+    def __init__(self, duration: float, on_progress):
+        self.duration = duration
+        self.on_progress = on_progress
+        self._out_time = 0.0
+
+    def __call__(self, line: str):
+        key, _, value = line.partition("=")
+        if key in ("out_time_us", "out_time_ms"):
+            # out_time_ms у ffmpeg тоже в микросекундах
+            try:
+                self._out_time = int(value) / 1_000_000
+            except ValueError:
+                pass
+        elif key == "progress" and self.duration:
+            fraction = 1.0 if value == "end" else self._out_time / self.duration
+            self.on_progress(min(fraction, 1.0))
+
+
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     await update.message.reply_text(
@@ -82,6 +1378,44 @@ async def platforms_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда администратора: состояние очередей и задержки этапов"""
+    if str(update.message.from_user.id) != str(admin_id):
+        return
+
+    paths = ", ".join(f"{path} {optimization_paths[path]}" for path in ('skip', 'remux', 'audio', 'encode'))
+    await update.message.reply_text(
+        f"📊 Очереди обработки:\n\n{scheduler.format_stats()}\n\n"
+        f"🎞 Подготовка видео: {paths}\n"
+        f"📨 Bot API: {rate_limiter.format_stats()}\n"
+        f"💽 Диск: {janitor.usage / (1024 * 1024):.0f} MB в {janitor.files} файлах, "
+        f"свободно {janitor.free_bytes() / (1024 * 1024):.0f} MB, "
+        f"вытеснено {janitor.evicted}, отклонено {janitor.rejected}"
+    )
+
+
+async def slow_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда администратора: самые долгие недавние задачи и их самые долгие отрезки"""
+    if str(update.message.from_user.id) != str(admin_id):
+        return
+
+    traces = tracer.slowest(int(context.args[0]) if context.args and context.args[0].isdigit() else 5)
+    if not traces:
+        await update.message.reply_text("🐢 Трасс пока нет")
+        return
+
+    lines = ["🐢 Самые долгие задачи:"]
+    for trace in traces:
+        lines.append(f"\n#{trace['job_id']} {trace['name']}: {trace['duration']:.1f}s ({trace['status']})")
+        # Листья дерева показывают, где на самом деле ушло время
+        parents = {span['parent'] for span in trace['spans']}
+        leaves = [span for span in trace['spans'] if span['id'] not in parents and span['duration']]
+        for span in sorted(leaves, key=lambda span: span['duration'], reverse=True)[:3]:
+            lines.append(f"  • {span['name']} {span['duration']:.1f}s"
+                         f"{' ⚠️ ' + span['status'] if span['status'] != 'ok' else ''}")
+    await update.message.reply_text("\n".join(lines))
+
+
 def is_supported_platform(url: str) -> bool:
     """Проверяет поддерживается ли платформа"""
     return any(domain in url for domain in SUPPORTED_PLATFORMS.keys())
@@ -119,32 +1453,20 @@ async def handle_video_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Автоматические замены URL для лучшей совместимости
     url = normalize_url(url)
 
-    # Сохраняем URL для пользователя
-    user_data[user_id] = {
-        'url': url,
-        'step': 'quality_selection',
-        'platform': get_platform_name(url),
-        'username': username
-    }
-
-    # Предлагаем выбрать качество
-    keyboard = [
-        [
-            InlineKeyboardButton("🎥 Лучшее качество", callback_data="quality_best"),
-            InlineKeyboardButton("⚖️ Сбалансированное", callback_data="quality_720")
-        ],
-        [
-            InlineKeyboardButton("📱 Для телефона (480p)", callback_data="quality_480"),
-            InlineKeyboardButton("🎵 Только аудио", callback_data="quality_audio")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Сохраняем задачу для пользователя
+    job_id = job_store.create(
+        user_id, 'quality_selection',
+        url=url,
+        platform=get_platform_name(url),
+        username=username
+    )
 
+    # Получаем метаданные в фоне, затем предлагаем выбрать качество
     platform_name = get_platform_name(url)
-    await update.message.reply_text(
-        f"🎬 Ссылка с {platform_name} принята!\nВыберите качество видео:",
-        reply_markup=reply_markup
+    status_message = await update.message.reply_text(
+        f"🎬 Ссылка с {platform_name} принята!\n🔍 Получаю информацию о видео..."
     )
+    scheduler.spawn(offer_quality_choice(status_message, job_id, url, platform_name))
 
 
 def normalize_url(url: str) -> str:
@@ -160,210 +1482,1882 @@ def normalize_url(url: str) -> str:
     return url
 
 
-async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик выбора качества"""
-    query = update.callback_query
-    await query.answer()
+# Лимит размера файла, который бот отправляет в Telegram без разделения (с запасом от 50 MB облачного
+# API и 2000 MB своего сервера)
+TELEGRAM_UPLOAD_LIMIT_MB = int(os.getenv('TELEGRAM_UPLOAD_LIMIT_MB', '1950' if BOT_API_URL else '45'))
+# Таймаут отправки файла: свой сервер отвечает только после загрузки большого файла в Telegram
+UPLOAD_TIMEOUT = int(os.getenv('UPLOAD_TIMEOUT', '900' if BOT_API_URL else '60'))
 
-    user_id = query.from_user.id
-    quality = query.data.replace('quality_', '')
 
-    if user_id not in user_data:
-        await query.edit_message_text("❌ Сессия устарела. Отправьте ссылку заново.")
+@contextlib.contextmanager
+def upload_source(path: str):
+    """
+    Файл для send_video/send_document:
+    - в local_mode - путь, сервер Bot API читает файл с диска сам
+    - иначе файл уходит в запрос потоком, не загружаясь в память целиком
+    """
+    if BOT_API_LOCAL_MODE:
+        yield os.path.abspath(path)
         return
+    with open(path, 'rb') as f:
+        yield InputFile(f, filename=os.path.basename(path), read_file_handle=False)
 
-    url = user_data[user_id]['url']
-    platform = user_data[user_id]['platform']
-    user_data[user_id]['quality'] = quality
-    user_data[user_id]['step'] = 'downloading'
+# Сколько раз отправлять файл, если Telegram отвечает 429
+UPLOAD_ATTEMPTS = 3
 
-    quality_names = {
-        'best': 'лучшее качество',
-        '720': '720p (HD)',
+
+async def upload_with_retry(path: str, send):
+    """
+    Вызывает send(файл) с источником из upload_source. После 429 ждет retry_after и повторяет
+    с заново открытым файлом: лимитер такие запросы сам не повторяет, файл уже прочитан.
+    """
+    for attempt in range(UPLOAD_ATTEMPTS):
+        try:
+            with upload_source(path) as source:
+                return await send(source)
+        except RetryAfter as e:
+            if attempt == UPLOAD_ATTEMPTS - 1:
+                raise
+            delay = retry_after_seconds(e)
+            logger.warning(f"Отправка {os.path.basename(path)}: 429, повтор через {delay:.0f}s")
+            await asyncio.sleep(delay)
+
+# Время жизни кэша метаданных видео (секунды)
+METADATA_TTL = int(os.getenv('METADATA_TTL', '600'))
+_metadata_cache = {}
+
+
+async def probe_metadata(url: str):
+    """Получает метаданные видео через yt-dlp без скачивания (результат кэшируется по URL)"""
+    cached = _metadata_cache.get(url)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    cmd = [
+        "yt-dlp",
+        "--dump-single-json",
+        "--skip-download",
+        "--no-warnings",
+        "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+        "--socket-timeout", "30",
+        url
+    ]
+
+    try:
+        result = await run_process(cmd, timeout=60)
+        if result.returncode != 0:
+            logger.warning(f"Не удалось получить метаданные {url}: {result.stderr[-500:]}")
+            return None
+        info = json.loads(result.stdout)
+    except Exception as e:
+        logger.warning(f"Ошибка получения метаданных {url}: {e}")
+        return None
+
+    # Просроченные записи чистим при каждом новом запросе
+    now = time.monotonic()
+    for key in [k for k, (expires, _) in _metadata_cache.items() if expires <= now]:
+        del _metadata_cache[key]
+    _metadata_cache[url] = (now + METADATA_TTL, info)
+    return info
+
+
+def _has_video(fmt: dict) -> bool:
+    return fmt.get('vcodec') != 'none' and bool(fmt.get('height') or fmt.get('vcodec'))
+
+
+def _has_audio(fmt: dict) -> bool:
+    return fmt.get('acodec') != 'none'
+
+
+def estimate_format_size(fmt: dict, duration: float):
+    """Оценка размера формата в байтах (None, если оценить нельзя)"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+
+def select_preset_format(info: dict, quality: str):
+    """Повторяет выбор yt-dlp для пресета: форматы в info отсортированы от худшего к лучшему"""
+    formats = info.get('formats') or []
+    preset = QUALITY_PRESETS.get(quality, QUALITY_PRESETS['best'])
+
+    if quality == 'audio':
+        candidates = [f for f in formats if _has_audio(f) and f.get('vcodec') == 'none']
+    else:
+        combined = [f for f in formats if _has_video(f) and _has_audio(f)]
+        candidates = [f for f in combined if (f.get('height') or 0) <= preset['max_height']]
+
+    if not candidates:
+        # Запасной вариант "/best" из строки формата
+        candidates = [f for f in formats if _has_video(f) and _has_audio(f)] or formats
+    return candidates[-1] if candidates else None
+
+
+def is_telegram_ready_format(fmt: dict) -> bool:
+    """Формат можно отправить в Telegram как видео без перекодирования"""
+    vcodec = (fmt.get('vcodec') or '').lower()
+    acodec = (fmt.get('acodec') or '').lower()
+    return (
+        fmt.get('ext') == 'mp4'
+        and _has_video(fmt) and _has_audio(fmt)
+        and (not vcodec or vcodec.startswith(('avc1', 'h264')))
+        and (not acodec or acodec.startswith(('mp4a', 'aac')))
+        and (fmt.get('height') or 0) <= 1080
+    )
+
+
+def find_telegram_ready_format(info: dict, limit_mb: float = TELEGRAM_UPLOAD_LIMIT_MB):
+    """Лучший формат, который помещается в лимит Telegram и не требует перекодирования"""
+    duration = info.get('duration') or 0
+    limit_bytes = limit_mb * 1024 * 1024
+    best = None
+    for fmt in info.get('formats') or []:
+        size = estimate_format_size(fmt, duration)
+        if size and size <= limit_bytes and is_telegram_ready_format(fmt):
+            best = fmt
+    return best
+
+
+def estimate_quality_sizes(info: dict, fit_format: dict = None) -> dict:
+    """Ожидаемый размер файла для каждого варианта качества (байты), нужен для проверки места на диске"""
+    duration = info.get('duration') or 0
+    sizes = {}
+    for quality in ('best', '720', '480', 'audio'):
+        fmt = select_preset_format(info, quality)
+        size = estimate_format_size(fmt, duration) if fmt else None
+        if size:
+            sizes[quality] = size
+    if fit_format:
+        sizes['fit'] = estimate_format_size(fit_format, duration)
+    return sizes
+
+
+def _format_label(fmt: dict, duration: float) -> str:
+    parts = []
+    if fmt.get('height') and fmt.get('vcodec') != 'none':
+        parts.append(f"{fmt['height']}p")
+    size = estimate_format_size(fmt, duration)
+    if size:
+        parts.append(f"~{size / (1024 * 1024):.0f} MB")
+    return " · ".join(parts)
+
+
+def build_quality_keyboard(info: dict = None, job_id: int = 0):
+    """
+    Клавиатура выбора качества. Если есть метаданные, кнопки показывают реальное
+    разрешение и ожидаемый размер, а также вариант без перекодирования.
+    Возвращает (разметка, формат варианта без перекодирования или None).
+    """
+    titles = {
+        'best': "🎥 Лучшее качество",
+        '720': "⚖️ Сбалансированное",
+        '480': "📱 Для телефона (480p)",
+        'audio': "🎵 Только аудио"
+    }
+
+    fit_format = None
+    if info:
+        duration = info.get('duration') or 0
+        for quality in titles:
+            fmt = select_preset_format(info, quality)
+            label = _format_label(fmt, duration) if fmt else ""
+            if label:
+                titles[quality] = f"{titles[quality].split(' (')[0]} ({label})"
+        fit_format = find_telegram_ready_format(info)
+
+    keyboard = [
+        [
+            InlineKeyboardButton(titles['best'], callback_data=job_callback("quality_best", job_id)),
+            InlineKeyboardButton(titles['720'], callback_data=job_callback("quality_720", job_id))
+        ],
+        [
+            InlineKeyboardButton(titles['480'], callback_data=job_callback("quality_480", job_id)),
+            InlineKeyboardButton(titles['audio'], callback_data=job_callback("quality_audio", job_id))
+        ]
+    ]
+
+    if fit_format:
+        keyboard.insert(0, [InlineKeyboardButton(
+            f"✅ Сразу для Telegram ({_format_label(fit_format, info.get('duration') or 0)})",
+            callback_data=job_callback("quality_fit", job_id)
+        )])
+
+    return InlineKeyboardMarkup(keyboard), fit_format
+
+
+async def offer_quality_choice(message, job_id: int, url: str, platform_name: str):
+    """Получает метаданные видео и показывает клавиатуру выбора качества"""
+    try:
+        info = await scheduler.run('probe', lambda: probe_metadata(url), owner=message.chat_id)
+    except QueueFullError:
+        info = None
+
+    reply_markup, fit_format = build_quality_keyboard(info, job_id)
+
+    metadata = {'fit_format': fit_format['format_id'] if fit_format else None}
+    if fit_format:
+        metadata['fit_video'] = {
+            'duration': info.get('duration'),
+            'width': fit_format.get('width'),
+            'height': fit_format.get('height')
+        }
+    if info:
+        metadata['duration'] = info.get('duration')
+        metadata['title'] = info.get('title')
+        metadata['estimated_sizes'] = estimate_quality_sizes(info, fit_format)
+    job_store.update(job_id, **metadata)
+
+    details = ""
+    if info:
+        if info.get('title'):
+            details += f"📹 {info['title']}\n"
+        if info.get('duration'):
+            minutes, seconds = divmod(int(info['duration']), 60)
+            details += f"⏱ {minutes}:{seconds:02d}\n"
+
+    await message.edit_text(
+        f"🎬 Ссылка с {platform_name} принята!\n{details}Выберите качество видео:",
+        reply_markup=reply_markup
+    )
+
+
+async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик выбора качества"""
+    query = update.callback_query
+    await query.answer()
+
+    user_id = query.from_user.id
+    action, job = get_callback_job(query)
+    quality = action.replace('quality_', '')
+
+    if job is None:
+        await query.edit_message_text("❌ Сессия устарела. Отправьте ссылку заново.")
+        return
+    job_id = job['job_id']
+    # Задача занимается до первого await (проверка места может идти долго): второе нажатие ее не получит
+    if not job_store.claim(job_id, 'quality_selection', 'queued'):
+        return  # Повторное нажатие: скачивание этой ссылки уже запущено
+
+    platform = job['platform']
+
+    quality_names = {
+        'best': 'лучшее качество',
+        '720': '720p (HD)',
         '480': '480p',
-        'audio': 'только аудио'
+        'audio': 'только аудио',
+        'fit': 'готово для Telegram (без перекодирования)'
     }
 
+    if quality == 'fit' and not job.get('fit_format'):
+        job_store.claim(job_id, 'queued', 'quality_selection')
+        await query.edit_message_text("❌ Сессия устарела. Отправьте ссылку заново.")
+        return
+
+    download_pool = scheduler.pools['download']
+    if download_pool.is_full(user_id):
+        job_store.claim(job_id, 'queued', 'quality_selection')
+        await query.edit_message_text(OVERLOAD_MESSAGE)
+        return
+
+    predicted = job.get('estimated_sizes', {}).get(quality) or DEFAULT_JOB_SIZE_MB * 1024 * 1024
+    try:
+        admitted = await janitor.admit(predicted)
+    except BaseException:
+        job_store.claim(job_id, 'queued', 'quality_selection')
+        raise
+    if not admitted:
+        job_store.claim(job_id, 'queued', 'quality_selection')
+        await query.edit_message_text(
+            "💽 На сервере сейчас недостаточно места для этого видео.\n"
+            "Попробуйте качество пониже или повторите позже."
+        )
+        return
+
+    job_store.update(job_id, quality=quality)
+
+    position = download_pool.next_position(user_id)
+    queue_line = f"🕐 Позиция в очереди: {position}\n" if position else ""
+
     await query.edit_message_text(
         f"⏬ Начинаю скачивание с {platform}...\n"
         f"💾 Качество: {quality_names.get(quality, quality)}\n"
+        f"{queue_line}"
         f"⏳ Это может занять несколько минут..."
     )
 
-    # Запускаем скачивание
-    asyncio.create_task(download_video(user_id, url, quality, context))
+    # Запускаем скачивание, прогресс показываем в этом же сообщении
+    status = StatusUpdater(query.edit_message_text, chat_id=user_id)
+    start_job_download(job_store.get(job_id), context, status)
+
+
+def start_job_download(job: dict, context, status: StatusUpdater):
+    """Запускает скачивание задачи в фоне (после выбора качества или при восстановлении после перезапуска)"""
+    format_override = job.get('fit_format') if job['quality'] == 'fit' else None
+    attrs = {'platform': platform_label(job['url']), 'quality': job['quality'], 'format': format_override}
+    if format_override and STREAM_UPLOADS:
+        # Формат уже подходит Telegram: отправляем потоком, минуя диск
+        scheduler.spawn(traced(job['job_id'], job['user_id'], 'stream', stream_ready_video(
+            job['job_id'], job['user_id'], job['url'], format_override, context, status
+        ), **attrs))
+    else:
+        scheduler.spawn(traced(job['job_id'], job['user_id'], 'download', download_video(
+            job['job_id'], job['user_id'], job['url'], job['quality'], context, format_override, status
+        ), **attrs))
+
+
+# ИСПРАВЛЕННЫЕ настройки качества
+QUALITY_PRESETS = {
+    'best': {
+        'format': 'best[height<=1080]/best',
+        'max_height': 1080,
+        'description': 'Лучшее качество (до 1080p)'
+    },
+    '720': {
+        'format': 'best[height<=720]/best',
+        'max_height': 720,
+        'description': 'HD качество (720p)'
+    },
+    '480': {
+        'format': 'best[height<=480]/best',
+        'max_height': 480,
+        'description': 'Стандартное качество (480p)'
+    },
+    'audio': {
+        'format': 'bestaudio/best',
+        'max_height': None,
+        'description': 'Только аудио',
+        'audio_params': ['-x', '--audio-format', 'mp3', '--audio-quality', '5']
+    },
+    'fit': {
+        # Конкретный format_id подставляется из метаданных видео
+        'format': 'best[ext=mp4][vcodec^=avc1]/best[ext=mp4]/best',
+        'max_height': 1080,
+        'description': 'Готово для Telegram (без перекодирования)'
+    }
+}
+
+
+class DownloadError(Exception):
+    """yt-dlp завершился с ошибкой; текст содержит stderr"""
+
+
+async def run_ytdlp(url: str, quality: str, target_dir: str, format_override: str = None,
+                    on_progress=None) -> str:
+    """Скачивает видео через yt-dlp в указанную папку и возвращает путь к файлу"""
+    preset = QUALITY_PRESETS.get(quality, QUALITY_PRESETS['best'])
+    format_selection = format_override or preset['format']
+
+    # Базовые параметры
+    cmd = [
+        "yt-dlp",
+        "-o", f"{target_dir}/%(title)s.%(ext)s",
+        "-f", format_selection,
+        "--no-warnings",
+        "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+        "--retries", "3",
+        "--fragment-retries", "3",
+        "--socket-timeout", "30",
+        "--newline",
+        "--progress-template", YTDLP_PROGRESS_TEMPLATE,
+        url
+    ]
+
+    # Добавляем параметры для аудио если нужно
+    if quality == 'audio' and 'audio_params' in preset:
+        cmd.extend(preset['audio_params'])
+
+    logger.info(f"Скачивание с параметрами: {' '.join(cmd)}")
+
+    def on_line(line):
+        progress = parse_ytdlp_progress(line)
+        if progress and on_progress is not None:
+            on_progress(progress)
+
+    result = await run_process(cmd, timeout=600, on_stdout=on_line, on_stderr=on_line)
+
+    if result.returncode != 0:
+        raise DownloadError(result.stderr if result.stderr else "Неизвестная ошибка")
+
+    return find_downloaded_file(target_dir)
+
+
+def find_downloaded_file(target_dir: str) -> str:
+    """Ищет скачанный файл в папке (служебные .part/.ytdl не учитываем)"""
+    files = [
+        os.path.join(target_dir, f) for f in os.listdir(target_dir)
+        if not f.endswith(('.part', '.ytdl'))
+    ]
+    if not files:
+        raise FileNotFoundError("Файл не найден после скачивания")
+
+    return max(files, key=os.path.getctime)
+
+
+class SubprocessDownloadBackend:
+    """Скачивание отдельным процессом yt-dlp на каждый запрос"""
+
+    name = 'subprocess'
+
+    async def download(self, url: str, quality: str, target_dir: str, format_override: str = None,
+                       on_progress=None) -> str:
+        return await run_ytdlp(url, quality, target_dir, format_override, on_progress)
+
+    def close(self):
+        pass
+
+
+# Состояние процесса-исполнителя yt-dlp: прогретые экземпляры YoutubeDL по пресетам
+# (не больше YTDLP_MAX_INSTANCES, давно не использованные закрываются)
+YTDLP_MAX_INSTANCES = 8
+YTDLP_CANCEL_SLOTS = 64
+_ydl_instances = collections.OrderedDict()
+_ydl_progress_queue = None
+_ydl_cancelled = None
+_ydl_current_job = None
+_ydl_deadline = 0.0
+_ydl_last_progress = 0.0
+
+
+def _ytdlp_worker_init(progress_queue, cancelled):
+    """Инициализация процесса пула yt-dlp"""
+    global _ydl_progress_queue, _ydl_cancelled
+    _ydl_progress_queue = progress_queue
+    _ydl_cancelled = cancelled
+
+
+def _ytdlp_progress_hook(status: dict):
+    """
+    Хук прогресса yt-dlp: пересылает в основной процесс не чаще раза в секунду.
+    Прерывает скачивание, если основной процесс его отменил или истек срок задачи.
+    """
+    global _ydl_last_progress
+    if time.time() > _ydl_deadline or _ydl_current_job in _ydl_cancelled[:]:
+        raise yt_dlp.utils.DownloadCancelled(f"скачивание {_ydl_current_job} отменено")
+
+    now = time.monotonic()
+    if status.get('status') == 'downloading' and now - _ydl_last_progress < 1:
+        return
+    _ydl_last_progress = now
+
+    _ydl_progress_queue.put((_ydl_current_job, {
+        'status': status.get('status'),
+        'downloaded_bytes': status.get('downloaded_bytes'),
+        'total_bytes': status.get('total_bytes') or status.get('total_bytes_estimate'),
+        'speed': status.get('speed'),
+        'eta': status.get('eta')
+    }))
+
+
+def _ytdlp_worker_download(job_id: int, url: str, quality: str, format_selection: str, target_dir: str,
+                           deadline: float) -> dict:
+    """Выполняется в процессе пула: скачивание через прогретый YoutubeDL"""
+    global _ydl_current_job, _ydl_deadline
+    _ydl_current_job = job_id
+    _ydl_deadline = deadline
+    if job_id in _ydl_cancelled[:]:
+        return {'error': "скачивание отменено до начала"}
+
+    ydl = _ydl_instances.get((quality, format_selection))
+    if ydl is not None:
+        _ydl_instances.move_to_end((quality, format_selection))
+    else:
+        options = {
+            'format': format_selection,
+            'outtmpl': '%(title)s.%(ext)s',
+            'quiet': True,
+            'no_warnings': True,
+            'noprogress': True,
+            'retries': 3,
+            'fragment_retries': 3,
+            'socket_timeout': 30,
+            'http_headers': {'User-Agent': "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+        }
+        if quality == 'audio':
+            options['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '5'
+            }]
+        ydl = yt_dlp.YoutubeDL(options)
+        ydl.add_progress_hook(_ytdlp_progress_hook)
+        _ydl_instances[(quality, format_selection)] = ydl
+        # Форматы 'fit' у каждого видео свои - без ограничения экземпляры копились бы бесконечно
+        while len(_ydl_instances) > YTDLP_MAX_INSTANCES:
+            _, stale = _ydl_instances.popitem(last=False)
+            stale.close()
+
+    # Папка назначения читается YoutubeDL при каждом скачивании
+    ydl.params['paths'] = {'home': target_dir}
+    try:
+        ydl.extract_info(url, download=True)
+    except Exception as e:
+        # Исключения yt-dlp не всегда переносятся между процессами, отдаем текст
+        return {'error': str(e)}
+
+    try:
+        return {'path': find_downloaded_file(target_dir)}
+    except FileNotFoundError as e:
+        return {'error': str(e)}
+
+
+class YtDlpApiBackend:
+    """
+    Скачивание через Python API yt-dlp в постоянном пуле процессов:
+    экстракторы и HTTP-соединения остаются прогретыми между задачами,
+    прогресс приходит из хуков yt-dlp, а не из stderr
+    """
+
+    name = 'api'
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = None
+        self._progress_queue = None
+        self._cancelled = None
+        self._listeners = {}
+        self._job_ids = itertools.count(1)
+
+    def _ensure_started(self):
+        if self._executor is not None:
+            return
+
+        # spawn: форк процесса с работающим циклом событий и потоками небезопасен
+        mp_context = multiprocessing.get_context('spawn')
+        self._progress_queue = mp_context.Queue()
+        # Кольцо номеров отмененных задач: процесс пула проверяет его в хуке прогресса
+        self._cancelled = mp_context.Array('q', YTDLP_CANCEL_SLOTS)
+        self._cancel_slots = itertools.cycle(range(YTDLP_CANCEL_SLOTS))
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=mp_context,
+            initializer=_ytdlp_worker_init,
+            initargs=(self._progress_queue, self._cancelled)
+        )
+
+        loop = asyncio.get_running_loop()
+        threading.Thread(
+            target=self._read_progress, args=(loop, self._progress_queue), daemon=True
+        ).start()
+
+    def _read_progress(self, loop, progress_queue):
+        while True:
+            try:
+                item = progress_queue.get()
+            except (EOFError, OSError):
+                return
+            if item is None:
+                return
+            try:
+                loop.call_soon_threadsafe(self._dispatch_progress, *item)
+            except RuntimeError:
+                # Цикл событий уже закрыт
+                return
+
+    def _dispatch_progress(self, job_id, progress: dict):
+        listener = self._listeners.get(job_id)
+        if listener is not None:
+            try:
+                listener(progress)
+            except Exception as e:
+                logger.warning(f"Ошибка обработчика прогресса: {e}")
+
+    async def download(self, url: str, quality: str, target_dir: str, format_override: str = None,
+                       on_progress=None) -> str:
+        self._ensure_started()
+        preset = QUALITY_PRESETS.get(quality, QUALITY_PRESETS['best'])
+        format_selection = format_override or preset['format']
+
+        job_id = next(self._job_ids)
+        if on_progress is not None:
+            self._listeners[job_id] = on_progress
+
+        logger.info(f"Скачивание через yt-dlp API: {url} (формат {format_selection})")
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, _ytdlp_worker_download, job_id, url, quality, format_selection, target_dir,
+            time.time() + 600
+        )
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), 600)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Процесс пула останавливается сам по флагу отмены; ждем его, чтобы он освободил место
+            # в пуле и перестал писать в target_dir до того, как вызывающий ее удалит
+            await self._cancel(job_id, future)
+            if isinstance(e, asyncio.TimeoutError):
+                raise subprocess.TimeoutExpired(["yt-dlp", url], 600)
+            raise
+        except concurrent.futures.process.BrokenProcessPool as e:
+            self.close()
+            raise DownloadError(f"Процесс yt-dlp аварийно завершился: {e}")
+        finally:
+            self._listeners.pop(job_id, None)
+
+        if 'error' in result:
+            raise DownloadError(result['error'])
+        return result['path']
+
+    async def _cancel(self, job_id: int, future):
+        self._cancelled[next(self._cancel_slots)] = job_id
+        try:
+            # Хук прогресса срабатывает на каждом блоке данных; разбор страницы прерывается по socket_timeout
+            await asyncio.wait_for(asyncio.shield(future), 60)
+        except asyncio.TimeoutError:
+            logger.warning(f"Процесс yt-dlp не остановил задачу {job_id} за 60 секунд")
+        except Exception:
+            pass
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if self._progress_queue is not None:
+            self._progress_queue.put(None)
+            self._progress_queue = None
+
+
+def create_download_backend(name: str):
+    """Выбирает реализацию скачивания: 'subprocess' (по умолчанию) или 'api'"""
+    if name == 'api':
+        if yt_dlp is None:
+            logger.warning("Модуль yt_dlp не установлен, используется запуск yt-dlp отдельным процессом")
+        else:
+            return YtDlpApiBackend(int(os.getenv('YTDLP_WORKERS', str(scheduler.pools['download'].workers))))
+    return SubprocessDownloadBackend()
+
+
+download_backend = create_download_backend(os.getenv('DOWNLOAD_BACKEND', 'subprocess'))
+
+
+class DownloadCache:
+    """
+    Общий кэш скачанных файлов на диске:
+    - ключ - нормализованный URL и пресет качества
+    - вытеснение по LRU при превышении лимита размера
+    - одновременные запросы одного видео ждут одну загрузку (single-flight)
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, "index.json")
+        self.tmp_root = os.path.join(root, ".tmp")
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+        self._inflight = {}
+        self._loaded = False
+
+    @staticmethod
+    def key_for(url: str, quality: str) -> str:
+        raw = f"{normalize_url(url)}|{quality}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.root, exist_ok=True)
+
+        # Незавершенные загрузки прошлого запуска больше не нужны
+        shutil.rmtree(self.tmp_root, ignore_errors=True)
+
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            logger.error(f"Не удалось прочитать индекс кэша, начинаю с пустого: {e}")
+            self.entries = {}
+
+        # Выкидываем записи без файлов
+        for key in list(self.entries):
+            if not os.path.exists(self._entry_path(key)):
+                del self.entries[key]
+
+    def _save(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key, self.entries[key]['file'])
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def lookup(self, key: str):
+        """Возвращает путь к файлу в кэше или None"""
+        self._load()
+        if key not in self.entries:
+            return None
+
+        path = self._entry_path(key)
+        if not os.path.exists(path):
+            del self.entries[key]
+            self._save()
+            return None
+
+        self.entries[key]['last_access'] = time.time()
+        self._save()
+        return path
+
+    async def get_or_fetch(self, key: str, fetch):
+        """
+        Возвращает (путь, взято_из_кэша). fetch(target_dir) скачивает файл
+        во временную папку и возвращает путь к нему.
+        """
+        path = self.lookup(key)
+        if path:
+            self.hits += 1
+            return path, True
+
+        task = self._inflight.get(key)
+        if task is not None:
+            # Присоединились к уже идущей загрузке: своего скачивания нет, это не промах
+            self.joined += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._fetch(key, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        # shield: отмена одного ожидающего не должна прерывать общую загрузку
+        return await asyncio.shield(task), False
+
+    async def _fetch(self, key: str, fetch) -> str:
+        target_dir = os.path.join(self.tmp_root, f"{key}_{os.getpid()}_{int(time.time() * 1000)}")
+        os.makedirs(target_dir, exist_ok=True)
+        try:
+            downloaded = await fetch(target_dir)
+
+            entry_dir = os.path.join(self.root, key)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.makedirs(entry_dir)
+            file_name = os.path.basename(downloaded)
+            os.replace(downloaded, os.path.join(entry_dir, file_name))
+
+            self.entries[key] = {
+                'file': file_name,
+                'size': os.path.getsize(os.path.join(entry_dir, file_name)),
+                'created': time.time(),
+                'last_access': time.time()
+            }
+            self._evict(keep=key)
+            self._save()
+            return self._entry_path(key)
+        finally:
+            shutil.rmtree(target_dir, ignore_errors=True)
+
+    def _evict(self, keep: str = None):
+        """Удаляет давно не использованные записи, пока кэш не уложится в лимит"""
+        total = self.total_bytes
+        for key in sorted(self.entries, key=lambda k: self.entries[k]['last_access']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._drop(key)
+
+    def _drop(self, key: str) -> int:
+        size = self.entries.pop(key)['size']
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+        logger.info(f"Кэш: вытеснена запись {key}")
+        return size
+
+    def shrink(self, to_free: int) -> int:
+        """Вытесняет давно не использованные записи, пока не освободится to_free байт; возвращает освобожденное"""
+        self._load()
+        freed = 0
+        for key in sorted(self.entries, key=lambda k: self.entries[k]['last_access']):
+            if freed >= to_free:
+                break
+            freed += self._drop(key)
+        if freed:
+            self._save()
+        return freed
+
+    async def materialize(self, cached_path: str, dest_dir: str) -> str:
+        """Создает копию файла из кэша в папке пользователя (жесткой ссылкой, если возможно)"""
+        os.makedirs(dest_dir, exist_ok=True)
+        dest_path = os.path.join(dest_dir, os.path.basename(cached_path))
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(cached_path, dest_path)
+        except OSError:
+            await asyncio.to_thread(shutil.copy2, cached_path, dest_path)
+        return dest_path
+
+
+download_cache = DownloadCache(
+    os.getenv('DOWNLOAD_CACHE_DIR', os.path.join(DOWNLOADS_DIR, ".cache")),
+    int(os.getenv('DOWNLOAD_CACHE_MAX_MB', '20480')) * 1024 * 1024
+)
+
+
+class FileIdCache:
+    """
+    Постоянный индекс file_id, которые Telegram вернул после загрузки.
+    Ключ - ключ содержимого из кэша загрузок, внутри записи:
+    'video' - отправленное видео, 'parts' - список частей (у каждой свой file_id и миниатюра)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = None
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            logger.error(f"Не удалось прочитать индекс file_id, начинаю с пустого: {e}")
+            self.entries = {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key: str, kind: str):
+        self._load()
+        value = self.entries.get(key, {}).get(kind)
+        cache_lookups_total.inc(cache='file_id', result='hit' if value else 'miss')
+        return value
+
+    def put(self, key: str, kind: str, value):
+        self._load()
+        record = self.entries.setdefault(key, {})
+        record[kind] = value
+        record['updated'] = time.time()
+        self._save()
+
+    def invalidate(self, key: str, kind: str):
+        self._load()
+        record = self.entries.get(key)
+        if record and record.pop(kind, None) is not None:
+            if not any(k in record for k in ('video', 'parts')):
+                del self.entries[key]
+            self._save()
+            logger.info(f"file_id для {key} ({kind}) удален из индекса")
+
+    @staticmethod
+    def describe(message, caption: str):
+        """Достает из отправленного сообщения file_id видео и его миниатюры"""
+        media = message.video or message.document
+        if media is None:
+            return None
+        thumbnail = getattr(media, 'thumbnail', None)
+        return {
+            'file_id': media.file_id,
+            'thumbnail': thumbnail.file_id if thumbnail else None,
+            'caption': caption
+        }
+
+
+file_id_cache = FileIdCache(os.getenv('FILE_ID_INDEX', os.path.join(download_cache.root, 'file_ids.json')))
+metrics.counter('bot_download_cache_lookups_total',
+                "Обращения к кэшу скачанных файлов (hit/miss; joined - ожидание уже идущей загрузки)",
+                collect=lambda: {(('result', 'hit'),): download_cache.hits, (('result', 'miss'),): download_cache.misses,
+                                 (('result', 'joined'),): download_cache.joined})
+
 
+async def send_cached_video(context, chat_id: int, cache_key: str) -> bool:
+    """Отправляет видео по сохраненному file_id; при отказе Telegram удаляет запись"""
+    cached = file_id_cache.get(cache_key, 'video')
+    if not cached:
+        return False
+
+    try:
+        await scheduler.run('upload', lambda: context.bot.send_video(
+            chat_id=chat_id,
+            video=cached['file_id'],
+            caption=cached.get('caption'),
+            supports_streaming=True
+        ), owner=chat_id)
+        return True
+    except BadRequest as e:
+        logger.warning(f"Telegram отклонил сохраненный file_id: {e}")
+        file_id_cache.invalidate(cache_key, 'video')
+        return False
+
+
+async def send_cached_parts(context, chat_id: int, cache_key: str) -> tuple:
+    """
+    Отправляет ранее загруженные части по file_id; при отказе Telegram удаляет запись.
+    Возвращает (отправленные записи частей, всего частей в записи): если Telegram отклонил
+    часть N, части до нее уже у пользователя и свежая загрузка продолжается с N.
+    """
+    cached_parts = file_id_cache.get(cache_key, 'parts')
+    if not cached_parts:
+        return [], 0
+
+    delivered = []
+
+    async def send_all():
+        for part in cached_parts:
+            await context.bot.send_video(
+                chat_id=chat_id,
+                video=part['file_id'],
+                caption=part.get('caption'),
+                supports_streaming=True
+            )
+            delivered.append(part)
 
-async def download_video(user_id: int, url: str, quality: str, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await scheduler.run('upload', send_all, owner=chat_id)
+    except BadRequest as e:
+        logger.warning(f"Telegram отклонил сохраненный file_id части {len(delivered) + 1}: {e}")
+        file_id_cache.invalidate(cache_key, 'parts')
+    return delivered, len(cached_parts)
+
+
+def post_download_keyboard(job_id: int) -> InlineKeyboardMarkup:
+    """Клавиатура действий после скачивания"""
+    keyboard = [
+        [
+            InlineKeyboardButton("🎬 Отправить видео", callback_data=job_callback("action_send", job_id)),
+            InlineKeyboardButton("📁 Сохранить на сервере", callback_data=job_callback("action_move", job_id))
+        ],
+        [
+            InlineKeyboardButton("🗑️ Удалить файл", callback_data=job_callback("action_delete", job_id))
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def download_video(job_id: int, user_id: int, url: str, quality: str, context: ContextTypes.DEFAULT_TYPE,
+                         format_override: str = None, status: StatusUpdater = None):
     """Скачивание видео в фоновом режиме"""
+    def on_progress(progress):
+        if status is not None and progress.get('status') == 'downloading':
+            status.update(format_download_progress(progress))
+
     try:
         # Создаем папку для пользователя
-        user_dir = f"/home/taras/video_downloads/user_{user_id}"
+        user_dir = os.path.join(DOWNLOADS_DIR, f"user_{user_id}")
         os.makedirs(user_dir, exist_ok=True)
 
-        # ИСПРАВЛЕННЫЕ настройки качества
-        quality_presets = {
-            'best': {
-                'format': 'best[height<=1080]/best',
-                'description': 'Лучшее качество (до 1080p)'
-            },
-            '720': {
-                'format': 'best[height<=720]/best',
-                'description': 'HD качество (720p)'
-            },
-            '480': {
-                'format': 'best[height<=480]/best',
-                'description': 'Стандартное качество (480p)'
-            },
-            'audio': {
-                'format': 'bestaudio/best',
-                'description': 'Только аудио',
-                'audio_params': ['-x', '--audio-format', 'mp3', '--audio-quality', '5']
-            }
-        }
+        preset = QUALITY_PRESETS.get(quality, QUALITY_PRESETS['best'])
+        cache_key = download_cache.key_for(url, f"{quality}:{format_override}" if format_override else quality)
 
-        preset = quality_presets.get(quality, quality_presets['best'])
-        format_selection = preset['format']
+        # Выполняем скачивание в пуле загрузок (или берем готовый файл из кэша)
+        async def download(target_dir):
+            job_store.update(job_id, 'downloading')
+            try:
+                with stage_seconds.time(stage='download'):
+                    path = await download_backend.download(url, quality, target_dir, format_override, on_progress)
+            except Exception:
+                downloads_total.inc(platform=platform_label(url), result='error')
+                raise
+            downloads_total.inc(platform=platform_label(url), result='ok')
+            bytes_total.inc(os.path.getsize(path), direction='in')
+            return path
+
+        async def fetch(target_dir):
+            return await scheduler.run('download', lambda: download(target_dir), owner=user_id)
+
+        cached_path, from_cache = await download_cache.get_or_fetch(cache_key, fetch)
+        latest_file = await download_cache.materialize(cached_path, user_dir)
+        tracer.current().set(file_size=os.path.getsize(latest_file), from_cache=from_cache)
+        if status is not None:
+            await status.close("✅ Скачивание завершено")
+
+        if not job_store.update(job_id, 'downloaded', file_path=latest_file, cache_key=cache_key):
+            # Задача истекла или удалена, пока шло скачивание
+            os.remove(latest_file)
+            return
 
-        # Базовые параметры
-        cmd = [
+        file_size = os.path.getsize(latest_file) / (1024 * 1024)
+        file_name = os.path.basename(latest_file)
+
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=f"✅ Видео успешно скачано!{' ⚡ (из кэша)' if from_cache else ''}\n\n"
+                 f"📹 Файл: `{file_name}`\n"
+                 f"📊 Размер: {file_size:.2f} MB\n"
+                 f"💾 Качество: {preset['description']}\n\n"
+                 f"Выберите действие:",
+            reply_markup=post_download_keyboard(job_id),
+            parse_mode='Markdown'
+        )
+
+        # Запланировать автоматическое удаление через 1 час
+        file_reaper.schedule(latest_file, FILE_RETENTION, job_id, user_id)
+        janitor.track(latest_file)
+        return
+
+    except DownloadError as e:
+        # Улучшенная обработка ошибок
+        error_message = await parse_error_message(str(e), get_platform_name(url))
+
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=error_message
+        )
+    except FileNotFoundError:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="❌ Файл не найден после скачивания"
+        )
+    except QueueFullError:
+        await context.bot.send_message(chat_id=user_id, text=OVERLOAD_MESSAGE)
+    except subprocess.TimeoutExpired:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="❌ Таймаут скачивания (10 минут)\n\n"
+                 "Возможно, видео слишком большое или платформа ограничивает скачивание."
+        )
+    except Exception as e:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=f"❌ Неожиданная ошибка:\n`{str(e)}`\n\n"
+                 "Попробуйте другую ссылку или повторите позже.",
+            parse_mode='Markdown'
+        )
+    finally:
+        if status is not None:
+            await status.close()
+
+    # Скачивание не удалось - задача завершена
+    job_store.delete(job_id)
+
+
+# Потоковая отправка готовых для Telegram форматов: yt-dlp -> ffmpeg (remux) -> тело запроса
+STREAM_UPLOADS = os.getenv('STREAM_UPLOADS', '1') == '1'
+
+
+class StreamUploadError(Exception):
+    """Потоковая отправка не удалась (можно повторить обычным скачиванием)"""
+
+
+class StreamDeliveryUnknown(Exception):
+    """
+    Тело запроса ушло целиком, но ответа нет (таймаут, обрыв): Telegram мог уже принять видео,
+    поэтому повторная отправка грозит дублем
+    """
+
+
+def _multipart_field(boundary: str, name: str, value) -> bytes:
+    return (
+        f"--{boundary}\r\n"
+        f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+        f"{value}\r\n"
+    ).encode("utf-8")
+
+
+def _multipart_file_header(boundary: str, name: str, filename: str, content_type: str) -> bytes:
+    return (
+        f"--{boundary}\r\n"
+        f"Content-Disposition: form-data; name=\"{name}\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8")
+
+
+async def stream_video_to_chat(bot, chat_id: int, url: str, format_id: str, video_meta: dict,
+                               caption: str, limit_mb: float = TELEGRAM_UPLOAD_LIMIT_MB,
+                               on_progress=None, timeout: float = 600) -> dict:
+    """
+    Скачивает формат yt-dlp в stdout, ffmpeg перепаковывает его во фрагментированный MP4
+    (быстрый старт без второго прохода) и поток сразу уходит телом запроса sendVideo.
+    Миниатюру тот же ffmpeg вынимает из потока. На диске остается только миниатюра.
+    Возвращает объект сообщения из ответа Bot API.
+    MP4 без faststart из канала не читается - тогда ffmpeg падает и вызывающий
+    переходит к обычному скачиванию.
+    timeout - общий срок запроса (httpx ограничивает только отдельные чтения и записи).
+    Ошибки до отправки всего тела - StreamUploadError, после - StreamDeliveryUnknown.
+    """
+    work_dir = tempfile.mkdtemp(prefix="stream_")
+    thumbnail_path = os.path.join(work_dir, "thumb.jpg")
+    limit_bytes = int(limit_mb * 1024 * 1024)
+
+    read_fd, write_fd = os.pipe()
+    processes = []
+    pumps = []
+    ytdlp_errors = []
+    ffmpeg_errors = []
+    try:
+        def on_ytdlp_line(line):
+            progress = parse_ytdlp_progress(line)
+            if progress and on_progress is not None:
+                on_progress(progress)
+
+        ytdlp = await asyncio.create_subprocess_exec(
             "yt-dlp",
-            "-o", f"{user_dir}/%(title)s.%(ext)s",
-            "-f", format_selection,
+            "-o", "-",
+            "-f", format_id,
             "--no-warnings",
             "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
             "--retries", "3",
             "--fragment-retries", "3",
             "--socket-timeout", "30",
-            url
+            "--newline",
+            "--progress-template", YTDLP_PROGRESS_TEMPLATE,
+            url,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=write_fd,
+            stderr=asyncio.subprocess.PIPE
+        )
+        processes.append(ytdlp)
+
+        ffmpeg = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-i", "pipe:0",
+            # Основной выход: перепаковка без перекодирования во фрагментированный MP4
+            "-map", "0:v:0", "-map", "0:a?",
+            "-c", "copy",
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "-map_metadata", "-1",
+            "-f", "mp4", "pipe:1",
+            # Второй выход: миниатюра из того же потока
+            "-map", "0:v:0",
+            "-ss", "5",
+            "-frames:v", "1",
+            "-vf", "scale=320:-2",
+            "-q:v", "5",
+            "-y", thumbnail_path,
+            stdin=read_fd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        processes.append(ffmpeg)
+        subprocesses_active.inc(2)
+    except BaseException:
+        for process in processes:
+            await _kill_process(process)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    finally:
+        # Концы канала теперь принадлежат дочерним процессам
+        os.close(read_fd)
+        os.close(write_fd)
+
+    pumps.append(asyncio.create_task(_pump_stream(ytdlp.stderr, ytdlp_errors, on_ytdlp_line)))
+    pumps.append(asyncio.create_task(_pump_stream(ffmpeg.stderr, ffmpeg_errors)))
+
+    boundary = f"stream{os.urandom(12).hex()}"
+    stats = {'bytes': 0, 'first_byte': None, 'sent': False}
+    started_at = time.monotonic()
+
+    async def body():
+        yield _multipart_field(boundary, "chat_id", chat_id)
+        yield _multipart_field(boundary, "supports_streaming", "true")
+        for field in ('duration', 'width', 'height'):
+            if video_meta.get(field):
+                yield _multipart_field(boundary, field, int(video_meta[field]))
+        yield _multipart_file_header(boundary, "video", "video.mp4", "video/mp4")
+
+        while True:
+            chunk = await ffmpeg.stdout.read(256 * 1024)
+            if not chunk:
+                break
+            if stats['first_byte'] is None:
+                stats['first_byte'] = time.monotonic() - started_at
+            stats['bytes'] += len(chunk)
+            if stats['bytes'] > limit_bytes:
+                raise StreamUploadError(f"Поток больше лимита {limit_mb} MB")
+            yield chunk
+
+        if await ffmpeg.wait() != 0 or await ytdlp.wait() != 0:
+            raise StreamUploadError(
+                "Ошибка потоковой обработки: "
+                + b"".join(ytdlp_errors + ffmpeg_errors).decode("utf-8", errors="replace")[-500:]
+            )
+        yield b"\r\n"
+
+        caption_text = f"{caption}\n📊 {stats['bytes'] / (1024 * 1024):.1f} MB"
+        yield _multipart_field(boundary, "caption", caption_text)
+
+        # Миниатюра готова только после окончания потока, поэтому ее часть идет последней
+        if os.path.exists(thumbnail_path) and os.path.getsize(thumbnail_path) <= 200 * 1024:
+            yield _multipart_field(boundary, "thumbnail", "attach://thumb")
+            yield _multipart_file_header(boundary, "thumb", "thumb.jpg", "image/jpeg")
+            with open(thumbnail_path, 'rb') as f:
+                yield f.read()
+            yield b"\r\n"
+
+        yield f"--{boundary}--\r\n".encode("utf-8")
+        # httpx забирает следующий кусок, только отправив предыдущий
+        stats['sent'] = True
+
+    try:
+        try:
+            # Запрос идет мимо бота, поэтому очередь лимитера занимаем сами
+            await rate_limiter.acquire_upload(chat_id)
+            async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, write=300.0)) as client:
+                response = await asyncio.wait_for(client.post(
+                    f"{bot.base_url}/sendVideo",
+                    content=body(),
+                    headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}
+                ), max(1.0, timeout - (time.monotonic() - started_at)))
+            payload = response.json()
+        except (httpx.HTTPError, asyncio.TimeoutError, ValueError) as e:
+            if stats['sent']:
+                raise StreamDeliveryUnknown(f"Нет ответа на потоковую загрузку: {e!r}")
+            raise StreamUploadError(f"Ошибка соединения при потоковой загрузке: {e!r}")
+
+        if not payload.get('ok'):
+            retry_after = (payload.get('parameters') or {}).get('retry_after')
+            if retry_after:
+                # Поток не повторить: паузу учитывает лимитер, и обычная отправка после скачивания
+                # дождется ее вместо немедленного повторного 429
+                rate_limiter.pause(str(chat_id), float(retry_after))
+            raise StreamUploadError(f"Bot API отклонил потоковую загрузку: {payload.get('description')}")
+
+        bytes_total.inc(stats['bytes'], direction='in')
+        bytes_total.inc(stats['bytes'], direction='out')
+        downloads_total.inc(platform=platform_label(url), result='ok')
+        logger.info(
+            f"Потоковая отправка: {stats['bytes'] / (1024 * 1024):.1f} MB, "
+            f"первый байт через {stats['first_byte'] or 0:.1f}s, всего {time.monotonic() - started_at:.1f}s"
+        )
+        return payload['result']
+
+    finally:
+        for process in processes:
+            if process.returncode is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+        # Пока в stdout остаются непрочитанные данные, wait() не вернется
+        await ffmpeg.stdout.read()
+        for process in processes:
+            await _kill_process(process)
+        subprocesses_active.dec(2)
+        for pump in pumps:
+            pump.cancel()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+async def stream_ready_video(job_id: int, user_id: int, url: str, format_id: str,
+                             context: ContextTypes.DEFAULT_TYPE, status: StatusUpdater):
+    """Отправка формата, готового для Telegram, без промежуточных файлов; при ошибке - обычное скачивание"""
+    cache_key = download_cache.key_for(url, f"fit:{format_id}")
+    session = job_store.get(job_id) or {}
+    caption = f"📹 {session.get('title') or 'Видео'}"
+
+    async def stream():
+        job_store.update(job_id, 'downloading')
+        try:
+            with stage_seconds.time(stage='stream'):
+                # Общий срок, как у обычного скачивания: зависший yt-dlp или Bot API, принимающий
+                # тело по байту, не должны держать слот загрузки
+                return await stream_video_to_chat(
+                    context.bot, user_id, url, format_id, session.get('fit_video') or {}, caption,
+                    on_progress=on_progress, timeout=600
+                )
+        except Exception:
+            downloads_total.inc(platform=platform_label(url), result='error')
+            raise
+
+    def on_progress(progress):
+        if progress.get('status') == 'downloading':
+            text = format_download_progress(progress)
+            status.update(text.replace("⏬ Скачиваю видео...", "📤 Скачиваю и сразу отправляю..."))
+
+    try:
+        if not await send_cached_video(context, user_id, cache_key):
+            result = await scheduler.run('download', stream, owner=user_id)
+            sent = FileIdCache.describe(Message.de_json(result, context.bot), result.get('caption'))
+            if sent:
+                file_id_cache.put(cache_key, 'video', sent)
+
+        await status.close("✅ Видео успешно отправлено!")
+        job_store.delete(job_id)
+
+    except QueueFullError:
+        await status.close(OVERLOAD_MESSAGE)
+        job_store.delete(job_id)
+    except StreamDeliveryUnknown as e:
+        # Видео, возможно, уже в чате: повторная отправка после скачивания могла бы его задвоить
+        logger.error(f"Потоковая отправка без ответа, повтор не делаем: {e}")
+        await status.close(
+            "⚠️ Видео отправлено, но Telegram не подтвердил доставку.\n\n"
+            "💡 Если его нет в чате, отправьте ссылку заново."
+        )
+        job_store.delete(job_id)
+    except Exception as e:
+        logger.warning(f"Потоковая отправка не удалась, скачиваю обычным способом: {e}")
+        status.update("⏬ Скачиваю видео...")
+        await download_video(job_id, user_id, url, 'fit', context, format_id, status)
+
+
+async def parse_error_message(error: str, platform: str) -> str:
+    """Парсит и форматирует сообщения об ошибках"""
+    error_lower = error.lower()
+
+    if "private" in error_lower or "login" in error_lower:
+        return f"❌ Видео с {platform} приватное или требует авторизации\n\nДля скачивания нужен доступ к аккаунту."
+
+    elif "geo" in error_lower or "region" in error_lower or "country" in error_lower:
+        return f"❌ Видео с {platform} недоступно в вашем регионе\n\nИспользуйте VPN или попробуйте другое видео."
+
+    elif "removed" in error_lower or "deleted" in error_lower or "unavailable" in error_lower:
+        return f"❌ Видео с {platform} было удалено или недоступно"
+
+    elif "too large" in error_lower or "size" in error_lower:
+        return "❌ Файл слишком большой для скачивания\n\nПопробуйте выбрать меньшее качество."
+
+    else:
+        return f"❌ Ошибка скачивания с {platform}:\n`{error[:500]}`\n\nПопробуйте другую ссылку."
+
+
+class MediaInfo:
+    """
+    Сведения о медиафайле из одного вызова ffprobe: длительность, потоки, кодеки, битрейт.
+    Индекс пакетов и ключевых кадров читается отдельным проходом только по запросу.
+    """
+
+    def __init__(self, path: str, size: int, mtime_ns: int, probe: dict):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.streams = probe.get('streams', [])
+        self.format = probe.get('format', {})
+        self.video = next((s for s in self.streams if s.get('codec_type') == 'video'), None)
+        self.audio = next((s for s in self.streams if s.get('codec_type') == 'audio'), None)
+        self._packet_index = None
+        self._faststart = None
+
+    @property
+    def size_mb(self) -> float:
+        return self.size / (1024 * 1024)
+
+    @property
+    def duration(self) -> float:
+        duration = self.format.get('duration') or (self.video or {}).get('duration')
+        try:
+            return float(duration)
+        except (TypeError, ValueError):
+            return 0.0
+
+    @property
+    def width(self) -> int:
+        return int((self.video or {}).get('width') or 0)
+
+    @property
+    def height(self) -> int:
+        return int((self.video or {}).get('height') or 0)
+
+    @property
+    def video_codec(self):
+        return self.video.get('codec_name') if self.video else None
+
+    @property
+    def audio_codec(self):
+        return self.audio.get('codec_name') if self.audio else None
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio is not None
+
+    @property
+    def bitrate_kbps(self) -> float:
+        """Общий битрейт файла; если контейнер его не указал - по размеру и длительности"""
+        bitrate = int(self.format.get('bit_rate') or 0) / 1000
+        if not bitrate and self.duration:
+            bitrate = self.size * 8 / self.duration / 1000
+        return bitrate
+
+    @property
+    def format_names(self) -> set:
+        return set(self.format.get('format_name', '').split(','))
+
+    @property
+    def audio_offset(self) -> float:
+        """Насколько звук начинается позже видео (секунды; меньше нуля - раньше)"""
+        try:
+            return float(self.audio['start_time']) - float(self.video['start_time'])
+        except (TypeError, KeyError, ValueError):
+            return 0.0
+
+    def estimate_parts(self, max_size_mb: float) -> int:
+        """Примерное число частей при разделении (с тем же запасом на заголовки, что и split_large_file)"""
+        return max(1, -(-self.size // int(max_size_mb * 1024 * 1024 * 0.95)))
+
+    @property
+    def faststart(self) -> bool:
+        """Атом moov стоит в начале файла (для не-MP4 контейнеров всегда False)"""
+        if self._faststart is None:
+            self._faststart = 'mp4' in self.format_names and is_faststart_mp4(self.path)
+        return self._faststart
+
+    def video_meta(self) -> dict:
+        """Параметры для send_video, чтобы Telegram сразу показал правильные пропорции и длительность"""
+        meta = {'duration': int(self.duration), 'width': self.width, 'height': self.height}
+        return {key: value for key, value in meta.items() if value}
+
+    async def packet_index(self):
+        """(packets, keyframes) из probe_packets; хранится до release_packet_index"""
+        if self._packet_index is None:
+            self._packet_index = await probe_packets(self.path)
+        return self._packet_index
+
+    def release_packet_index(self):
+        """
+        Освобождает индекс пакетов: у длинного видео это сотни тысяч записей, а MediaInfo
+        живет в _media_info_cache. Вызывается, когда разделение или кодирование его прочитали
+        """
+        self._packet_index = None
+
+
+MEDIA_INFO_CACHE_SIZE = 64
+_media_info_cache = collections.OrderedDict()
+_media_info_inflight = {}
+
+
+async def probe_media(path: str) -> MediaInfo:
+    """
+    MediaInfo файла: из кэша, если у файла не изменились mtime и размер,
+    иначе одним вызовом ffprobe. Одновременные запросы одного файла ждут один вызов.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+
+    cached = _media_info_cache.get(path)
+    if cached is not None and (cached.mtime_ns, cached.size) == key[1:]:
+        _media_info_cache.move_to_end(path)
+        cache_lookups_total.inc(cache='probe', result='hit')
+        return cached
+    cache_lookups_total.inc(cache='probe', result='miss')
+
+    task = _media_info_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_probe_media(*key))
+        _media_info_inflight[key] = task
+        task.add_done_callback(lambda _: _media_info_inflight.pop(key, None))
+
+    # shield: отмена одного ожидающего не должна прерывать общий вызов ffprobe
+    return await asyncio.shield(task)
+
+
+@timed('probe')
+async def _probe_media(path: str, mtime_ns: int, size: int) -> MediaInfo:
+    result = await run_process([
+        "ffprobe", "-v", "quiet", "-print_format", "json",
+        "-show_format", "-show_streams", path
+    ], timeout=60)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe не смог прочитать файл: {result.stderr[-500:]}")
+
+    info = MediaInfo(path, size, mtime_ns, json.loads(result.stdout))
+    _media_info_cache[path] = info
+    _media_info_cache.move_to_end(path)
+    while len(_media_info_cache) > MEDIA_INFO_CACHE_SIZE:
+        _media_info_cache.popitem(last=False)
+    return info
+
+
+# Режим перекодирования: 'single' - один процесс ffmpeg, 'parallel' - куски по GOP параллельно
+TRANSCODE_MODE = os.getenv('TRANSCODE_MODE', 'parallel')
+# Короткие видео быстрее кодировать целиком, чем резать и склеивать
+PARALLEL_MIN_DURATION = float(os.getenv('PARALLEL_MIN_DURATION', '120'))
+PARALLEL_THREADS_PER_JOB = 2
+PARALLEL_TRANSCODE_JOBS = int(os.getenv(
+    'PARALLEL_TRANSCODE_JOBS', str(max(2, (os.cpu_count() or 2) // PARALLEL_THREADS_PER_JOB))
+))
+# Общий на весь процесс лимит процессов кодирования кусков: одновременные задачи пула 'transcode'
+# делят его, а не запускают по PARALLEL_TRANSCODE_JOBS процессов каждая
+parallel_encode_slots = asyncio.Semaphore(PARALLEL_TRANSCODE_JOBS)
+
+# Управление битрейтом при кодировании под размер: 'capped_crf' (совместим с параллельным
+# режимом) или 'two_pass' (двухпроходное кодирование одним процессом)
+TARGET_RATE_CONTROL = os.getenv('TARGET_RATE_CONTROL', 'capped_crf')
+
+
+def telegram_audio_args(bitrate: str = "128k") -> list:
+    """Параметры аудио для Telegram"""
+    return [
+        "-c:a", "aac",  # Аудио кодек
+        "-b:a", bitrate,  # Аудио битрейт
+        "-ac", "2"  # Стерео звук
+    ]
+
+
+TELEGRAM_AUDIO_ARGS = telegram_audio_args()
+
+
+def plan_target_bitrate(duration: float, target_size_mb: float, has_audio: bool):
+    """
+    Рассчитывает битрейты, при которых файл длительностью duration поместится в target_size_mb.
+    Возвращает dict с video_kbps, audio_kbps и height или None, если уложиться нельзя.
+    """
+    if duration <= 0:
+        return None
+
+    # ~4% оставляем на контейнер и погрешность контроля битрейта
+    budget_kbps = target_size_mb * 1024 * 1024 * 8 / 1000 / duration * 0.96
+    if not has_audio:
+        audio_kbps = 0
+    elif budget_kbps >= 1000:
+        audio_kbps = 128
+    elif budget_kbps >= 400:
+        audio_kbps = 96
+    else:
+        audio_kbps = 64
+
+    video_kbps = int(budget_kbps - audio_kbps)
+    if video_kbps < 100:
+        return None
+
+    # Больше обычного максимума не нужно, а на малых битрейтах меньшее разрешение выглядит лучше
+    video_kbps = min(video_kbps, 2500)
+    if video_kbps >= 1500:
+        height = 720
+    elif video_kbps >= 600:
+        height = 480
+    else:
+        height = 360
+
+    return {'video_kbps': video_kbps, 'audio_kbps': audio_kbps, 'height': height}
+
+
+def telegram_video_args(target_height: int, max_bitrate: str = "2500k", buffer_size: str = "5000k") -> list:
+    """Параметры видео для Telegram, общие для обычного и параллельного кодирования"""
+    return [
+        "-c:v", "libx264",  # Кодек H.264
+        "-preset", "medium",  # Баланс скорость/качество
+        "-crf", "23",  # Качество (23 - хороший баланс)
+        "-maxrate", max_bitrate,  # Максимальный битрейт
+        "-bufsize", buffer_size,  # Размер буфера
+        "-vf", f"scale=-2:{target_height}"  # Масштабирование по высоте
+    ]
+
+
+async def encode_single(input_path: str, output_path: str, video_args: list, duration: float,
+                        on_progress=None, audio_args: list = None) -> bool:
+    """Кодирование одним процессом ffmpeg"""
+    cmd = [
+        "ffmpeg", "-i", input_path,
+        *video_args,
+        *(audio_args or TELEGRAM_AUDIO_ARGS),
+        "-movflags", "+faststart",  # Быстрый старт для стриминга
+        "-map_metadata", "-1",  # Удаляем метаданные
+        "-progress", "pipe:1", "-nostats",  # Прогресс построчно в stdout
+        "-y",  # Перезаписать выходной файл
+        output_path
+    ]
+
+    result = await run_process(
+        cmd, timeout=600,
+        on_stdout=FfmpegProgress(duration, on_progress) if on_progress else None
+    )
+    if result.returncode != 0:
+        logger.error(f"Ошибка оптимизации: {result.stderr}")
+    return result.returncode == 0
+
+
+def plan_chunk_boundaries(keyframes: list, duration: float, chunks: int, min_chunk: float = 10.0) -> list:
+    """Границы кусков для параллельного кодирования: ключевые кадры ближе всего к равным долям"""
+    boundaries = []
+    for i in range(1, chunks):
+        target = duration * i / chunks
+        index = bisect.bisect_left(keyframes, target)
+        candidates = keyframes[max(0, index - 1):index + 1]
+        if not candidates:
+            continue
+        keyframe = min(candidates, key=lambda k: abs(k - target))
+        previous = boundaries[-1] if boundaries else 0.0
+        if keyframe - previous >= min_chunk and duration - keyframe >= min_chunk:
+            boundaries.append(keyframe)
+    return boundaries
+
+
+async def encode_parallel(input_path: str, output_path: str, video_args: list, duration: float,
+                          has_audio: bool, on_progress=None, audio_args: list = None) -> bool:
+    """
+    Параллельное кодирование:
+    - видео режется копированием потока на куски по границам GOP
+    - куски и аудиодорожка кодируются одновременно (не больше PARALLEL_TRANSCODE_JOBS процессов)
+    - результат склеивается concat demuxer без перекодирования
+    Куски начинаются с нуля (matroska, без стартового сдвига mpegts), а звук сдвигается на
+    исходную разницу начала звука и видео, поэтому ненулевой start_time источника не сбивает синхронность.
+    """
+    media = await probe_media(input_path)
+    _, keyframes = await media.packet_index()
+    media.release_packet_index()
+    boundaries = plan_chunk_boundaries(keyframes, duration, PARALLEL_TRANSCODE_JOBS)
+    if not boundaries:
+        return await encode_single(input_path, output_path, video_args, duration, on_progress, audio_args)
+
+    work_dir = f"{output_path}_chunks"
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        split_cmd = [
+            "ffmpeg", "-i", input_path,
+            "-map", "0:v:0", "-an",
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_times", ",".join(f"{t:.6f}" for t in boundaries),
+            "-segment_format", "matroska",
+            "-reset_timestamps", "1",
+            "-y", f"{work_dir}/src_%03d.mkv"
         ]
+        result = await run_process(split_cmd, timeout=600)
+        if result.returncode != 0:
+            logger.error(f"Ошибка нарезки на куски: {result.stderr[-500:]}")
+            return False
 
-        # Добавляем параметры для аудио если нужно
-        if quality == 'audio' and 'audio_params' in preset:
-            cmd.extend(preset['audio_params'])
-
-        logger.info(f"Скачивание с параметрами: {' '.join(cmd)}")
-
-        # Выполняем скачивание
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
-
-        if result.returncode == 0:
-            # Ищем скачанный файл
-            files = os.listdir(user_dir)
-            if files:
-                latest_file = max([os.path.join(user_dir, f) for f in files], key=os.path.getctime)
+        sources = sorted(f for f in os.listdir(work_dir) if f.startswith("src_"))
+        starts = [0.0] + boundaries
+        ends = boundaries + [duration]
+        chunk_progress = [0.0] * len(sources)
+
+        def report(index, fraction):
+            chunk_progress[index] = fraction
+            done = sum(p * (ends[i] - starts[i]) for i, p in enumerate(chunk_progress) if i < len(starts))
+            on_progress(done / duration)
+
+        async def encode_chunk(index, source):
+            async with parallel_encode_slots:
+                cmd = [
+                    "ffmpeg", "-i", os.path.join(work_dir, source),
+                    *video_args,
+                    "-an",
+                    "-threads", str(PARALLEL_THREADS_PER_JOB),
+                    "-progress", "pipe:1", "-nostats",
+                    "-f", "matroska",
+                    "-y", os.path.join(work_dir, f"enc_{index:03d}.mkv")
+                ]
+                chunk_duration = ends[index] - starts[index] if index < len(starts) else 0
+                return await run_process(
+                    cmd, timeout=600,
+                    on_stdout=FfmpegProgress(chunk_duration, lambda f: report(index, f)) if on_progress else None
+                )
 
-                user_data[user_id]['file_path'] = latest_file
-                user_data[user_id]['step'] = 'downloaded'
+        async def encode_audio():
+            async with parallel_encode_slots:
+                cmd = [
+                    # Звук до первого кадра видео отрезается: склеенное видео начинается с его начала
+                    "ffmpeg", *(["-ss", f"{-audio_offset:.6f}"] if audio_offset < 0 else []), "-i", input_path,
+                    "-vn", *(audio_args or TELEGRAM_AUDIO_ARGS),
+                    "-y", os.path.join(work_dir, "audio.m4a")
+                ]
+                return await run_process(cmd, timeout=600)
 
-                file_size = os.path.getsize(latest_file) / (1024 * 1024)
-                file_name = os.path.basename(latest_file)
+        audio_offset = media.audio_offset
+        jobs = [encode_chunk(i, source) for i, source in enumerate(sources)]
+        if has_audio:
+            jobs.append(encode_audio())
+        results = await asyncio.gather(*jobs)
 
-                # Клавиатура действий после скачивания
-                keyboard = [
-                    [
-                        InlineKeyboardButton("🎬 Отправить видео", callback_data="action_send"),
-                        InlineKeyboardButton("📁 Сохранить на сервере", callback_data="action_move")
-                    ],
-                    [
-                        InlineKeyboardButton("🗑️ Удалить файл", callback_data="action_delete")
-                    ]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+        failed = [r for r in results if r.returncode != 0]
+        if failed:
+            logger.error(f"Ошибка параллельного кодирования: {failed[0].stderr[-500:]}")
+            return False
 
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"✅ Видео успешно скачано!\n\n"
-                         f"📹 Файл: `{file_name}`\n"
-                         f"📊 Размер: {file_size:.2f} MB\n"
-                         f"💾 Качество: {preset['description']}\n\n"
-                         f"Выберите действие:",
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
+        list_path = os.path.join(work_dir, "chunks.txt")
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for index in range(len(sources)):
+                chunk_path = os.path.join(work_dir, f"enc_{index:03d}.mkv").replace("'", "'\\''")
+                f.write(f"file '{chunk_path}'\n")
+
+        concat_cmd = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", list_path]
+        if has_audio:
+            if audio_offset > 0:
+                concat_cmd += ["-itsoffset", f"{audio_offset:.6f}"]
+            concat_cmd += ["-i", os.path.join(work_dir, "audio.m4a"), "-map", "0:v", "-map", "1:a"]
+        concat_cmd += [
+            "-c", "copy",
+            "-movflags", "+faststart",
+            "-map_metadata", "-1",
+            "-y", output_path
+        ]
+        result = await run_process(concat_cmd, timeout=600)
+        if result.returncode != 0:
+            logger.error(f"Ошибка склейки кусков: {result.stderr[-500:]}")
+        return result.returncode == 0
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+async def encode_two_pass(input_path: str, output_path: str, target_height: int, video_kbps: int,
+                          duration: float, on_progress=None, audio_args: list = None) -> bool:
+    """Двухпроходное кодирование с заданным средним битрейтом видео"""
+    passlog = f"{output_path}_2pass"
+    video_args = [
+        "-c:v", "libx264",
+        "-preset", "medium",
+        "-b:v", f"{video_kbps}k",
+        "-maxrate", f"{int(video_kbps * 1.5)}k",
+        "-bufsize", f"{video_kbps * 2}k",
+        "-vf", f"scale=-2:{target_height}",
+        "-passlogfile", passlog
+    ]
 
-                # Запланировать автоматическое удаление через 1 час
-                asyncio.create_task(schedule_file_deletion(user_id, latest_file, 3600))
-            else:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="❌ Файл не найден после скачивания"
-                )
-        else:
-            error_msg = result.stderr if result.stderr else "Неизвестная ошибка"
+    def pass_progress(offset):
+        if on_progress is None:
+            return None
+        return FfmpegProgress(duration, lambda f: on_progress(offset + f / 2))
 
-            # Улучшенная обработка ошибок
-            error_message = await parse_error_message(error_msg, user_data[user_id]['platform'])
+    try:
+        first_pass = [
+            "ffmpeg", "-i", input_path, *video_args, "-pass", "1", "-an",
+            "-progress", "pipe:1", "-nostats", "-f", "null", "-y", os.devnull
+        ]
+        result = await run_process(first_pass, timeout=600, on_stdout=pass_progress(0.0))
+        if result.returncode != 0:
+            logger.error(f"Ошибка первого прохода: {result.stderr[-500:]}")
+            return False
 
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=error_message
-            )
+        second_pass = [
+            "ffmpeg", "-i", input_path, *video_args, "-pass", "2",
+            *(audio_args or TELEGRAM_AUDIO_ARGS),
+            "-movflags", "+faststart",
+            "-map_metadata", "-1",
+            "-progress", "pipe:1", "-nostats",
+            "-y", output_path
+        ]
+        result = await run_process(second_pass, timeout=600, on_stdout=pass_progress(0.5))
+        if result.returncode != 0:
+            logger.error(f"Ошибка второго прохода: {result.stderr[-500:]}")
+        return result.returncode == 0
+
+    finally:
+        for suffix in ("-0.log", "-0.log.mbtree"):
+            if os.path.exists(passlog + suffix):
+                os.remove(passlog + suffix)
+
+
+async def encode_video(input_path: str, output_path: str, video_args: list, duration: float,
+                       has_audio: bool, mode: str = None, on_progress=None, audio_args: list = None) -> bool:
+    """Кодирует видео для Telegram в выбранном режиме ('single' или 'parallel')"""
+    mode = mode or TRANSCODE_MODE
+    if mode == 'parallel' and duration >= PARALLEL_MIN_DURATION and PARALLEL_TRANSCODE_JOBS > 1:
+        try:
+            if await encode_parallel(input_path, output_path, video_args, duration, has_audio,
+                                     on_progress, audio_args):
+                return True
+            logger.warning("Параллельное кодирование не удалось, кодирую одним процессом")
+        except Exception as e:
+            logger.warning(f"Параллельное кодирование не удалось, кодирую одним процессом: {e}")
+    return await encode_single(input_path, output_path, video_args, duration, on_progress, audio_args)
 
-    except subprocess.TimeoutExpired:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="❌ Таймаут скачивания (10 минут)\n\n"
-                 "Возможно, видео слишком большое или платформа ограничивает скачивание."
-        )
-    except Exception as e:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"❌ Неожиданная ошибка:\n`{str(e)}`\n\n"
-                 "Попробуйте другую ссылку или повторите позже.",
-            parse_mode='Markdown'
-        )
 
+# Кодеки, которые Telegram воспроизводит во встроенном плеере
+TELEGRAM_VIDEO_CODECS = {'h264'}
+TELEGRAM_AUDIO_CODECS = {'aac'}
+TELEGRAM_PIX_FMTS = {'yuv420p', 'yuvj420p'}
+# Во сколько раз битрейт может превысить порог 2500k, чтобы файл отправлялся без перекодирования
+REMUX_BITRATE_TOLERANCE = float(os.getenv('REMUX_BITRATE_TOLERANCE', '1.5'))
 
-async def parse_error_message(error: str, platform: str) -> str:
-    """Парсит и форматирует сообщения об ошибках"""
-    error_lower = error.lower()
+# Сколько раз выбран каждый способ подготовки файла ('skip', 'remux', 'audio', 'encode')
+optimization_paths = collections.Counter()
+metrics.counter('bot_optimization_paths_total', "Выбранные пути подготовки видео (skip/remux/audio/encode)",
+                collect=lambda: {(('path', path),): count for path, count in optimization_paths.items()})
 
-    if "private" in error_lower or "login" in error_lower:
-        return f"❌ Видео с {platform} приватное или требует авторизации\n\nДля скачивания нужен доступ к аккаунту."
 
-    elif "geo" in error_lower or "region" in error_lower or "country" in error_lower:
-        return f"❌ Видео с {platform} недоступно в вашем регионе\n\nИспользуйте VPN или попробуйте другое видео."
+def is_faststart_mp4(path: str) -> bool:
+    """Проверяет по заголовкам атомов верхнего уровня, что moov идет раньше mdat"""
+    try:
+        with open(path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            position = 0
+            # Каждый атом сдвигает позицию минимум на размер заголовка, поэтому цикл конечен
+            while position + 8 <= file_size:
+                f.seek(position)
+                size, box_type = struct.unpack('>I4s', f.read(8))
+                if box_type == b'moov':
+                    return True
+                if box_type == b'mdat':
+                    return False
+                if size == 1:
+                    size = struct.unpack('>Q', f.read(8))[0]
+                    if size < 16:
+                        return False  # 64-битный размер меньше своего заголовка - файл поврежден
+                elif size < 8:
+                    return False  # 0 - атом до конца файла, 2..7 - поврежденный заголовок
+                position += size
+            return False
+    except (OSError, struct.error):
+        return False
 
-    elif "removed" in error_lower or "deleted" in error_lower or "unavailable" in error_lower:
-        return f"❌ Видео с {platform} было удалено или недоступно"
 
-    elif "too large" in error_lower or "size" in error_lower:
-        return "❌ Файл слишком большой для скачивания\n\nПопробуйте выбрать меньшее качество."
+def plan_optimization(media: MediaInfo, target_size_mb: float = None) -> str:
+    """
+    Выбирает самый дешевый способ подготовить файл для Telegram:
+    'skip' - файл уже подходит как есть
+    'remux' - только перепаковка в MP4 с moov в начале (-c copy -movflags +faststart)
+    'audio' - видео копируется, перекодируется только аудио
+    'encode' - полное перекодирование
+    """
+    limit_mb = target_size_mb or TELEGRAM_UPLOAD_LIMIT_MB
+    video_ok = (
+        media.video_codec in TELEGRAM_VIDEO_CODECS
+        and media.video.get('pix_fmt', 'yuv420p') in TELEGRAM_PIX_FMTS
+        and media.height <= 720
+    )
+    if not video_ok or media.size_mb > limit_mb or media.bitrate_kbps > 2500 * REMUX_BITRATE_TOLERANCE:
+        return 'encode'
+
+    if media.has_audio and media.audio_codec not in TELEGRAM_AUDIO_CODECS:
+        return 'audio'
+
+    if media.faststart and len(media.streams) <= (2 if media.has_audio else 1):
+        return 'skip'
+    return 'remux'
+
+
+async def remux_for_telegram(input_path: str, output_path: str, duration: float, transcode_audio: bool,
+                             on_progress=None) -> bool:
+    """Перепаковка в MP4 с быстрым стартом без перекодирования видео (аудио - по необходимости)"""
+    cmd = [
+        "ffmpeg", "-i", input_path,
+        "-map", "0:v:0", "-map", "0:a:0?",  # Лишние дорожки и субтитры Telegram не нужны
+        "-c:v", "copy",
+        *(TELEGRAM_AUDIO_ARGS if transcode_audio else ["-c:a", "copy"]),
+        "-movflags", "+faststart",
+        "-map_metadata", "-1",
+        "-progress", "pipe:1", "-nostats",
+        "-y", output_path
+    ]
 
-    else:
-        return f"❌ Ошибка скачивания с {platform}:\n`{error[:500]}`\n\nПопробуйте другую ссылку."
+    result = await run_process(
+        cmd, timeout=600,
+        on_stdout=FfmpegProgress(duration, on_progress) if on_progress else None
+    )
+    if result.returncode != 0:
+        logger.error(f"Ошибка перепаковки: {result.stderr[-500:]}")
+    return result.returncode == 0
 
 
-async def optimize_video_for_telegram(input_path: str, output_path: str = None) -> str:
+@timed('optimize')
+async def optimize_video_for_telegram(input_path: str, output_path: str = None, on_progress=None,
+                                      mode: str = None, target_size_mb: float = None) -> str:
     """
     Оптимизирует видео для отправки в Telegram:
     - Сжимает до 720p
     - Уменьшает битрейт
     - Конвертирует в оптимальный формат
     - Удаляет метаданные
+    С target_size_mb битрейт рассчитывается так, чтобы результат гарантированно
+    поместился в заданный размер за одно кодирование.
     """
     if output_path is None:
         output_path = f"{input_path}_optimized.mp4"
 
     try:
-        # Получаем информацию о исходном видео
-        probe_cmd = [
-            "ffprobe", "-v", "quiet", "-print_format", "json",
-            "-show_format", "-show_streams", input_path
-        ]
-
-        result = subprocess.run(probe_cmd, capture_output=True, text=True)
-        video_info = json.loads(result.stdout)
+        # Получаем информацию о исходном видео (общий кэш ffprobe для всех этапов)
+        media = await probe_media(input_path)
 
-        # Находим видео поток
-        video_stream = next((s for s in video_info['streams'] if s['codec_type'] == 'video'), None)
-
-        if not video_stream:
+        if not media.video:
             return input_path  # Не смогли проанализировать, возвращаем оригинал
 
-        original_height = int(video_stream.get('height', 1080))
-        original_bitrate = int(video_info['format'].get('bit_rate', 0)) / 1000  # kbps
+        original_height = media.height or 1080
+        original_bitrate = media.bitrate_kbps  # kbps
 
         # Настройки оптимизации для Telegram
         target_height = min(720, original_height)  # Максимум 720p
@@ -371,41 +3365,65 @@ async def optimize_video_for_telegram(input_path: str, output_path: str = None)
         max_bitrate = "2500k"  # Максимальный битрейт
         buffer_size = "5000k"  # Размер буфера
 
-        # Если оригинальное видео уже меньше наших целевых параметров, не оптимизируем
-        if original_height <= 720 and (original_bitrate <= 2500 or original_bitrate == 0):
+        duration = media.duration
+        has_audio = media.has_audio
+
+        # Кодеки и размер уже подходят - обходимся без перекодирования видео
+        path = plan_optimization(media, target_size_mb)
+        optimization_paths[path] += 1
+        tracer.current().set(path=path, size=media.size, height=media.height, video_codec=media.video_codec,
+                             audio_codec=media.audio_codec, bitrate_kbps=round(media.bitrate_kbps),
+                             target_size_mb=target_size_mb, mode=mode or TRANSCODE_MODE)
+        if path == 'skip':
             logger.info("Видео уже оптимизировано, пропускаем сжатие")
             return input_path
 
-        logger.info(f"Оптимизируем видео: {original_height}p -> {target_height}p, битрейт ~{target_bitrate}")
+        if path in ('remux', 'audio'):
+            logger.info(f"Перепаковка без перекодирования видео ({media.video_codec}/{media.audio_codec}, "
+                        f"{original_bitrate:.0f}k, {'аудио в AAC' if path == 'audio' else 'faststart'})")
+            if await remux_for_telegram(input_path, output_path, duration, path == 'audio', on_progress):
+                compression_ratios.observe(os.path.getsize(output_path) / media.size, path=path)
+                return output_path
+            # Перепаковка не удалась - остается полное перекодирование
+            optimization_paths['encode'] += 1
 
-        # Команда для оптимизации
-        cmd = [
-            "ffmpeg", "-i", input_path,
-            "-c:v", "libx264",  # Кодек H.264
-            "-preset", "medium",  # Баланс скорость/качество
-            "-crf", "23",  # Качество (23 - хороший баланс)
-            "-maxrate", max_bitrate,  # Максимальный битрейт
-            "-bufsize", buffer_size,  # Размер буфера
-            "-vf", f"scale=-2:{target_height}",  # Масштабирование по высоте
-            "-c:a", "aac",  # Аудио кодек
-            "-b:a", "128k",  # Аудио битрейт
-            "-ac", "2",  # Стерео звук
-            "-movflags", "+faststart",  # Быстрый старт для стриминга
-            "-map_metadata", "-1",  # Удаляем метаданные
-            "-y",  # Перезаписать выходной файл
-            output_path
-        ]
+        plan = plan_target_bitrate(duration, target_size_mb, has_audio) if target_size_mb else None
 
         # Выполняем оптимизацию
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+        if plan is None:
+            logger.info(f"Оптимизируем видео: {original_height}p -> {target_height}p, битрейт ~{target_bitrate}")
+            success = await encode_video(
+                input_path, output_path,
+                telegram_video_args(target_height, max_bitrate, buffer_size),
+                duration, has_audio, mode=mode, on_progress=on_progress
+            )
+        else:
+            target_height = min(plan['height'], original_height)
+            video_kbps = plan['video_kbps']
+            audio_args = telegram_audio_args(f"{plan['audio_kbps']}k")
+            logger.info(f"Кодирование под размер {target_size_mb} MB: {original_height}p -> {target_height}p, "
+                        f"видео {video_kbps}k, аудио {plan['audio_kbps']}k ({TARGET_RATE_CONTROL})")
+
+            if TARGET_RATE_CONTROL == 'two_pass':
+                success = await encode_two_pass(
+                    input_path, output_path, target_height, video_kbps, duration, on_progress, audio_args
+                )
+            else:
+                # CRF с жестким ограничением VBV: bufsize = maxrate не дает среднему битрейту выйти за лимит
+                success = await encode_video(
+                    input_path, output_path,
+                    telegram_video_args(target_height, f"{video_kbps}k", f"{video_kbps}k"),
+                    duration, has_audio, mode=mode, on_progress=on_progress, audio_args=audio_args
+                )
 
-        if result.returncode == 0 and os.path.exists(output_path):
-            original_size = os.path.getsize(input_path) / (1024 * 1024)
+        if success and os.path.exists(output_path):
+            original_size = media.size_mb
             optimized_size = os.path.getsize(output_path) / (1024 * 1024)
-            compression_ratio = (1 - optimized_size / original_size) * 100
+            compression_ratios.observe(optimized_size / original_size, path='encode')
 
             logger.info(
-                f"Оптимизация завершена: {original_size:.1f}MB -> {optimized_size:.1f}MB ({compression_ratio:.1f}% сжатия)")
+                f"Оптимизация завершена: {original_size:.1f}MB -> {optimized_size:.1f}MB "
+                f"({(1 - optimized_size / original_size) * 100:.1f}% сжатия)")
 
             # Если оптимизированный файл стал больше, возвращаем оригинал
             if optimized_size >= original_size:
@@ -414,7 +3432,6 @@ async def optimize_video_for_telegram(input_path: str, output_path: str = None)
 
             return output_path
         else:
-            logger.error(f"Ошибка оптимизации: {result.stderr}")
             return input_path
 
     except Exception as e:
@@ -422,20 +3439,26 @@ async def optimize_video_for_telegram(input_path: str, output_path: str = None)
         return input_path
 
 
-async def create_thumbnail(video_path: str) -> str:
+@timed('thumbnail')
+async def create_thumbnail(video_path: str, media: MediaInfo = None) -> str:
     """Создает миниатюру для видео"""
     try:
         thumbnail_path = f"{video_path}_thumb.jpg"
 
+        # Берем кадр на 5-й секунде, а у коротких роликов - ближе к началу
+        position = 5.0
+        if media is not None and media.duration:
+            position = min(position, media.duration / 3)
+
         cmd = [
-            "ffmpeg", "-i", video_path,
-            "-ss", "00:00:05",  # Берем кадр на 5-й секунде
+            "ffmpeg", "-ss", f"{position:.3f}",
+            "-i", video_path,
             "-vframes", "1",  # Только один кадр
             "-q:v", "2",  # Качество JPEG
             thumbnail_path
         ]
 
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        result = await run_process(cmd, timeout=30)
 
         if result.returncode == 0 and os.path.exists(thumbnail_path):
             # Проверяем размер миниатюры (Telegram limit 200KB)
@@ -447,7 +3470,7 @@ async def create_thumbnail(video_path: str) -> str:
                     "-q:v", "5",  # Более сильное сжатие
                     f"{thumbnail_path}_compressed.jpg"
                 ]
-                subprocess.run(cmd_compress, capture_output=True, timeout=10)
+                await run_process(cmd_compress, timeout=10)
                 os.replace(f"{thumbnail_path}_compressed.jpg", thumbnail_path)
 
             return thumbnail_path
@@ -458,20 +3481,53 @@ async def create_thumbnail(video_path: str) -> str:
     return None
 
 
-async def handle_send_action(query, context, user_id, file_path):
+async def handle_send_action(query, context, user_id, file_path, job_id):
     """Обработка отправки файла как видео с оптимизацией"""
     try:
         original_size = os.path.getsize(file_path) / (1024 * 1024)  # MB
 
-        # Реальные лимиты Telegram для ботов
-        if original_size > 45:
-            await handle_large_file(query, context, user_id, file_path, original_size)
+        # Это видео уже отправлялось - пересылаем по file_id без повторной загрузки
+        cache_key = (job_store.get(job_id) or {}).get('cache_key')
+        if cache_key and await send_cached_video(context, user_id, cache_key):
+            await query.edit_message_text("✅ Видео успешно отправлено! ⚡ (без повторной загрузки)")
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            job_store.delete(job_id)
+            return
+
+        # Лимит отправки зависит от сервера Bot API
+        if original_size > TELEGRAM_UPLOAD_LIMIT_MB:
+            await handle_large_file(query, context, user_id, file_path, original_size, job_id)
             return
 
-        await query.edit_message_text("🔄 Оптимизирую видео для Telegram...")
+        try:
+            plan = plan_optimization(await probe_media(file_path))
+        except Exception as e:
+            # Без параметров файла выбор пути не делаем: как раньше, решает optimize_video_for_telegram,
+            # который при нечитаемом файле отдает оригинал
+            logger.warning(f"Не удалось прочитать параметры видео: {e}")
+            plan = None
+
+        if plan == 'skip':
+            # Кодеки, контейнер и битрейт уже подходят Telegram - очередь кодирования не нужна
+            optimization_paths['skip'] += 1
+            optimized_path = file_path
+        else:
+            await query.edit_message_text("🔄 Оптимизирую видео для Telegram...")
 
-        # Оптимизируем видео
-        optimized_path = await optimize_video_for_telegram(file_path)
+            # Оптимизируем видео
+            status = StatusUpdater(query.edit_message_text, chat_id=user_id)
+            try:
+                optimized_path = await scheduler.run(
+                    'transcode',
+                    lambda: optimize_video_for_telegram(
+                        file_path, on_progress=progress_reporter(status, "🔄 Оптимизирую видео для Telegram...")
+                    ),
+                    on_queued=queue_notifier(query, "оптимизацию"),
+                    owner=user_id
+                )
+            finally:
+                await status.close()
         optimized_size = os.path.getsize(optimized_path) / (
                     1024 * 1024) if optimized_path != file_path else original_size
 
@@ -479,23 +3535,42 @@ async def handle_send_action(query, context, user_id, file_path):
             await query.edit_message_text(
                 f"✅ Видео оптимизировано: {original_size:.1f}MB → {optimized_size:.1f}MB\n🎬 Отправляю...")
 
+        # Параметры файла для миниатюры и send_video (после оптимизации уже в кэше)
+        try:
+            media = await probe_media(optimized_path)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать параметры видео: {e}")
+            media = None
+
         # Создаем миниатюру
-        thumbnail_path = await create_thumbnail(optimized_path)
+        thumbnail_path = await create_thumbnail(optimized_path, media)
 
+        keep_file = False
         try:
             # Пытаемся отправить как видео
-            with open(optimized_path, 'rb') as video_file:
-                await context.bot.send_video(
+            caption = (f"📹 {os.path.basename(file_path)}\n"
+                       f"📊 {optimized_size:.1f} MB{' (оптимизировано)' if optimized_path != file_path else ''}")
+
+            async def upload():
+                return await upload_with_retry(optimized_path, lambda video_file: context.bot.send_video(
                     chat_id=user_id,
                     video=video_file,
-                    caption=f"📹 {os.path.basename(file_path)}\n"
-                            f"📊 {optimized_size:.1f} MB{' (оптимизировано)' if optimized_path != file_path else ''}",
+                    caption=caption,
                     thumbnail=thumbnail_path,
                     supports_streaming=True,
-                    read_timeout=60,
-                    write_timeout=60,
-                    connect_timeout=60
-                )
+                    read_timeout=UPLOAD_TIMEOUT,
+                    write_timeout=UPLOAD_TIMEOUT,
+                    connect_timeout=60,
+                    **(media.video_meta() if media else {})
+                ))
+
+            message = await scheduler.run('upload', upload, on_queued=queue_notifier(query, "отправку"),
+                                          owner=user_id)
+
+            # Запоминаем file_id, чтобы повторные запросы не загружали файл заново
+            sent = FileIdCache.describe(message, caption)
+            if cache_key and sent:
+                file_id_cache.put(cache_key, 'video', sent)
 
             success_message = "✅ Видео успешно отправлено!"
             if optimized_path != file_path:
@@ -504,12 +3579,16 @@ async def handle_send_action(query, context, user_id, file_path):
 
             await query.edit_message_text(success_message)
 
+        except QueueFullError:
+            # Очередь отправки переполнена: файл и задача остаются, пользователь повторит позже
+            keep_file = True
+            raise
         except Exception as send_error:
             # Если не получилось как видео, пробуем как документ
             error_msg = str(send_error)
             if "413" in error_msg or "Request Entity Too Large" in error_msg or "400" in error_msg:
                 await query.edit_message_text("🔄 Видео слишком большое, пробую отправить как файл...")
-                await send_as_document(query, context, user_id, optimized_path)
+                await send_as_document(query, context, user_id, optimized_path, job_id)
             else:
                 raise send_error
 
@@ -519,36 +3598,45 @@ async def handle_send_action(query, context, user_id, file_path):
                 os.remove(thumbnail_path)
             if optimized_path != file_path and os.path.exists(optimized_path):
                 os.remove(optimized_path)  # Удаляем оптимизированную копию
-            if os.path.exists(file_path):
-                os.remove(file_path)  # Удаляем оригинал
-            if user_id in user_data:
-                del user_data[user_id]
+            if not keep_file:
+                if os.path.exists(file_path):
+                    os.remove(file_path)  # Удаляем оригинал
+                job_store.delete(job_id)
 
+    except QueueFullError:
+        await query.edit_message_text(OVERLOAD_MESSAGE, reply_markup=post_download_keyboard(job_id))
     except Exception as e:
         await handle_send_error(query, e, original_size)
 
 
-async def handle_large_file(query, context, user_id, file_path, file_size):
+async def handle_large_file(query, context, user_id, file_path, file_size, job_id):
     """Обработка больших файлов"""
+    # Число частей оцениваем по размеру; ffprobe здесь же заполняет кэш для оптимизации и разделения
+    try:
+        split_label = f"✂️ Разделить на части (~{(await probe_media(file_path)).estimate_parts(TELEGRAM_UPLOAD_LIMIT_MB)})"
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать параметры видео: {e}")
+        split_label = "✂️ Разделить на части"
+
     # Предлагаем варианты для больших файлов
     keyboard = [
         [
-            InlineKeyboardButton("🔄 Оптимизировать и отправить", callback_data=f"optimize_{user_id}"),
-            InlineKeyboardButton("✂️ Разделить на части", callback_data=f"split_{user_id}")
+            InlineKeyboardButton("🔄 Оптимизировать и отправить", callback_data=job_callback("optimize", job_id)),
+            InlineKeyboardButton(split_label, callback_data=job_callback("split", job_id))
         ],
         [
-            InlineKeyboardButton("📁 Сохранить на сервере", callback_data="action_move"),
-            InlineKeyboardButton("📤 Отправить как есть", callback_data="action_send_as_file")
+            InlineKeyboardButton("📁 Сохранить на сервере", callback_data=job_callback("action_move", job_id)),
+            InlineKeyboardButton("📤 Отправить как есть", callback_data=job_callback("action_send_as_file", job_id))
         ],
         [
-            InlineKeyboardButton("🗑️ Удалить файл", callback_data="action_delete")
+            InlineKeyboardButton("🗑️ Удалить файл", callback_data=job_callback("action_delete", job_id))
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text(
         f"📹 Видео большое ({file_size:.1f} MB)\n\n"
-        f"📊 Лимит Telegram: ~50 MB\n\n"
+        f"📊 Лимит отправки: ~{TELEGRAM_UPLOAD_LIMIT_MB} MB\n\n"
         f"💡 Варианты:\n"
         f"• 🔄 Оптимизировать (сжать размер)\n"
         f"• ✂️ Разделить на части\n"
@@ -566,11 +3654,13 @@ async def handle_optimize_action(update: Update, context: ContextTypes.DEFAULT_T
 
     user_id = query.from_user.id
 
-    if user_id not in user_data or 'file_path' not in user_data[user_id]:
+    _, job = get_callback_job(query)
+    if job is None or 'file_path' not in job:
         await query.edit_message_text("❌ Файл не найден или сессия устарела.")
         return
 
-    file_path = user_data[user_id]['file_path']
+    job_id = job['job_id']
+    file_path = job['file_path']
     original_size = os.path.getsize(file_path) / (1024 * 1024)
 
     await query.edit_message_text(
@@ -581,7 +3671,19 @@ async def handle_optimize_action(update: Update, context: ContextTypes.DEFAULT_T
 
     try:
         # Оптимизируем видео
-        optimized_path = await optimize_video_for_telegram(file_path)
+        status = StatusUpdater(query.edit_message_text, chat_id=user_id)
+        try:
+            optimized_path = await scheduler.run(
+                'transcode',
+                lambda: optimize_video_for_telegram(
+                    file_path, on_progress=progress_reporter(status, "🔄 Оптимизирую видео..."),
+                    target_size_mb=TELEGRAM_UPLOAD_LIMIT_MB
+                ),
+                on_queued=queue_notifier(query, "оптимизацию"),
+                owner=user_id
+            )
+        finally:
+            await status.close()
         optimized_size = os.path.getsize(optimized_path) / (1024 * 1024)
 
         if optimized_path == file_path:
@@ -589,21 +3691,21 @@ async def handle_optimize_action(update: Update, context: ContextTypes.DEFAULT_T
                 "ℹ️ Видео уже оптимального размера\n"
                 "Пробую отправить как есть..."
             )
-            await handle_send_action(query, context, user_id, file_path)
+            await handle_send_action(query, context, user_id, file_path, job_id)
             return
 
         compression_ratio = (1 - optimized_size / original_size) * 100
 
         # Обновляем путь к файлу в данных пользователя
-        user_data[user_id]['file_path'] = optimized_path
+        job_store.update(job_id, file_path=optimized_path)
 
-        if optimized_size <= 45:
+        if optimized_size <= TELEGRAM_UPLOAD_LIMIT_MB:
             await query.edit_message_text(
                 f"✅ Оптимизация завершена!\n"
                 f"💾 Сжатие: {original_size:.1f}MB → {optimized_size:.1f}MB ({compression_ratio:.1f}%)\n"
                 f"🎬 Отправляю видео..."
             )
-            await handle_send_action(query, context, user_id, optimized_path)
+            await handle_send_action(query, context, user_id, optimized_path, job_id)
         else:
             await query.edit_message_text(
                 f"✅ Оптимизация завершена!\n"
@@ -612,8 +3714,10 @@ async def handle_optimize_action(update: Update, context: ContextTypes.DEFAULT_T
                 f"💡 Выберите действие:"
             )
             # Показываем обновленные варианты
-            await handle_large_file(query, context, user_id, optimized_path, optimized_size)
+            await handle_large_file(query, context, user_id, optimized_path, optimized_size, job_id)
 
+    except QueueFullError:
+        await query.edit_message_text(OVERLOAD_MESSAGE)
     except Exception as e:
         await query.edit_message_text(
             f"❌ Ошибка при оптимизации:\n`{str(e)}`\n\n"
@@ -622,26 +3726,29 @@ async def handle_optimize_action(update: Update, context: ContextTypes.DEFAULT_T
         )
 
 
-async def send_as_document(query, context, user_id, file_path):
+async def send_as_document(query, context, user_id, file_path, job_id):
     """Отправляет файл как документ"""
     try:
         file_size = os.path.getsize(file_path) / (1024 * 1024)
 
-        with open(file_path, 'rb') as file:
-            await context.bot.send_document(
+        async def upload():
+            await upload_with_retry(file_path, lambda file: context.bot.send_document(
                 chat_id=user_id,
                 document=file,
                 filename=os.path.basename(file_path),
-                caption=f"📁 {os.path.basename(file_path)}\n📊 {file_size:.1f} MB"
-            )
+                caption=f"📁 {os.path.basename(file_path)}\n📊 {file_size:.1f} MB",
+                read_timeout=UPLOAD_TIMEOUT,
+                write_timeout=UPLOAD_TIMEOUT
+            ))
+
+        await scheduler.run('upload', upload, on_queued=queue_notifier(query, "отправку"), owner=user_id)
 
         await query.edit_message_text("✅ Файл успешно отправлен!")
 
         # Удаляем файл после успешной отправки
         try:
             os.remove(file_path)
-            if user_id in user_data:
-                del user_data[user_id]
+            job_store.delete(job_id)
         except:
             pass
 
@@ -649,10 +3756,10 @@ async def send_as_document(query, context, user_id, file_path):
         await query.edit_message_text(f"❌ Ошибка отправки как файл: {str(e)}")
 
 
-async def handle_send_as_file_action(query, context, user_id, file_path):
+async def handle_send_as_file_action(query, context, user_id, file_path, job_id):
     """Обработка отправки как файла"""
     await query.edit_message_text("📤 Отправляю как файл...")
-    await send_as_document(query, context, user_id, file_path)
+    await send_as_document(query, context, user_id, file_path, job_id)
 
 
 async def handle_send_error(query, error, file_size):
@@ -672,11 +3779,139 @@ async def handle_send_error(query, error, file_size):
         await query.edit_message_text(f"❌ Ошибка отправки: {str(error)}")
 
 
-async def split_large_file(file_path: str, max_size_mb: int = 45):
-    """Разделяет большой файл на части используя ffmpeg"""
+async def probe_packets(file_path: str):
+    """
+    Читает индекс пакетов одним проходом ffprobe (без декодирования).
+    Возвращает (packets, keyframes): packets - [(время, размер)] всех потоков,
+    keyframes - отсортированные времена ключевых кадров видео (в файле без видео -
+    пакетов первой звуковой дорожки, каждый из них - допустимая точка разреза)
+    """
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "stream=index,codec_type:packet=stream_index,pts_time,dts_time,size,flags",
+        "-of", "compact", file_path
+    ]
+    result = await run_process(cmd, timeout=300)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe не смог прочитать пакеты: {result.stderr[-500:]}")
+
+    video_index = audio_index = None
+    raw_packets = []
+    last_time = 0.0
+    for line in result.stdout.splitlines():
+        section, *fields = line.split('|')
+        values = dict(field.split('=', 1) for field in fields if '=' in field)
+
+        if section == 'stream':
+            if values.get('codec_type') == 'video' and video_index is None:
+                video_index = values.get('index')
+            elif values.get('codec_type') == 'audio' and audio_index is None:
+                audio_index = values.get('index')
+        elif section == 'packet':
+            pts = values.get('pts_time')
+            if pts in (None, 'N/A'):
+                pts = values.get('dts_time')
+            try:
+                last_time = float(pts)
+            except (TypeError, ValueError):
+                pass  # Без метки времени относим пакет к предыдущему моменту
+            raw_packets.append((
+                last_time,
+                int(values.get('size') or 0),
+                values.get('stream_index'),
+                'K' in values.get('flags', '')
+            ))
+
+    packets = sorted((t, size) for t, size, _, _ in raw_packets)
+    cut_index = video_index if video_index is not None else audio_index
+    keyframes = sorted({t for t, _, index, key in raw_packets if key and index == cut_index})
+    return packets, keyframes
+
+
+def plan_split_points(packets: list, keyframes: list, limit_bytes: int) -> list:
+    """
+    Выбирает точки разреза на ключевых кадрах так, чтобы накопленный объем
+    пакетов каждой части (включая последнюю, до конца файла) не превышал limit_bytes.
+    Часть может превысить лимит, только если один GOP сам по себе больше лимита.
+    """
+    times = [t for t, _ in packets]
+    cumulative = [0]
+    for _, size in packets:
+        cumulative.append(cumulative[-1] + size)
+
+    def bytes_before(t):
+        return cumulative[bisect.bisect_left(times, t)]
+
+    cuts = []
+    start_bytes = 0
+    start_time = times[0] if times else 0.0
+    candidate = None
+
+    for keyframe in keyframes:
+        if keyframe <= start_time:
+            continue
+        while True:
+            if bytes_before(keyframe) - start_bytes <= limit_bytes:
+                candidate = keyframe
+                break
+
+            # Режем на последнем подходящем ключевом кадре или, если GOP слишком велик, на текущем
+            cut = candidate if candidate is not None else keyframe
+            cuts.append(cut)
+            start_time = cut
+            start_bytes = bytes_before(cut)
+            candidate = None
+            if cut == keyframe:
+                break
+
+    # Конец файла - последняя граница: хвост после последнего разреза тоже должен влезть в лимит
+    if cumulative[-1] - start_bytes > limit_bytes and candidate is not None:
+        cuts.append(candidate)
+
+    return cuts
+
+
+async def reencode_part(part_file: str, max_size_mb: int, on_progress=None, has_video: bool = True) -> bool:
+    """Крайняя мера для части больше лимита: перекодирование в 480p (звук - в AAC 96k)"""
+    tmp_file = f"{part_file}_480p.mp4"
+    video_args = [
+        "-vf", "scale=-2:480",  # Уменьшаем разрешение до 480p
+        "-c:v", "libx264", "-crf", "28",  # Более сильное сжатие
+    ] if has_video else ["-vn"]
+    cmd = [
+        "ffmpeg", "-i", part_file,
+        *video_args,
+        "-c:a", "aac", "-b:a", "96k",
+        "-preset", "fast",
+        "-movflags", "+faststart",
+        "-progress", "pipe:1", "-nostats",
+        "-y", tmp_file
+    ]
+    result = await run_process(cmd, timeout=600, on_stdout=on_progress)
+
+    if result.returncode == 0 and os.path.exists(tmp_file) and \
+            os.path.getsize(tmp_file) <= max_size_mb * 1024 * 1024:
+        os.replace(tmp_file, part_file)
+        return True
+
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    return False
+
+
+@timed('split')
+async def split_large_file(file_path: str, max_size_mb: int = TELEGRAM_UPLOAD_LIMIT_MB, on_progress=None):
+    """
+    Разделяет большой файл на части используя ffmpeg:
+    - точки разреза выбираются по индексу ключевых кадров и размерам пакетов,
+      чтобы каждая часть помещалась в лимит
+    - все части пишутся за один проход копированием потоков (segment muxer)
+    - перекодирование только для части, которая все равно не влезла
+    on_progress(номер_части, всего_частей, доля) вызывается по ходу обработки каждой части
+    """
     try:
-        file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB
-        if file_size <= max_size_mb:
+        media = await probe_media(file_path)
+        if media.size_mb <= max_size_mb:
             return [file_path]  # Не нужно разделять
 
         # Создаем папку для частей
@@ -684,62 +3919,75 @@ async def split_large_file(file_path: str, max_size_mb: int = 45):
         parts_dir = f"{base_name}_parts"
         os.makedirs(parts_dir, exist_ok=True)
 
-        # Получаем длительность видео
-        duration_cmd = [
-            "ffprobe", "-v", "error", "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1", file_path
-        ]
-
-        result = subprocess.run(duration_cmd, capture_output=True, text=True)
-        total_duration = float(result.stdout.strip())
+        # Один проход ffprobe: размеры пакетов и ключевые кадры (общий с параллельным кодированием)
+        packets, keyframes = await media.packet_index()
+        media.release_packet_index()
+        if not packets:
+            return [file_path]
+
+        # Запас на заголовки контейнера (moov) каждой части
+        limit_bytes = int(max_size_mb * 1024 * 1024 * 0.95)
+        cut_points = plan_split_points(packets, keyframes, limit_bytes)
+        total_duration = media.duration or packets[-1][0]
+        if not cut_points:
+            # Точек разреза по индексу нет (например, один ключевой кадр) - делим по длительности,
+            # части больше лимита перекодируются ниже
+            num_parts = max(2, math.ceil(media.size / limit_bytes))
+            cut_points = [total_duration * i / num_parts for i in range(1, num_parts)]
+
+        num_parts = len(cut_points) + 1
+        tracer.current().set(size=media.size, parts=num_parts)
+        logger.info(f"Разделение на {num_parts} частей по ключевым кадрам: {cut_points}")
+
+        def on_pass_progress(fraction):
+            # Номер текущей части определяем по позиции в исходном файле
+            part = bisect.bisect_right(cut_points, fraction * total_duration) + 1
+            on_progress(part, num_parts, fraction)
 
-        # Вычисляем количество частей
-        num_parts = max(2, math.ceil(file_size / max_size_mb))  # Минимум 2 части
-        part_duration = total_duration / num_parts
+        cmd = [
+            "ffmpeg", "-i", file_path,
+            *(["-map", "0:v:0", "-map", "0:a?"] if media.video else ["-map", "0:a:0"]),
+            "-c", "copy",  # Копируем без перекодирования
+            "-f", "segment",
+            "-segment_times", ",".join(f"{t:.6f}" for t in cut_points),
+            "-segment_start_number", "1",
+            "-segment_format", "mp4",
+            "-segment_format_options", "movflags=+faststart",
+            "-reset_timestamps", "1",
+            "-avoid_negative_ts", "make_zero",
+            "-progress", "pipe:1", "-nostats",
+            "-y", f"{parts_dir}/part_%02d.mp4"
+        ]
+        result = await run_process(
+            cmd, timeout=600,
+            on_stdout=FfmpegProgress(total_duration, on_pass_progress) if on_progress else None
+        )
+        if result.returncode != 0:
+            logger.error(f"Ошибка разделения ffmpeg: {result.stderr[-500:]}")
+            return [file_path]
 
         part_files = []
-
         for i in range(num_parts):
             part_file = f"{parts_dir}/part_{i + 1:02d}.mp4"
-            start_time = i * part_duration
-
-            # Сначала пробуем скопировать без перекодирования
-            cmd = [
-                "ffmpeg", "-i", file_path,
-                "-ss", str(start_time),
-                "-t", str(part_duration),
-                "-c", "copy",  # Копируем без перекодирования
-                "-avoid_negative_ts", "make_zero",
-                part_file
-            ]
-
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-
-            if result.returncode == 0 and os.path.exists(part_file):
-                part_size = os.path.getsize(part_file) / (1024 * 1024)
-
-                # Если часть все еще слишком большая, уменьшаем качество
-                if part_size > max_size_mb:
+            if not os.path.exists(part_file):
+                continue
+
+            # Если часть все еще слишком большая, уменьшаем качество
+            if os.path.getsize(part_file) > max_size_mb * 1024 * 1024:
+                logger.warning(f"Часть {i + 1} больше лимита, перекодирую")
+                part_progress = None
+                if on_progress is not None:
+                    part_duration = (cut_points[i] if i < len(cut_points) else total_duration) - \
+                                    (cut_points[i - 1] if i > 0 else 0.0)
+                    part_progress = FfmpegProgress(part_duration, lambda f, n=i + 1: on_progress(n, num_parts, f))
+                with tracer.span('reencode_part', part=i + 1, size=os.path.getsize(part_file)) as span:
+                    reencoded = await reencode_part(part_file, max_size_mb, part_progress, bool(media.video))
+                    span.set(ok=reencoded)
+                if not reencoded:
                     os.remove(part_file)
-                    cmd = [
-                        "ffmpeg", "-i", file_path,
-                        "-ss", str(start_time),
-                        "-t", str(part_duration),
-                        "-vf", "scale=854:480",  # Уменьшаем разрешение до 480p
-                        "-c:v", "libx264", "-crf", "28",  # Более сильное сжатие
-                        "-c:a", "aac", "-b:a", "96k",
-                        "-preset", "fast",
-                        part_file
-                    ]
-                    subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-
-                # Проверяем финальный размер
-                if os.path.exists(part_file):
-                    final_size = os.path.getsize(part_file) / (1024 * 1024)
-                    if final_size <= max_size_mb:
-                        part_files.append(part_file)
-                    else:
-                        os.remove(part_file)
+                    continue
+
+            part_files.append(part_file)
 
         return part_files if part_files else [file_path]
 
@@ -748,40 +3996,169 @@ async def split_large_file(file_path: str, max_size_mb: int = 45):
         return [file_path]
 
 
-async def send_video_parts(chat_id, part_files, context, original_filename):
-    """Отправляет части видео в Telegram"""
-    total_parts = len(part_files)
+# Служебный чат (например, закрытый канал бота): части загружаются туда параллельно,
+# а пользователю пересылаются по file_id строго по порядку. Пусто - загрузка по одной
+PARTS_STAGING_CHAT_ID = os.getenv('PARTS_STAGING_CHAT_ID')
+PARTS_UPLOAD_CONCURRENCY = int(os.getenv('PARTS_UPLOAD_CONCURRENCY', '3'))
 
-    for i, part_file in enumerate(part_files):
-        try:
-            part_size = os.path.getsize(part_file) / (1024 * 1024)
-            part_name = f"{original_filename}.part{i + 1:02d}.mp4"
 
-            # Создаем миниатюру для части
-            thumbnail_path = await create_thumbnail(part_file)
+def retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+
+class AimdWindow:
+    """
+    Окно одновременных загрузок по схеме AIMD: после каждой успешной загрузки
+    окно растет (на 1 за «круг»), при ответе 429 сокращается вдвое и все ждут retry_after
+    """
+
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = 1.0
+        self.active = 0
+        self.paused_until = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def release(self, ok: bool = True):
+        async with self._condition:
+            self.active -= 1
+            if ok:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def throttle(self, delay: float):
+        self.limit = max(1.0, self.limit / 2)
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        logger.warning(f"Telegram ограничил частоту запросов: пауза {delay:.0f}s, окно {int(self.limit)}")
+
+
+async def send_video_parts(chat_id, part_files, context, original_filename, cache_key: str = None,
+                           delivered: list = ()):
+    """
+    Отправляет части видео в Telegram конвейером:
+    - миниатюры готовятся по порядку заранее, пока идут загрузки
+    - со служебным чатом части загружаются туда параллельно в окне AIMD и
+      по готовности уходят пользователю по file_id в исходном порядке
+    - без служебного чата части загружаются пользователю по одной
+    delivered - записи первых частей, уже отправленных по file_id: они не загружаются повторно
+    """
+    total_parts = len(part_files)
+    first = len(delivered)
+    staging = bool(PARTS_STAGING_CHAT_ID) and total_parts - first > 1
+    window = AimdWindow(PARTS_UPLOAD_CONCURRENCY if staging else 1)
+    sent_parts = list(delivered)
+
+    captions = [
+        f"📦 Часть {i + 1}/{total_parts}\n"
+        f"📹 {original_filename}\n"
+        f"📊 {os.path.getsize(part_file) / (1024 * 1024):.1f} MB"
+        for i, part_file in enumerate(part_files)
+    ]
+    for part_file in part_files[:first]:
+        os.remove(part_file)
+    thumbnails = [asyncio.get_running_loop().create_future() for _ in part_files]
+    for thumbnail in thumbnails[:first]:
+        thumbnail.set_result(None)
+
+    async def prepare_thumbnails():
+        for part_file, thumbnail in zip(part_files[first:], thumbnails[first:]):
+            thumbnail.set_result(await create_thumbnail(part_file))
+
+    async def upload(i):
+        thumbnail_path = await thumbnails[i]
+        while True:
+            await window.acquire()
+            try:
+                with upload_source(part_files[i]) as video_file:
+                    message = await context.bot.send_video(
+                        chat_id=PARTS_STAGING_CHAT_ID if staging else chat_id,
+                        video=video_file,
+                        caption=captions[i],
+                        thumbnail=thumbnail_path,
+                        supports_streaming=True,
+                        read_timeout=UPLOAD_TIMEOUT,
+                        write_timeout=UPLOAD_TIMEOUT,
+                        connect_timeout=60
+                    )
+            except RetryAfter as e:
+                window.throttle(retry_after_seconds(e))
+                await window.release(ok=False)
+                continue
+            except BaseException:
+                await window.release(ok=False)
+                raise
+            await window.release()
+            return message
+
+    async def remove_staged(staged):
+        try:
+            await context.bot.delete_message(PARTS_STAGING_CHAT_ID, staged.message_id)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить часть из служебного чата: {e}")
 
-            with open(part_file, 'rb') as video_file:
-                await context.bot.send_video(
+    async def deliver(i, staged):
+        """Пересылает загруженную часть пользователю по file_id и убирает ее из служебного чата"""
+        while True:
+            try:
+                message = await context.bot.send_video(
                     chat_id=chat_id,
-                    video=video_file,
-                    caption=f"📦 Часть {i + 1}/{total_parts}\n"
-                            f"📹 {original_filename}\n"
-                            f"📊 {part_size:.1f} MB",
-                    thumbnail=thumbnail_path,
-                    supports_streaming=True,
-                    read_timeout=60,
-                    write_timeout=60,
-                    connect_timeout=60
+                    video=staged.video.file_id,
+                    caption=captions[i],
+                    supports_streaming=True
                 )
+                break
+            except RetryAfter as e:
+                window.throttle(retry_after_seconds(e))
+                await asyncio.sleep(retry_after_seconds(e))
+        await remove_staged(staged)
+        return message
+
+    thumbnail_task = asyncio.create_task(prepare_thumbnails())
+    uploads = [asyncio.create_task(upload(i)) for i in range(first, total_parts)]
+    i = first
+    try:
+        for i, task in enumerate(uploads, start=first):
+            message = await task
+            if staging:
+                message = await deliver(i, message)
+            sent_parts.append(FileIdCache.describe(message, captions[i]))
 
             # Удаляем временные файлы
+            thumbnail_path = thumbnails[i].result()
             if thumbnail_path and os.path.exists(thumbnail_path):
                 os.remove(thumbnail_path)
-            os.remove(part_file)
+            os.remove(part_files[i])
 
-        except Exception as e:
-            logger.error(f"Ошибка отправки части {i + 1}: {e}")
-            return False
+    except Exception as e:
+        logger.error(f"Ошибка отправки части {i + 1}: {e}")
+        return False
+
+    finally:
+        thumbnail_task.cancel()
+        for task in uploads:
+            task.cancel()
+        await asyncio.gather(thumbnail_task, *uploads, return_exceptions=True)
+        if staging:
+            # Части, загруженные в служебный чат, но не доставленные пользователю, там не оставляем
+            for task in uploads[len(sent_parts) - first:]:
+                if not task.cancelled() and task.exception() is None:
+                    await remove_staged(task.result())
+        for thumbnail in thumbnails[len(sent_parts):]:
+            if thumbnail.done() and not thumbnail.cancelled() and thumbnail.result() \
+                    and os.path.exists(thumbnail.result()):
+                os.remove(thumbnail.result())
+
+    if cache_key and all(sent_parts):
+        file_id_cache.put(cache_key, 'parts', sent_parts)
 
     return True
 
@@ -793,11 +4170,14 @@ async def handle_split_action(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     user_id = query.from_user.id
 
-    if user_id not in user_data or 'file_path' not in user_data[user_id]:
+    _, job = get_callback_job(query)
+    if job is None or 'file_path' not in job:
         await query.edit_message_text("❌ Файл не найден или сессия устарела.")
         return
 
-    file_path = user_data[user_id]['file_path']
+    job_id = job['job_id']
+    file_path = job['file_path']
+    cache_key = job.get('cache_key')
     original_filename = os.path.basename(file_path)
     file_size = os.path.getsize(file_path) / (1024 * 1024)
 
@@ -809,8 +4189,32 @@ async def handle_split_action(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
     try:
+        # Части этого видео уже загружались - отправляем их по file_id
+        delivered, cached_total = await send_cached_parts(context, user_id, cache_key) if cache_key else ([], 0)
+        if cached_total and len(delivered) == cached_total:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            job_store.delete(job_id)
+            await query.edit_message_text("✅ Все части успешно отправлены! ⚡ (без повторной загрузки)")
+            return
+
         # Разделяем файл на части
-        part_files = await split_large_file(file_path, max_size_mb=45)
+        status = StatusUpdater(query.edit_message_text, chat_id=user_id)
+
+        def on_split_progress(part, total_parts, fraction):
+            status.update(f"✂️ Разделяю видео на части...\n"
+                          f"📦 Часть {part}/{total_parts}\n"
+                          f"{render_progress_bar(fraction)}")
+
+        try:
+            part_files = await scheduler.run(
+                'transcode',
+                lambda: split_large_file(file_path, on_progress=on_split_progress),
+                on_queued=queue_notifier(query, "разделение"),
+                owner=user_id
+            )
+        finally:
+            await status.close()
 
         if len(part_files) <= 1:
             await query.edit_message_text(
@@ -821,13 +4225,23 @@ async def handle_split_action(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return
 
+        if len(part_files) != cached_total:
+            # Разбиение не совпало с сохраненным (например, изменился лимит) - отправляем все части заново
+            delivered = []
+
         # Отправляем части как видео
         await query.edit_message_text(
             f"📤 Отправляю {len(part_files)} частей...\n"
             f"⏳ Пожалуйста, подождите..."
         )
 
-        success = await send_video_parts(user_id, part_files, context, original_filename)
+        success = await scheduler.run(
+            'upload',
+            lambda: send_video_parts(user_id, part_files, context, original_filename, cache_key=cache_key,
+                                     delivered=delivered),
+            on_queued=queue_notifier(query, "отправку"),
+            owner=user_id
+        )
 
         if success:
             # Удаляем исходный файл
@@ -853,9 +4267,10 @@ async def handle_split_action(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
 
         # Очищаем данные пользователя
-        if user_id in user_data:
-            del user_data[user_id]
+        job_store.delete(job_id)
 
+    except QueueFullError:
+        await query.edit_message_text(OVERLOAD_MESSAGE)
     except Exception as e:
         await query.edit_message_text(
             f"❌ Ошибка при разделении видео:\n`{str(e)}`\n\n"
@@ -864,12 +4279,12 @@ async def handle_split_action(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
 
 
-async def handle_move_action(query, context, user_id, file_path):
+async def handle_move_action(query, context, user_id, file_path, job_id):
     """Обработка перемещения файла в папку пользователя"""
     try:
         # Создаем папку пользователя
-        username = user_data[user_id].get('username', f'user_{user_id}')
-        user_saved_dir = f"/home/torrent/download/youtube/{username}"
+        username = (job_store.get(job_id) or {}).get('username', f'user_{user_id}')
+        user_saved_dir = os.path.join(SAVED_DIR, username)
         os.makedirs(user_saved_dir, exist_ok=True)
 
         # Перемещаем файл в папку пользователя
@@ -895,13 +4310,13 @@ async def handle_move_action(query, context, user_id, file_path):
             parse_mode='Markdown'
         )
         # Обновляем путь в данных пользователя
-        user_data[user_id]['file_path'] = new_path
+        job_store.update(job_id, file_path=new_path)
 
     except Exception as e:
         await query.edit_message_text(f"❌ Ошибка сохранения: {str(e)}")
 
 
-async def handle_delete_action(query, context, user_id, file_path):
+async def handle_delete_action(query, context, user_id, file_path, job_id):
     """Обработка удаления файла"""
     try:
         if os.path.exists(file_path):
@@ -911,8 +4326,7 @@ async def handle_delete_action(query, context, user_id, file_path):
             await query.edit_message_text("✅ Файл уже удален")
 
         # Очищаем данные пользователя
-        if user_id in user_data:
-            del user_data[user_id]
+        job_store.delete(job_id)
     except Exception as e:
         await query.edit_message_text(f"❌ Ошибка удаления: {str(e)}")
 
@@ -920,88 +4334,517 @@ async def handle_delete_action(query, context, user_id, file_path):
 async def handle_post_download_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик действий после скачивания"""
     query = update.callback_query
-    await query.answer()
-
     user_id = query.from_user.id
 
-    # Обработка специальных действий
-    if query.data.startswith('split_'):
-        await handle_split_action(update, context)
-        return
-    elif query.data.startswith('optimize_'):
-        await handle_optimize_action(update, context)
+    action, job = get_callback_job(query)
+    if job is None or 'file_path' not in job:
+        await query.answer()
+        await query.edit_message_text("❌ Файл не найден или сессия устарела.")
         return
 
-    action = query.data.replace('action_', '')
+    job_id = job['job_id']
+    file_path = job['file_path']
 
-    if user_id not in user_data or 'file_path' not in user_data[user_id]:
-        await query.edit_message_text("❌ Файл не найден или сессия устарела.")
+    # Фоновые действия занимают задачу сразу, до запуска: повторное нажатие или старая клавиатура
+    # не должны начать вторую отправку того же файла. Пока файл обрабатывается, остальные кнопки тоже ждут
+    if action in JOB_ACTIONS:
+        busy = not job_store.claim(job_id, 'downloaded', 'sending')
+    else:
+        busy = job['state'] == 'sending'
+    if busy:
+        await query.answer("⏳ Это видео уже обрабатывается")
+        return
+    await query.answer()
+
+    # Обработка специальных действий (тяжелые операции уходят в фоновые задачи планировщика)
+    if action == 'split':
+        scheduler.spawn(run_job_action(job_id, handle_split_action(update, context)))
+        return
+    elif action == 'optimize':
+        scheduler.spawn(run_job_action(job_id, handle_optimize_action(update, context)))
         return
 
-    file_path = user_data[user_id]['file_path']
+    action = action.replace('action_', '')
 
     if action == 'send':
-        await handle_send_action(query, context, user_id, file_path)
+        scheduler.spawn(run_job_action(job_id, handle_send_action(query, context, user_id, file_path, job_id)))
     elif action == 'send_as_file':
-        await handle_send_as_file_action(query, context, user_id, file_path)
+        scheduler.spawn(run_job_action(
+            job_id, handle_send_as_file_action(query, context, user_id, file_path, job_id)
+        ))
     elif action == 'move':
-        await handle_move_action(query, context, user_id, file_path)
+        await handle_move_action(query, context, user_id, file_path, job_id)
     elif action == 'delete':
-        await handle_delete_action(query, context, user_id, file_path)
+        await handle_delete_action(query, context, user_id, file_path, job_id)
+
 
+# Действия, которые выполняются фоновой задачей в состоянии 'sending'
+JOB_ACTIONS = ('split', 'optimize', 'action_send', 'action_send_as_file')
 
-async def schedule_file_deletion(user_id: int, file_path: str, delay: int):
-    """Планирует автоматическое удаление файла"""
-    await asyncio.sleep(delay)
 
+async def run_job_action(job_id: int, action):
+    """
+    Выполняет действие над скачанным файлом в состоянии 'sending' (его ставит обработчик кнопки).
+    Если действие не завершило задачу (ошибка, файл все еще большой), она снова ждет выбора.
+    При остановке бота задача остается в 'sending' и обрабатывается при следующем запуске.
+    """
+    job = job_store.get(job_id) or {}
+    file_path = job.get('file_path')
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info(f"Автоматически удален файл: {file_path}")
+        with tracer.job(job_id, job.get('user_id'), action.__name__,
+                        file_size=os.path.getsize(file_path) if file_path and os.path.exists(file_path) else None):
+            await action
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        job_store.update(job_id, 'downloaded')
+        raise
+    job_store.update(job_id, 'downloaded')
+
+
+# Сколько хранится скачанный файл, если пользователь ничего с ним не сделал (секунды)
+FILE_RETENTION = int(os.getenv('FILE_RETENTION', '3600'))
+
+
+class FileReaper:
+    """
+    Единый планировщик удаления скачанных файлов вместо спящей задачи на каждый файл:
+    - сроки хранятся в базе задач (таблица expiring_files) и переживают перезапуск
+    - в памяти куча ближайших сроков, одна фоновая задача спит до ближайшего
+    - файлы, срок которых наступает в пределах batch_window, удаляются одной пачкой
+    - уведомления отправляет бот работающего приложения, по одному сообщению на пользователя
+    """
 
-            # Уведомляем пользователя если сессия активна
-            if user_id in user_data and user_data[user_id].get('file_path') == file_path:
+    def __init__(self, store: JobStore, batch_window: float = 5.0):
+        self.store = store
+        self.batch_window = batch_window
+        self.deleted = 0
+        self._heap = []
+        self._deadlines = {}
+        self._bot = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._table_ready = False
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if not self._table_ready:
+            self.store.db.execute(
+                "CREATE TABLE IF NOT EXISTS expiring_files ("
+                "path TEXT PRIMARY KEY, "
+                "expires REAL NOT NULL, "
+                "job_id INTEGER, "
+                "user_id INTEGER)"
+            )
+            self._table_ready = True
+        return self.store.db
+
+    def schedule(self, path: str, delay: float, job_id: int = None, user_id: int = None):
+        """Удалить файл через delay секунд (повторный вызов для того же пути переносит срок)"""
+        expires = time.time() + delay
+        self.db.execute(
+            "INSERT OR REPLACE INTO expiring_files (path, expires, job_id, user_id) VALUES (?, ?, ?, ?)",
+            (path, expires, job_id, user_id)
+        )
+        self._push(path, expires)
+        self._wakeup.set()
+
+    def _push(self, path: str, expires: float):
+        # Старые записи кучи для этого пути не удаляем: при извлечении их отсеет сверка с _deadlines
+        self._deadlines[path] = expires
+        heapq.heappush(self._heap, (expires, path))
+
+    def start(self, bot):
+        """Загружает сохраненные сроки и запускает фоновую задачу"""
+        self._bot = bot
+        for row in self.db.execute("SELECT path, expires FROM expiring_files"):
+            self._push(row['path'], row['expires'])
+        logger.info(f"Планировщик удаления: {len(self._deadlines)} файлов в очереди")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is not None and delay <= 0:
                 try:
-                    await Application.builder().token(BOT_TOKEN).build().bot.send_message(
-                        chat_id=user_id,
-                        text="🗑️ Файл автоматически удален с сервера (через 1 час)"
-                    )
-                except:
+                    await self._reap_due()
+                except Exception as e:
+                    logger.error(f"Ошибка автоматического удаления: {e}")
+                    await asyncio.sleep(self.batch_window)
+                continue
+
+            # Спим до ближайшего срока или до появления более раннего
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _pop_due(self) -> list:
+        due = []
+        horizon = time.time() + self.batch_window
+        while self._heap and self._heap[0][0] <= horizon:
+            expires, path = heapq.heappop(self._heap)
+            if self._deadlines.get(path) == expires:
+                del self._deadlines[path]
+                due.append(path)
+        return due
+
+    async def _reap_due(self):
+        due = self._pop_due()
+        if not due:
+            return
+
+        rows = {}
+        for path in due:
+            row = self.db.execute("SELECT * FROM expiring_files WHERE path = ?", (path,)).fetchone()
+            if row is not None:
+                rows[path] = row
+
+        def remove_files():
+            removed = []
+            for path in due:
+                try:
+                    os.remove(path)
+                    removed.append(path)
+                except FileNotFoundError:
                     pass
-    except Exception as e:
-        logger.error(f"Ошибка автоматического удаления: {e}")
+                except OSError as e:
+                    logger.error(f"Не удалось удалить {path}: {e}")
+            return removed
+
+        removed = await asyncio.to_thread(remove_files)
+        self.db.executemany("DELETE FROM expiring_files WHERE path = ?", [(path,) for path in due])
+        self.deleted += len(removed)
+        if removed:
+            logger.info(f"Автоматически удалено файлов: {len(removed)}")
+
+        # Уведомляем пользователей, у которых задача все еще ждала действия с этим файлом
+        notify = collections.Counter()
+        for path in removed:
+            row = rows.get(path)
+            job = self.store.get(row['job_id']) if row is not None and row['job_id'] is not None else None
+            if job and job.get('file_path') == path:
+                self.store.delete(job['job_id'])
+                notify[job['user_id']] += 1
+
+        for user_id, count in notify.items():
+            text = "🗑️ Файл автоматически удален с сервера" if count == 1 else \
+                f"🗑️ Автоматически удалено файлов с сервера: {count}"
+            try:
+                await self._bot.send_message(chat_id=user_id, text=f"{text} (через {FILE_RETENTION // 60} мин.)")
+            except Exception as e:
+                logger.warning(f"Не удалось уведомить {user_id} об удалении файла: {e}")
+
 
+file_reaper = FileReaper(job_store)
 
-async def cleanup_old_files():
-    """Очистка старых файлов при запуске"""
-    download_base = "/home/taras/video_downloads"
-    if os.path.exists(download_base):
-        for user_dir in os.listdir(download_base):
-            user_path = os.path.join(download_base, user_dir)
-            if os.path.isdir(user_path):
+
+async def on_startup(application: Application):
+    """Запуск фоновых служб и восстановление задач после перезапуска"""
+    file_reaper.start(application.bot)
+    janitor.start()
+    if METRICS_PORT:
+        await metrics.start(METRICS_HOST, METRICS_PORT)
+    await resume_jobs(application)
+
+
+# Сколько при остановке ждать начатые задачи (секунды); 0 - прерывать сразу
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', '60'))
+
+
+async def on_stop(application: Application):
+    """Обновления больше не принимаются: даем начатым задачам доделаться, пока бот еще может отвечать"""
+    if scheduler.active_tasks:
+        logger.info(f"Остановка: жду завершения {scheduler.active_tasks} задач (до {SHUTDOWN_DRAIN_TIMEOUT:.0f}с)")
+    cancelled = await scheduler.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    if cancelled:
+        logger.info(f"Остановка: прервано задач {cancelled}, они продолжатся после перезапуска")
+
+
+async def on_shutdown(application: Application):
+    await metrics.stop()
+    await janitor.stop()
+    await file_reaper.stop()
+
+
+class DiskJanitor:
+    """
+    Периодическая уборка папок со скачанными и сохраненными видео:
+    - обход через os.scandir в рабочем потоке, по его итогам ведется текущий объем
+    - файлы старше срока хранения своей папки удаляются
+    - выше верхней отметки объема (или при нехватке свободного места) место освобождается
+      по ступеням, пока объем не опустится до нижней отметки: сначала кэш скачиваний
+      (его можно скачать заново), затем давно не использованные файлы папок загрузок;
+      папки из last_resort (сохраненные пользователями видео) - только по сроку хранения
+      или при нехватке свободного места, когда больше удалять нечего
+    - admit() перед скачиванием проверяет, хватит ли места на ожидаемый размер задачи
+    Файлы активных задач и база задач не удаляются.
+    """
+
+    def __init__(self, roots: dict, high_watermark: int, low_watermark: int, min_free: int, interval: float,
+                 last_resort: tuple = ()):
+        self.roots = roots
+        self.last_resort = last_resort
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.min_free = min_free
+        self.interval = interval
+        self.usage = 0
+        self.files = 0
+        self.evicted = 0
+        self.rejected = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def track(self, path: str):
+        """Учитывает новый файл в текущем объеме до следующего обхода"""
+        try:
+            self.usage += os.path.getsize(path)
+            self.files += 1
+        except OSError:
+            pass
+
+    def free_bytes(self) -> int:
+        """Свободное место на самом заполненном из дисков, куда пишутся загрузки"""
+        free = []
+        for path in (*self.roots, download_cache.root):
+            # Папка может быть еще не создана - берем ближайшую существующую родительскую
+            while not os.path.exists(path) and os.path.dirname(path) != path:
+                path = os.path.dirname(path)
+            try:
+                free.append(shutil.disk_usage(path).free)
+            except OSError:
+                pass
+        return min(free) if free else 0
+
+    @staticmethod
+    def _protected_prefixes() -> tuple:
+        # Файл активной задачи вместе с производными (_optimized, _thumb, папка _parts), база задач и трассы
+        prefixes = [job_store.path]
+        if tracer.path:
+            # Пустой путь (запись трасс выключена) совпал бы с любым файлом
+            prefixes.append(tracer.path)
+        for job in job_store.all():
+            if job.get('file_path') and job['state'] in ('downloaded', 'sending'):
+                prefixes.append(os.path.splitext(job['file_path'])[0])
+        return tuple(prefixes)
+
+    def _scan(self, protected: tuple, now: float) -> dict:
+        """Обход корней: просроченные файлы, кандидаты на вытеснение, пустые папки и общий объем"""
+        result = {'expired': [], 'candidates': [], 'last_resort': [], 'empty_dirs': [], 'usage': 0, 'files': 0}
+        for root, max_age in self.roots.items():
+            candidates = result['last_resort' if root in self.last_resort else 'candidates']
+            stack = [root]
+            while stack:
+                directory = stack.pop()
+                empty = True
                 try:
-                    # Удаляем папки старше 2 часов
-                    if os.path.getctime(user_path) < (time.time() - 7200):
-                        shutil.rmtree(user_path)
-                        logger.info(f"Удалена старая папка: {user_path}")
-                except Exception as e:
-                    logger.error(f"Ошибка очистки {user_path}: {e}")
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            empty = False
+                            if entry.is_dir(follow_symlinks=False):
+                                # Кэш по умолчанию лежит в папке скачиваний: его объем и вытеснение
+                                # ведет сам DownloadCache (ступень 1)
+                                if entry.path != download_cache.root:
+                                    stack.append(entry.path)
+                                continue
+                            if not entry.is_file(follow_symlinks=False):
+                                continue
+                            stat = entry.stat(follow_symlinks=False)
+                            result['usage'] += stat.st_size
+                            result['files'] += 1
+                            if entry.path.startswith(protected):
+                                continue
+                            last_used = max(stat.st_atime, stat.st_mtime)
+                            if now - stat.st_mtime > max_age:
+                                result['expired'].append((last_used, stat.st_size, entry.path))
+                            else:
+                                candidates.append((last_used, stat.st_size, entry.path))
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                except OSError as e:
+                    logger.error(f"Ошибка обхода {directory}: {e}")
+                    continue
+                if empty and directory != root:
+                    result['empty_dirs'].append(directory)
+        return result
+
+    @staticmethod
+    def _remove(victims: list, empty_dirs: list) -> tuple:
+        removed = freed = 0
+        for _, size, path in victims:
+            try:
+                os.remove(path)
+                removed += 1
+                freed += size
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Ошибка очистки {path}: {e}")
+        for directory in empty_dirs:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass  # В папке уже появились файлы
+        return removed, freed
+
+    async def sweep(self, need_bytes: int = 0) -> int:
+        """Один проход уборки; need_bytes - сколько места нужно освободить сверх обычных правил"""
+        async with self._lock:
+            scan = await asyncio.to_thread(self._scan, self._protected_prefixes(), time.time())
+            expired = sum(size for _, size, _ in scan['expired'])
+            usage = scan['usage'] - expired + download_cache.total_bytes
+
+            # Сколько еще освободить: до нижней отметки объема и до запаса свободного места
+            excess = usage - self.low_watermark if usage > self.high_watermark else 0
+            shortage = self.min_free + need_bytes - (self.free_bytes() + expired)
+            to_free = max(excess, shortage, 0)
+
+            # Ступень 1: кэш скачиваний
+            cache_freed = download_cache.shrink(to_free) if to_free > 0 else 0
+            to_free -= cache_freed
+            shortage -= cache_freed
+
+            # Ступень 2: давно не использованные скачанные файлы
+            victims = list(scan['expired'])
+            for candidate in sorted(scan['candidates']):
+                if to_free <= 0:
+                    break
+                victims.append(candidate)
+                to_free -= candidate[1]
+                shortage -= candidate[1]
+
+            # Крайний случай: диск переполнен, а больше удалять нечего
+            for candidate in sorted(scan['last_resort']):
+                if shortage <= 0:
+                    break
+                logger.warning(f"Уборка: не хватает места, удаляю сохраненный файл {candidate[2]}")
+                victims.append(candidate)
+                shortage -= candidate[1]
+
+            removed, freed = await asyncio.to_thread(self._remove, victims, scan['empty_dirs'])
+            self.usage = scan['usage'] - freed + download_cache.total_bytes
+            self.files = scan['files'] - removed
+            freed += cache_freed
+            self.evicted += removed
+            if removed or cache_freed:
+                logger.info(f"Уборка: удалено файлов {removed} (из кэша {cache_freed / (1024 * 1024):.0f} MB), "
+                            f"освобождено {freed / (1024 * 1024):.0f} MB, занято {self.usage / (1024 * 1024):.0f} MB")
+            return freed
+
+    async def admit(self, predicted_bytes: int) -> bool:
+        """
+        Допуск нового скачивания: на диске должно остаться min_free после файла и его
+        перекодированной копии. При нехватке сначала освобождается место.
+        """
+        needed = predicted_bytes * 2 + self.min_free
+        if self.free_bytes() >= needed and self.usage + predicted_bytes <= self.high_watermark:
+            return True
+
+        await self.sweep(need_bytes=predicted_bytes * 2)
+        if self.free_bytes() >= needed:
+            return True
+
+        self.rejected += 1
+        logger.warning(f"Скачивание отклонено: нужно {needed / (1024 * 1024):.0f} MB, "
+                       f"свободно {self.free_bytes() / (1024 * 1024):.0f} MB")
+        return False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
-    # Также очищаем старые части файлов в saved_videos
-    saved_base = "/home/torrent/download/youtube"
-    if os.path.exists(saved_base):
-        for item in os.listdir(saved_base):
-            item_path = os.path.join(saved_base, item)
+    async def _run(self):
+        while True:
             try:
-                # Удаляем файлы/папки старше 7 дней
-                if os.path.getctime(item_path) < (time.time() - 604800):
-                    if os.path.isdir(item_path):
-                        shutil.rmtree(item_path)
-                    else:
-                        os.remove(item_path)
-                    logger.info(f"Удален старый файл: {item_path}")
+                await self.sweep()
             except Exception as e:
-                logger.error(f"Ошибка очистки {item_path}: {e}")
+                logger.error(f"Ошибка уборки: {e}")
+            await asyncio.sleep(self.interval)
+
+
+# Ожидаемый размер задачи, если по метаданным его оценить нельзя
+DEFAULT_JOB_SIZE_MB = int(os.getenv('DEFAULT_JOB_SIZE_MB', '300'))
+
+# Скачанные файлы хранятся 2 часа, сохраненные пользователями - 7 дней (раньше - только если диск переполнен)
+janitor = DiskJanitor(
+    {DOWNLOADS_DIR: 7200, SAVED_DIR: 604800},
+    high_watermark=int(os.getenv('DISK_HIGH_WATERMARK_MB', '51200')) * 1024 * 1024,
+    low_watermark=int(os.getenv('DISK_LOW_WATERMARK_MB', '40960')) * 1024 * 1024,
+    min_free=int(os.getenv('DISK_MIN_FREE_MB', '2048')) * 1024 * 1024,
+    interval=float(os.getenv('JANITOR_INTERVAL', '600')),
+    last_resort=(SAVED_DIR,)
+)
+metrics.gauge('bot_disk_usage_bytes', "Объем файлов в папках загрузок и кэше по последнему обходу",
+              collect=lambda: {(): janitor.usage})
+metrics.counter('bot_disk_evicted_files_total', "Файлы, удаленные уборкой", collect=lambda: {(): janitor.evicted})
+metrics.counter('bot_disk_rejected_total', "Скачивания, отклоненные из-за нехватки места",
+                collect=lambda: {(): janitor.rejected})
+
+
+async def resume_jobs(application: Application):
+    """
+    Восстановление задач после перезапуска:
+    - просроченные удаляются вместе с файлами
+    - прерванные скачивания запускаются заново (готовый файл возьмется из кэша)
+    - прерванная обработка возвращается к выбору действия, если файл на месте
+    - задачи, файл которых пропал, удаляются
+    """
+    expired = job_store.remove_expired()
+    context = CallbackContext(application)
+    resumed = 0
+
+    for job in job_store.all():
+        job_id, user_id, state = job['job_id'], job['user_id'], job['state']
+        try:
+            if state in ('queued', 'downloading'):
+                message = await application.bot.send_message(
+                    chat_id=user_id, text="♻️ Бот был перезапущен, продолжаю скачивание..."
+                )
+                job_store.update(job_id, 'queued')
+                start_job_download(job, context, StatusUpdater(message.edit_text, chat_id=user_id))
+                resumed += 1
+
+            elif state in ('downloaded', 'sending'):
+                if not os.path.exists(job.get('file_path', '')):
+                    job_store.delete(job_id)
+                    continue
+                # Кнопки восстановленной задачи проходят ту же проверку состояния, что и обычные:
+                # задача снова 'downloaded', и повторное действие займет ее только один раз
+                if state == 'sending' and job_store.claim(job_id, 'sending', 'downloaded'):
+                    await application.bot.send_message(
+                        chat_id=user_id,
+                        text=f"♻️ Бот был перезапущен во время обработки видео\n\n"
+                             f"📹 Файл: {os.path.basename(job['file_path'])}\n\n"
+                             f"Выберите действие:",
+                        reply_markup=post_download_keyboard(job_id)
+                    )
+                    resumed += 1
+
+        except Exception as e:
+            logger.error(f"Не удалось восстановить задачу {job_id}: {e}")
+            remove_job_file(job)
+            job_store.delete(job_id)
+
+    logger.info(f"Задачи после перезапуска: восстановлено {resumed}, удалено просроченных {len(expired)}")
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1009,11 +4852,212 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Ошибка: {context.error}")
 
 
+# Режим получения обновлений: polling (опрос getUpdates) или webhook (Telegram сам присылает их на HTTP-сервер бота)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный HTTPS-адрес вебхука; пусто - вебхук регистрируется снаружи (например, один раз для всех экземпляров)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+# Адрес HTTP-сервера вебхука; TLS снимает прокси или балансировщик перед ботом
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', urllib.parse.urlsplit(WEBHOOK_URL).path or '/telegram')
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена,
+# поэтому совпадает у всех экземпляров бота
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+webhook_requests_total = metrics.counter('bot_webhook_requests_total', "Запросы к вебхуку по результату")
+
+
+class WebhookRequestError(Exception):
+    """Запрос к вебхуку нельзя прочитать; status - ответ клиенту, после него соединение закрывается"""
+
+    def __init__(self, status: str):
+        super().__init__(status)
+        self.status = status
+
+
+class WebhookServer:
+    """
+    HTTP-сервер вебхука на asyncio: проверяет секретный токен и кладет обновления в очередь
+    приложения, дальше их обрабатывают те же обработчики, что и при опросе.
+    Соединения держатся открытыми (Telegram переиспользует их), при остановке сервер перестает
+    принимать запросы и закрывает простаивающие соединения.
+    """
+    MAX_BODY = 1024 * 1024
+    IDLE_TIMEOUT = 75
+
+    def __init__(self, application: Application, path: str, secret_token: str):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token.encode()
+        self._server = None
+        self._idle = set()
+        self._closing = False
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """(метод, путь, заголовки, тело) или None, если клиент закрыл соединение"""
+        request_line = await asyncio.wait_for(reader.readline(), self.IDLE_TIMEOUT)
+        if not request_line.strip():
+            return None
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise WebhookRequestError("400 Bad Request")
+        if length > self.MAX_BODY:
+            raise WebhookRequestError("413 Payload Too Large")
+        body = await asyncio.wait_for(reader.readexactly(length), 10) if length else b""
+        method, target = (request_line.decode("latin-1").split() + ["", ""])[:2]
+        return method, target.split("?")[0], headers, body
+
+    async def _process(self, method: str, path: str, headers: dict, body: bytes) -> str:
+        if path != self.path:
+            return "404 Not Found"
+        if method != "POST":
+            return "405 Method Not Allowed"
+        if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', '').encode(), self.secret_token):
+            return "403 Forbidden"
+        if self._closing:
+            # Telegram повторит доставку позже (или на другой экземпляр за балансировщиком)
+            return "503 Service Unavailable"
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            return "400 Bad Request"
+        await self.application.update_queue.put(update)
+        return "200 OK"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while not self._closing:
+                self._idle.add(writer)
+                try:
+                    request = await self._read_request(reader)
+                finally:
+                    self._idle.discard(writer)
+                if request is None:
+                    break
+                status = await self._process(*request)
+                webhook_requests_total.inc(status=status.split()[0])
+                keep_alive = request[2].get('connection', '').lower() != 'close' and not self._closing
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    f"Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except WebhookRequestError as e:
+            webhook_requests_total.inc(status=e.status.split()[0])
+            writer.write(f"HTTP/1.1 {e.status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode("latin-1"))
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str, port: int):
+        self._closing = False
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Вебхук принимает обновления на http://{host}:{self.port}{self.path}")
+
+    async def stop(self):
+        """Перестает принимать обновления; запросы, которые уже читаются, получат 503"""
+        if self._server is None:
+            return
+        self._closing = True
+        self._server.close()
+        for writer in list(self._idle):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+
+
+async def run_webhook(application: Application):
+    """
+    Работа в режиме вебхука. Жизненный цикл повторяет run_polling: post_init, обработка обновлений,
+    по SIGINT/SIGTERM - остановка приема, post_stop (дожидается начатых задач), post_shutdown.
+    """
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    server = WebhookServer(application, WEBHOOK_PATH, WEBHOOK_SECRET)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+            logger.info(f"Вебхук зарегистрирован: {WEBHOOK_URL}")
+        await application.start()
+        await stopping.wait()
+        logger.info("Получен сигнал остановки")
+    finally:
+        # Вебхук не удаляем: обновления дождутся перезапуска или достанутся другим экземплярам
+        await server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def build_application(builder=None) -> Application:
+    """
+    Приложение бота со всеми обработчиками.
+    builder - преднастроенный ApplicationBuilder (нагрузочный тест подставляет заглушку Bot API),
+    по умолчанию берутся токен и сервер Bot API из настроек.
+    """
+    if builder is None:
+        builder = Application.builder().token(BOT_TOKEN)
+        if BOT_API_URL:
+            # Свой сервер Bot API; перед первым запуском бот должен выйти из облачного (log_out)
+            builder = builder.base_url(BOT_API_URL).base_file_url(BOT_API_FILE_URL).local_mode(BOT_API_LOCAL_MODE)
+            logger.info(f"Bot API: {BOT_API_URL}, лимит отправки {TELEGRAM_UPLOAD_LIMIT_MB} MB"
+                        f"{', файлы передаются путем' if BOT_API_LOCAL_MODE else ''}")
+    application = (builder.rate_limiter(rate_limiter).post_init(on_startup).post_stop(on_stop)
+                   .post_shutdown(on_shutdown).build())
+
+    # Добавляем обработчики
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("platforms", platforms_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("slow", slow_command))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_video_url))
+    application.add_handler(CallbackQueryHandler(handle_quality_selection, pattern="^quality_"))
+    application.add_handler(
+        CallbackQueryHandler(handle_post_download_actions, pattern="^(action_|split|optimize)"))
+
+    application.add_error_handler(error_handler)
+    return application
+
+
 def main():
     """Запуск бота"""
     # Создаем базовые папки
-    os.makedirs("/home/taras/video_downloads", exist_ok=True)
-    os.makedirs("/home/torrent/download/youtube", exist_ok=True)
+    os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+    os.makedirs(SAVED_DIR, exist_ok=True)
 
     # Проверяем наличие ffmpeg и ffprobe
     try:
@@ -1024,28 +5068,20 @@ def main():
         logger.warning(
             "FFmpeg или FFprobe не установлены. Установите их для работы с большими файлами: sudo apt install ffmpeg")
 
-    # Очищаем старые файлы
-    asyncio.run(cleanup_old_files())
-
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
-
-        # Добавляем обработчики
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("platforms", platforms_command))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_video_url))
-        application.add_handler(CallbackQueryHandler(handle_quality_selection, pattern="^quality_"))
-        application.add_handler(
-            CallbackQueryHandler(handle_post_download_actions, pattern="^(action_|split_|optimize_)"))
+        application = build_application()
 
-        application.add_error_handler(error_handler)
-
-        logger.info("Бот запускается...")
-        application.run_polling()
+        logger.info(f"Бот запускается... (скачивание: {download_backend.name}, режим: {BOT_MODE})")
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(application))
+        else:
+            # Опрос удаляет вебхук, если он был зарегистрирован
+            application.run_polling()
 
     except Exception as e:
         logger.error(f"Ошибка запуска бота: {e}")
+    finally:
+        download_backend.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,19 @@
+import os
+import sys
+import shutil
+import tempfile
+
+# main читает настройки при импорте: папки и порты тестов не должны задевать рабочие
+WORK_DIR = tempfile.mkdtemp(prefix="bot_tests_")
+os.environ.setdefault('DOWNLOADS_DIR', os.path.join(WORK_DIR, "downloads"))
+os.environ.setdefault('SAVED_DIR', os.path.join(WORK_DIR, "saved"))
+os.environ.setdefault('DOWNLOAD_CACHE_DIR', os.path.join(WORK_DIR, "cache"))
+os.environ.setdefault('JOB_DB_PATH', os.path.join(WORK_DIR, "jobs.db"))
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ.setdefault('TOKEN', '0:tests')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
@@ -0,0 +1,25 @@
+import pytest
+
+from main import plan_target_bitrate
+
+
+@pytest.mark.parametrize('duration, has_audio, expected', [
+    (60, True, {'video_kbps': 2500, 'audio_kbps': 128, 'height': 720}),
+    (600, True, {'video_kbps': 507, 'audio_kbps': 96, 'height': 360}),
+    (600, False, {'video_kbps': 603, 'audio_kbps': 0, 'height': 480}),
+])
+def test_plan_for_45_mb(duration, has_audio, expected):
+    assert plan_target_bitrate(duration, 45, has_audio) == expected
+
+
+@pytest.mark.parametrize('duration', [30, 300, 1200, 1800])
+def test_planned_bitrate_fits_target(duration):
+    plan = plan_target_bitrate(duration, 45, True)
+    size = (plan['video_kbps'] + plan['audio_kbps']) * 1000 / 8 * duration
+    assert size <= 45 * 1024 * 1024
+
+
+def test_impossible_targets():
+    # Меньше 100 kbps на видео не остается
+    assert plan_target_bitrate(3600, 45, True) is None
+    assert plan_target_bitrate(0, 45, True) is None
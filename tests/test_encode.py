@@ -0,0 +1,59 @@
+import asyncio
+import shutil
+import subprocess
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(not shutil.which("ffmpeg"), reason="нужен ffmpeg")
+
+
+def stream_times(path) -> dict:
+    """{тип потока: (start_time, конец)}; у mkv конец потока записан в теге DURATION"""
+    output = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "stream=codec_type,start_time,duration:stream_tags=DURATION",
+         "-of", "csv=p=0", str(path)],
+        capture_output=True, text=True, check=True
+    ).stdout
+    times = {}
+    for line in output.split():
+        kind, start, duration, *tag = line.split(',')
+        if duration == 'N/A':
+            hours, minutes, seconds = tag[0].split(':')
+            end = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        else:
+            end = float(start) + float(duration)
+        times[kind] = (float(start), end)
+    return times
+
+
+@pytest.mark.parametrize('audio_delay', [0.5, -0.8])
+def test_parallel_encode_keeps_audio_in_sync(tmp_path, monkeypatch, audio_delay):
+    # Источник с ненулевым start_time и звуком, который начинается позже или раньше видео
+    source = tmp_path / "source.mkv"
+    subprocess.run([
+        "ffmpeg", "-v", "error",
+        "-f", "lavfi", "-i", "testsrc2=size=320x180:rate=25:duration=30",
+        "-itsoffset", f"{max(audio_delay, 0)}", "-f", "lavfi", "-i", "sine=duration=30",
+        "-itsoffset", f"{max(-audio_delay, 0)}", "-f", "lavfi", "-i", "testsrc2=size=320x180:rate=25:duration=30",
+        "-map", "2:v" if audio_delay < 0 else "0:v", "-map", "1:a",
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", "50", "-c:a", "aac",
+        "-output_ts_offset", "5", "-y", str(source)
+    ], check=True)
+    before = stream_times(source)
+
+    monkeypatch.setattr(main, 'PARALLEL_TRANSCODE_JOBS', 3)
+    output = tmp_path / "output.mp4"
+
+    async def encode():
+        monkeypatch.setattr(main, 'parallel_encode_slots', asyncio.Semaphore(3))
+        return await main.encode_parallel(str(source), str(output), ["-c:v", "libx264", "-preset", "ultrafast"],
+                                          30.0, True)
+
+    assert asyncio.run(encode())
+    after = stream_times(output)
+    # Начало и конец звука относительно начала видео те же, что в источнике (звук до видео отрезается)
+    video_start = before['video'][0]
+    assert after['audio'][0] - after['video'][0] == pytest.approx(max(before['audio'][0] - video_start, 0), abs=0.05)
+    assert after['audio'][1] - after['video'][0] == pytest.approx(before['audio'][1] - video_start, abs=0.05)
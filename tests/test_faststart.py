@@ -0,0 +1,42 @@
+import struct
+
+from main import is_faststart_mp4
+
+
+def atom(box_type: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def large_atom(box_type: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack('>I4sQ', 1, box_type, 16 + len(payload)) + payload
+
+
+def write(tmp_path, data: bytes) -> str:
+    path = tmp_path / "video.mp4"
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_moov_before_mdat(tmp_path):
+    assert is_faststart_mp4(write(tmp_path, atom(b'ftyp', b'isom') + atom(b'moov', b'x' * 32) + atom(b'mdat', b'y' * 64)))
+
+
+def test_mdat_before_moov(tmp_path):
+    assert not is_faststart_mp4(write(tmp_path, atom(b'ftyp', b'isom') + atom(b'mdat', b'y' * 64) + atom(b'moov')))
+
+
+def test_64_bit_atom_sizes(tmp_path):
+    data = atom(b'ftyp', b'isom') + large_atom(b'free', b'z' * 100) + atom(b'moov')
+    assert is_faststart_mp4(write(tmp_path, data))
+
+
+def test_malformed_headers_stop_the_walk(tmp_path):
+    # Нулевой размер, размер меньше заголовка и 64-битный размер меньше своего заголовка
+    assert not is_faststart_mp4(write(tmp_path, struct.pack('>I4s', 0, b'free') + atom(b'moov')))
+    assert not is_faststart_mp4(write(tmp_path, struct.pack('>I4s', 4, b'free') + atom(b'moov')))
+    assert not is_faststart_mp4(write(tmp_path, struct.pack('>I4sQ', 1, b'free', 8) + atom(b'moov')))
+
+
+def test_truncated_or_missing_file(tmp_path):
+    assert not is_faststart_mp4(write(tmp_path, atom(b'ftyp', b'isom')[:6]))
+    assert not is_faststart_mp4(str(tmp_path / "missing.mp4"))
@@ -0,0 +1,84 @@
+import os
+import json
+import asyncio
+
+import main
+from main import MediaInfo, ProcessResult
+
+PROBE = {
+    'streams': [
+        {'codec_type': 'video', 'codec_name': 'h264', 'width': 1280, 'height': 720, 'start_time': '1.400000'},
+        {'codec_type': 'audio', 'codec_name': 'opus', 'start_time': '1.900000'},
+    ],
+    'format': {'format_name': 'mov,mp4,m4a,3gp,3g2,mj2', 'duration': '120.5', 'bit_rate': '3000000'},
+}
+
+
+def test_media_info_fields():
+    media = MediaInfo("/tmp/video.mp4", 45 * 1024 * 1024, 0, PROBE)
+    assert (media.width, media.height, media.duration) == (1280, 720, 120.5)
+    assert (media.video_codec, media.audio_codec, media.has_audio) == ('h264', 'opus', True)
+    assert media.bitrate_kbps == 3000
+    assert 'mp4' in media.format_names
+    assert media.audio_offset == 0.5
+    assert media.video_meta() == {'duration': 120, 'width': 1280, 'height': 720}
+    assert media.estimate_parts(20) == 3
+
+
+def test_media_info_without_streams():
+    media = MediaInfo("/tmp/audio.m4a", 8 * 1024 * 1024, 0, {'format': {'duration': '64'}})
+    assert media.video is None and not media.has_audio
+    assert media.bitrate_kbps == 8 * 1024 * 1024 * 8 / 64 / 1000
+    assert media.audio_offset == 0.0
+    assert media.video_meta() == {'duration': 64}
+
+
+def test_probe_is_cached_until_the_file_changes(tmp_path, monkeypatch):
+    calls = []
+
+    async def fake_run_process(cmd, timeout=None, **kwargs):
+        calls.append(cmd)
+        await asyncio.sleep(0.01)
+        return ProcessResult(cmd, 0, json.dumps(PROBE), "")
+
+    monkeypatch.setattr(main, 'run_process', fake_run_process)
+    monkeypatch.setattr(main, '_media_info_cache', main.collections.OrderedDict())
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"x" * 100)
+
+    async def scenario():
+        # Одновременные запросы ждут один вызов ffprobe
+        first, second = await asyncio.gather(main.probe_media(str(path)), main.probe_media(str(path)))
+        assert first is second
+        assert await main.probe_media(str(path)) is first
+        assert len(calls) == 1
+
+        path.write_bytes(b"x" * 200)
+        os.utime(path, ns=(0, 0))
+        changed = await main.probe_media(str(path))
+        assert changed is not first and changed.size == 200
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_packet_index_is_released(monkeypatch):
+    calls = []
+
+    async def fake_probe_packets(path):
+        calls.append(path)
+        return [(0.0, 100)], [0.0]
+
+    monkeypatch.setattr(main, 'probe_packets', fake_probe_packets)
+    media = MediaInfo("/tmp/video.mp4", 100, 0, PROBE)
+
+    async def scenario():
+        assert await media.packet_index() == ([(0.0, 100)], [0.0])
+        await media.packet_index()
+        assert len(calls) == 1
+        media.release_packet_index()
+        assert media._packet_index is None
+        await media.packet_index()
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
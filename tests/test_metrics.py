@@ -0,0 +1,67 @@
+import asyncio
+
+from main import MetricsRegistry
+
+
+def test_counter_gauge_and_collect():
+    registry = MetricsRegistry()
+    downloads = registry.counter('downloads_total', "Скачивания")
+    downloads.inc(platform='vk.com', result='ok')
+    downloads.inc(2, platform='vk.com', result='ok')
+    downloads.inc(platform='say "hi"\\', result='error')
+    active = registry.gauge('active', "Активные")
+    active.inc(3)
+    active.dec()
+    registry.gauge('queued', "В очереди", collect=lambda: {(('stage', 'upload'),): 4})
+
+    lines = registry.render().splitlines()
+    assert "# TYPE downloads_total counter" in lines
+    assert 'downloads_total{platform="vk.com",result="ok"} 3' in lines
+    assert 'downloads_total{platform="say \\"hi\\"\\\\",result="error"} 1' in lines
+    assert "active 2" in lines
+    assert 'queued{stage="upload"} 4' in lines
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    stage = registry.histogram('stage_seconds', "Этапы", buckets=(1, 5, 0.5))
+    for value in (0.2, 0.5, 3, 10):
+        stage.observe(value, stage='probe')
+
+    lines = registry.render().splitlines()
+    assert [line for line in lines if line.startswith("stage_seconds_bucket")] == [
+        'stage_seconds_bucket{stage="probe",le="0.5"} 2',
+        'stage_seconds_bucket{stage="probe",le="1"} 2',
+        'stage_seconds_bucket{stage="probe",le="5"} 3',
+        'stage_seconds_bucket{stage="probe",le="+Inf"} 4',
+    ]
+    assert 'stage_seconds_sum{stage="probe"} 13.7' in lines
+    assert 'stage_seconds_count{stage="probe"} 4' in lines
+
+
+def test_broken_collector_does_not_break_the_page():
+    registry = MetricsRegistry()
+    registry.gauge('broken', "Ошибка", collect=lambda: 1 / 0)
+    registry.counter('ok_total', "Работает").inc()
+    assert "ok_total 1" in registry.render().splitlines()
+
+
+def test_metrics_endpoint():
+    async def scenario():
+        registry = MetricsRegistry()
+        registry.counter('requests_total', "Запросы").inc()
+        await registry.start('127.0.0.1', 0)
+        port = registry._server.sockets[0].getsockname()[1]
+        responses = []
+        for path in ("/metrics", "/other"):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            responses.append((await reader.read()).decode())
+            writer.close()
+        await registry.stop()
+        return responses
+
+    metrics_page, not_found = asyncio.run(scenario())
+    assert metrics_page.startswith("HTTP/1.1 200 OK")
+    assert "requests_total 1" in metrics_page
+    assert not_found.startswith("HTTP/1.1 404")
@@ -0,0 +1,39 @@
+from main import parse_ytdlp_progress, FfmpegProgress, render_progress_bar
+
+
+def test_parses_progress_template_line():
+    progress = parse_ytdlp_progress("PROGRESS 1048576 4194304 NA 524288.5 6")
+    assert progress == {
+        'status': 'downloading',
+        'downloaded_bytes': 1048576.0,
+        'total_bytes': 4194304.0,
+        'speed': 524288.5,
+        'eta': 6.0
+    }
+
+
+def test_unknown_total_falls_back_to_estimate():
+    progress = parse_ytdlp_progress("PROGRESS 100 NA 2000 NA NA")
+    assert progress['total_bytes'] == 2000.0
+    assert progress['speed'] is None
+    assert progress['eta'] is None
+
+
+def test_ignores_other_lines():
+    assert parse_ytdlp_progress("[download] Destination: video.mp4") is None
+    assert parse_ytdlp_progress("PROGRESS 1 2") is None
+
+
+def test_ffmpeg_progress_fraction():
+    fractions = []
+    progress = FfmpegProgress(10.0, fractions.append)
+    for line in ("out_time_us=2500000", "progress=continue", "out_time_us=bad", "progress=continue",
+                 "out_time_us=20000000", "progress=continue", "progress=end"):
+        progress(line)
+    assert fractions == [0.25, 0.25, 1.0, 1.0]
+
+
+def test_progress_bar_is_clamped():
+    assert render_progress_bar(0.5) == "[▓▓▓▓▓░░░░░] 50%"
+    assert render_progress_bar(2) == "[▓▓▓▓▓▓▓▓▓▓] 100%"
+    assert render_progress_bar(None) == "[░░░░░░░░░░] 0%"
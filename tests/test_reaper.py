@@ -0,0 +1,66 @@
+import asyncio
+
+from main import FileReaper, JobStore
+
+
+class Bot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+
+def make_files(tmp_path, *names):
+    paths = []
+    for name in names:
+        path = tmp_path / name
+        path.write_bytes(b"video")
+        paths.append(str(path))
+    return paths
+
+
+def test_due_files_are_removed_in_one_batch(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"), 3600)
+    first, second, later = make_files(tmp_path, "a.mp4", "b.mp4", "c.mp4")
+    job_ids = [store.create(7, 'downloaded', file_path=path) for path in (first, second)]
+
+    async def scenario():
+        bot = Bot()
+        reaper = FileReaper(store, batch_window=0.2)
+        reaper.schedule(first, 0.05, job_ids[0], 7)
+        reaper.schedule(second, 0.15, job_ids[1], 7)
+        reaper.schedule(later, 0.05)
+        # Повторное планирование переносит срок
+        reaper.schedule(later, 30)
+        reaper.start(bot)
+        await asyncio.sleep(0.5)
+        await reaper.stop()
+        return bot, reaper
+
+    bot, reaper = asyncio.run(scenario())
+    assert not (tmp_path / "a.mp4").exists() and not (tmp_path / "b.mp4").exists()
+    assert (tmp_path / "c.mp4").exists()
+    assert reaper.deleted == 2
+    assert all(store.get(job_id) is None for job_id in job_ids)
+    # Один пользователь - одно уведомление на пачку
+    assert len(bot.messages) == 1 and bot.messages[0][0] == 7
+
+
+def test_deadlines_survive_restart(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"), 3600)
+    path, = make_files(tmp_path, "a.mp4")
+
+    FileReaper(store).schedule(path, 0.05)
+
+    async def scenario():
+        reaper = FileReaper(store, batch_window=0.1)
+        reaper.start(Bot())
+        await asyncio.sleep(0.3)
+        await reaper.stop()
+        return reaper
+
+    reaper = asyncio.run(scenario())
+    assert reaper.deleted == 1
+    assert not (tmp_path / "a.mp4").exists()
+    assert store.db.execute("SELECT COUNT(*) FROM expiring_files").fetchone()[0] == 0
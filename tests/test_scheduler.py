@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from main import StagePool, QueueFullError
+
+
+async def wait_queued(pool: StagePool, count: int):
+    while pool.queued < count:
+        await asyncio.sleep(0)
+
+
+def test_slots_are_shared_round_robin_between_owners():
+    async def scenario():
+        pool = StagePool('test', workers=1, max_queue=10)
+        started = []
+        release = asyncio.Event()
+
+        def job(name):
+            async def run():
+                started.append(name)
+                if name == 'c':
+                    await release.wait()
+            return run
+
+        blocker = asyncio.create_task(pool.run(job('c'), owner='c'))
+        await asyncio.sleep(0)
+        # Первый пользователь ставит три задачи раньше второго, но второй не ждет их все
+        tasks = [asyncio.create_task(pool.run(job(f"a{i}"), owner='a')) for i in range(3)]
+        await wait_queued(pool, 3)
+        tasks.append(asyncio.create_task(pool.run(job('b0'), owner='b')))
+        await wait_queued(pool, 4)
+        # Следующая задача второго пользователя пойдет после a0, b0, a1
+        assert pool.next_position('b') == 4
+
+        release.set()
+        await asyncio.gather(blocker, *tasks)
+        return started
+
+    assert asyncio.run(scenario()) == ['c', 'a0', 'b0', 'a1', 'a2']
+
+
+def test_owner_queue_limit():
+    async def scenario():
+        pool = StagePool('test', workers=1, max_queue=10, owner_queue=2)
+        release = asyncio.Event()
+        running = asyncio.create_task(pool.run(release.wait, owner='a'))
+        await asyncio.sleep(0)
+        queued = [asyncio.create_task(pool.run(release.wait, owner='a')) for _ in range(2)]
+        await wait_queued(pool, 2)
+
+        assert pool.is_full('a')
+        assert not pool.is_full('b')
+        with pytest.raises(QueueFullError):
+            await pool.run(release.wait, owner='a')
+        assert pool.stats['rejected'] == 1
+
+        release.set()
+        await asyncio.gather(running, *queued)
+        return pool
+
+    pool = asyncio.run(scenario())
+    assert pool.stats['completed'] == 3
+    assert pool.active == pool.queued == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        pool = StagePool('test', workers=1, max_queue=10)
+        release = asyncio.Event()
+        running = asyncio.create_task(pool.run(release.wait, owner='a'))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(pool.run(release.wait, owner='b'))
+        await wait_queued(pool, 1)
+
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert pool.queued == 0 and pool.waiting_owners == 0
+
+        release.set()
+        await running
+        return pool
+
+    pool = asyncio.run(scenario())
+    assert pool.active == 0
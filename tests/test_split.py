@@ -0,0 +1,44 @@
+from main import plan_split_points
+
+
+def packets(count: int, size: int, step: float = 0.1) -> list:
+    return [(round(i * step, 3), size) for i in range(count)]
+
+
+def part_sizes(packet_list: list, cuts: list) -> list:
+    bounds = [float('-inf')] + cuts + [float('inf')]
+    return [
+        sum(size for t, size in packet_list if start <= t < end)
+        for start, end in zip(bounds, bounds[1:])
+    ]
+
+
+def test_fits_without_cuts():
+    assert plan_split_points(packets(100, 100), [0, 2, 4, 6, 8], 20000) == []
+
+
+def test_cuts_on_last_fitting_keyframe():
+    data = packets(100, 100)
+    cuts = plan_split_points(data, [0, 2, 4, 6, 8], 6500)
+    assert cuts == [6]
+    assert all(size <= 6500 for size in part_sizes(data, cuts))
+
+
+def test_tail_after_last_keyframe_is_checked():
+    # Хвост от последнего ключевого кадра до конца файла тоже должен влезть: 4000 + 4000 + 2000
+    data = packets(100, 100)
+    cuts = plan_split_points(data, [0, 2, 4, 6, 8], 4500)
+    assert cuts == [4, 8]
+    assert part_sizes(data, cuts) == [4000, 4000, 2000]
+
+
+def test_oversized_gop_is_cut_on_its_own_keyframe():
+    data = packets(100, 100)
+    cuts = plan_split_points(data, [0, 5], 3000)
+    assert cuts == [5]
+    # Оба GOP больше лимита - такие части перекодируются после разделения
+    assert part_sizes(data, cuts) == [5000, 5000]
+
+
+def test_empty_index():
+    assert plan_split_points([], [], 1000) == []